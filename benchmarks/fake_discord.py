@@ -0,0 +1,104 @@
+import random
+
+
+# Минимальные заменители объектов discord.py: ровно те поля, которые читают
+# VoiceTracker, VoiceSnapshot и DiscordBot. Сеть и токены не нужны.
+class FakeMember:
+    __slots__ = ("id", "name", "guild", "bot")
+
+    def __init__(self, member_id, name, guild, bot=False):
+        self.id = member_id
+        self.name = name
+        self.guild = guild
+        self.bot = bot
+
+
+class FakeVoiceChannel:
+    def __init__(self, channel_id, name):
+        self.id = channel_id
+        self.name = name
+        self.members = []
+
+
+class FakeVoiceState:
+    __slots__ = ("channel",)
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name, channel_count):
+        self.id = guild_id
+        self.name = name
+        self.me = object()
+        self.voice_channels = [FakeVoiceChannel(guild_id * 1000 + i, f"voice-{i}") for i in range(channel_count)]
+        self.channels_by_id = {c.id: c for c in self.voice_channels}
+        self.members = {}
+        self.member_list = []
+        self.member_channel = {}  # member_id -> FakeVoiceChannel
+
+    def add_channel(self, channel_id, name=None):
+        channel = self.channels_by_id.get(channel_id)
+        if channel is None:
+            channel = FakeVoiceChannel(channel_id, name or f"voice-{len(self.voice_channels)}")
+            self.voice_channels.append(channel)
+            self.channels_by_id[channel_id] = channel
+        return channel
+
+    def add_member(self, member_id, name, bot=False):
+        member = self.members.get(member_id)
+        if member is None:
+            member = FakeMember(member_id, name, self, bot=bot)
+            self.members[member_id] = member
+            self.member_list.append(member)
+        return member
+
+    def get_channel(self, channel_id):
+        return self.channels_by_id.get(channel_id)
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def move(self, member, channel):
+        # Меняет кэш так же, как discord.py перед on_voice_state_update, и возвращает (before, after)
+        before = self.member_channel.pop(member.id, None)
+        if before is not None:
+            before.members.remove(member)
+        if channel is not None:
+            channel.members.append(member)
+            self.member_channel[member.id] = channel
+        return FakeVoiceState(before), FakeVoiceState(channel)
+
+
+class FakeWorld:
+    # Набор синтетических гильдий. Всё строится из seed, поэтому прогоны воспроизводимы
+    def __init__(self, guilds, channels, members, occupancy, bot_share, seed):
+        self.rng = random.Random(seed)
+        self.guilds = []
+        self.guilds_by_id = {}
+        for g in range(guilds):
+            guild = FakeGuild(1_000_000 + g, f"guild-{g}", channels)
+            for m in range(members):
+                member_id = guild.id * 100_000 + m
+                member = FakeMember(member_id, f"user-{g}-{m}", guild, bot=self.rng.random() < bot_share)
+                guild.members[member_id] = member
+                guild.member_list.append(member)
+                if self.rng.random() < occupancy:
+                    guild.move(member, self.rng.choice(guild.voice_channels))
+            self.guilds.append(guild)
+            self.guilds_by_id[guild.id] = guild
+
+    def get_guild(self, guild_id):
+        return self.guilds_by_id.get(guild_id)
+
+    def random_event(self, leave_share):
+        # Случайный участник заходит, переходит или выходит; возвращает аргументы on_voice_state_update
+        guild = self.rng.choice(self.guilds)
+        member = self.rng.choice(guild.member_list)
+        if member.id in guild.member_channel and self.rng.random() < leave_share:
+            channel = None
+        else:
+            channel = self.rng.choice(guild.voice_channels)
+        before, after = guild.move(member, channel)
+        return member, before, after
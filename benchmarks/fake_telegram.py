@@ -0,0 +1,274 @@
+# Локальная заглушка Telegram Bot API: то подмножество методов, которым пользуется TelegramBot.
+# Умеет добавлять задержку, отвечать 429 (случайно и по лимитам, похожим на настоящие)
+# и генерировать поток входящих апдейтов. Бот направляется сюда через TELEGRAM_API_BASE:
+#
+#   python benchmarks/fake_telegram.py --port 8081 --latency-ms 30 --update-rate 5
+#   TELEGRAM_API_BASE=http://127.0.0.1:8081 python main.py
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from aiohttp import web
+
+COMMANDS = ("/start", "/help", "/settings", "/setthreshold {n}", "/setmode total", "/setmode max_channel",
+            "/addserver {server}", "/setdigest off")
+CALLBACKS = ("mode_total", "mode_max", "digest_on", "digest_off")
+
+
+class Bucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self):
+        # 0, если токен есть, иначе сколько секунд ждать
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeTelegramServer:
+    def __init__(self, latency_ms=0, inject_429=0.0, retry_after=1, global_rate=30.0, chat_rate=1.0,
+                 chat_burst=3, seed=1):
+        self.latency = latency_ms / 1000
+        self.inject_429 = inject_429
+        self.retry_after = retry_after
+        self.global_bucket = Bucket(global_rate, max(1, int(global_rate))) if global_rate > 0 else None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.rng = random.Random(seed)
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.updates_event = asyncio.Event()
+        # Ожидающие ответа апдейты: chat_id -> [время создания, ...]; callback id -> время создания
+        self.pending_replies = {}
+        self.pending_callbacks = {}
+        self.reply_latencies = []
+        self.method_calls = {}
+        self.messages = {}  # chat_id -> число доставленных сообщений
+        self.rate_limited = 0
+        self.injected = 0
+        self.last_delivery = None
+        self.runner = None
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self.app.router.add_get("/bot{token}/{method}", self.handle)
+
+    async def start(self, host="127.0.0.1", port=8081):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info(f"Fake Telegram Bot API listening on http://{host}:{port}.")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    # --- входящие апдейты ---
+
+    def user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+    def chat(self, chat_id):
+        return {"id": chat_id, "type": "private"}
+
+    def push_update(self, update):
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(update)
+        self.updates_event.set()
+
+    def push_message(self, chat_id, text):
+        self.pending_replies.setdefault(chat_id, []).append(time.monotonic())
+        message = {
+            "message_id": self.new_message_id(), "date": int(time.time()),
+            "chat": self.chat(chat_id), "from": self.user(chat_id), "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        self.push_update({"message": message})
+
+    def push_callback(self, chat_id, data):
+        callback_id = f"cb{self.next_update_id}"
+        self.pending_callbacks[callback_id] = time.monotonic()
+        self.push_update({"callback_query": {
+            "id": callback_id, "from": self.user(chat_id), "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": self.new_message_id(), "date": int(time.time()), "chat": self.chat(chat_id),
+                        "text": "Выберите режим:"},
+        }})
+
+    def push_random(self, chat_ids, server_ids, callback_share=0.2):
+        chat_id = self.rng.choice(chat_ids)
+        if self.rng.random() < callback_share:
+            self.push_callback(chat_id, self.rng.choice(CALLBACKS))
+            return
+        text = self.rng.choice(COMMANDS).format(n=self.rng.randint(1, 20), server=self.rng.choice(server_ids))
+        self.push_message(chat_id, text)
+
+    async def generate(self, rate, chat_ids, server_ids):
+        # Синтетический поток команд с постоянной частотой rate апдейтов в секунду
+        interval = 1 / rate
+        next_at = time.monotonic()
+        while True:
+            self.push_random(chat_ids, server_ids)
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+
+    def new_message_id(self):
+        self.next_message_id += 1
+        return self.next_message_id
+
+    # --- обработка запросов бота ---
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        self.method_calls[method] = self.method_calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        if method == "getupdates":
+            return await self.get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("sendmessage", "editmessagetext"):
+            limited = self.check_limits(int(params.get("chat_id", 0)))
+            if limited:
+                return limited
+        handler = {
+            "getme": self.get_me,
+            "deletewebhook": lambda p: True,
+            "setwebhook": lambda p: True,
+            "sendmessage": self.send_message,
+            "editmessagetext": self.edit_message_text,
+            "answercallbackquery": self.answer_callback_query,
+        }.get(method)
+        if handler is None:
+            return self.error(404, f"Not Found: method {method} is not implemented by the fake server")
+        return web.json_response({"ok": True, "result": handler(params)})
+
+    def error(self, code, description, parameters=None):
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def check_limits(self, chat_id):
+        if self.inject_429 and self.rng.random() < self.inject_429:
+            self.injected += 1
+            return self.too_many(self.retry_after)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = Bucket(self.chat_rate, self.chat_burst)
+        wait = bucket.take() if self.chat_rate > 0 else 0.0
+        if not wait and self.global_bucket is not None:
+            wait = self.global_bucket.take()
+        if wait:
+            self.rate_limited += 1
+            return self.too_many(max(1, math.ceil(wait)))
+        return None
+
+    def too_many(self, retry_after):
+        return self.error(429, f"Too Many Requests: retry after {retry_after}", {"retry_after": retry_after})
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        if offset:
+            # Как в настоящем API: offset подтверждает все апдейты до него
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.updates_event.clear()
+            try:
+                await asyncio.wait_for(self.updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit", 100) or 100)
+        return web.json_response({"ok": True, "result": self.updates[:limit]})
+
+    def get_me(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    def delivered(self, chat_id):
+        self.last_delivery = time.monotonic()
+        self.messages[chat_id] = self.messages.get(chat_id, 0) + 1
+        pending = self.pending_replies.get(chat_id)
+        if pending:
+            self.reply_latencies.append(time.monotonic() - pending.pop(0))
+
+    def send_message(self, params):
+        chat_id = int(params["chat_id"])
+        self.delivered(chat_id)
+        return {"message_id": self.new_message_id(), "date": int(time.time()), "chat": self.chat(chat_id),
+                "text": params.get("text", "")}
+
+    def edit_message_text(self, params):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return {"message_id": int(params.get("message_id", 0) or 0), "date": int(time.time()),
+                "chat": self.chat(chat_id), "text": params.get("text", "")}
+
+    def answer_callback_query(self, params):
+        created = self.pending_callbacks.pop(params.get("callback_query_id"), None)
+        self.last_delivery = time.monotonic()
+        if created is not None:
+            self.reply_latencies.append(time.monotonic() - created)
+        return True
+
+    def stats(self):
+        return {
+            "method_calls": dict(self.method_calls),
+            "messages_delivered": sum(self.messages.values()),
+            "rate_limited": self.rate_limited,
+            "injected_429": self.injected,
+            "pending_updates": len(self.updates),
+        }
+
+
+async def serve(args):
+    server = FakeTelegramServer(
+        latency_ms=args.latency_ms, inject_429=args.inject_429, retry_after=args.retry_after,
+        global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=args.chat_burst, seed=args.seed
+    )
+    await server.start(args.host, args.port)
+    if args.update_rate > 0:
+        chat_ids = list(range(1000, 1000 + args.users))
+        asyncio.create_task(server.generate(args.update_rate, chat_ids, [1_000_000 + i for i in range(10)]))
+    try:
+        while True:
+            await asyncio.sleep(10)
+            logging.info(json.dumps(server.stats()))
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--inject-429", type=float, default=0.0, help="probability of a random 429 on sends")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--global-rate", type=float, default=30.0, help="sends per second before 429, 0 - unlimited")
+    parser.add_argument("--chat-rate", type=float, default=1.0, help="sends per second per chat, 0 - unlimited")
+    parser.add_argument("--chat-burst", type=int, default=3)
+    parser.add_argument("--update-rate", type=float, default=0.0, help="synthetic updates per second")
+    parser.add_argument("--users", type=int, default=100, help="synthetic users sending updates")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Нагрузка на Telegram-часть бота через локальную заглушку Bot API (benchmarks/fake_telegram.py).
+# Меряет скорость обработки команд и отправки уведомлений при лимитах, похожих на настоящие.
+#
+#   python benchmarks/telegram_load.py --duration 20 --command-rate 50 --alert-rate 100 --latency-ms 30
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from voice_pipeline import percentile, git_commit
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram command and alert load test against a fake Bot API.")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--drain-timeout", type=float, default=30.0, help="seconds to wait for outstanding work")
+    parser.add_argument("--command-rate", type=float, default=20.0, help="incoming updates per second")
+    parser.add_argument("--users", type=int, default=200, help="users sending commands")
+    parser.add_argument("--alert-rate", type=float, default=50.0, help="alerts submitted per second")
+    parser.add_argument("--alert-chats", type=int, default=500, help="distinct chats receiving alerts")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake API latency per request")
+    parser.add_argument("--inject-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--chat-rate", type=float, default=1.0)
+    parser.add_argument("--chat-burst", type=int, default=3)
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON to this file")
+    return parser.parse_args(argv)
+
+
+def configure_env(args, workdir):
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "data.json"),
+        "SQLITE_DB_PATH": os.path.join(workdir, "data.db"),
+        "TELEGRAM_BOT_TOKEN": "123456789:benchmark-token-not-used-for-network",
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{args.port}",
+        "ENABLE_LOGGING": "false",
+    })
+    sys.path.insert(0, ROOT)
+
+
+async def submit_alerts(telegram_bot, rng, rate, chat_ids):
+    interval = 1 / rate
+    next_at = time.monotonic()
+    submitted = 0
+    try:
+        while True:
+            chat_id = rng.choice(chat_ids)
+            channel = f"Сервер guild-{rng.randint(0, 20)} (все каналы)"
+            telegram_bot.notify_user(str(chat_id), channel, rng.randint(3, 30), ["alice", "bob", "carol"])
+            submitted += 1
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+    except asyncio.CancelledError:
+        return submitted
+
+
+async def run(args):
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    from fake_telegram import FakeTelegramServer
+    from storage import create_storage
+    from telegram_bot import TelegramBot
+
+    server = FakeTelegramServer(
+        latency_ms=args.latency_ms, inject_429=args.inject_429, retry_after=args.retry_after,
+        global_rate=args.global_rate, chat_rate=args.chat_rate, chat_burst=args.chat_burst, seed=args.seed
+    )
+    await server.start(port=args.port)
+    storage = create_storage()
+    storage.start_flusher()
+    telegram_bot = TelegramBot(storage)
+    polling = asyncio.create_task(telegram_bot.start_async())
+
+    command_chats = list(range(1000, 1000 + args.users))
+    alert_chats = list(range(500_000, 500_000 + args.alert_chats))
+    generator = asyncio.create_task(server.generate(args.command_rate, command_chats, [1_000_000 + i for i in range(10)]))
+    alerts = asyncio.create_task(submit_alerts(telegram_bot, server.rng, args.alert_rate, alert_chats)) \
+        if args.alert_rate > 0 else None
+
+    started = time.monotonic()
+    await asyncio.sleep(args.duration)
+    generator.cancel()
+    submitted = 0
+    if alerts is not None:
+        alerts.cancel()
+        submitted = await alerts
+    commands_pushed = server.next_update_id - 1
+    load_end = time.monotonic()
+
+    # Ждём, пока бот ответит на всё и разошлёт очередь уведомлений. Ответ на команду, получивший 429,
+    # бот не повторяет, поэтому ждём и до тех пор, пока отправки не затихнут на пару секунд
+    deadline = load_end + args.drain_timeout
+    while time.monotonic() < deadline:
+        outstanding = sum(len(v) for v in server.pending_replies.values()) + len(server.pending_callbacks)
+        notifier_idle = not telegram_bot.notifier.queue_depth and not telegram_bot.notifier.pending
+        quiet = server.last_delivery is None or time.monotonic() - server.last_delivery > 2
+        if notifier_idle and (not outstanding or quiet):
+            break
+        await asyncio.sleep(0.1)
+    finished = max(load_end, server.last_delivery or load_end)
+
+    await telegram_bot.dp.stop_polling()
+    await polling
+    await telegram_bot.stop_async()
+    await storage.close()
+    await server.stop()
+
+    latencies = sorted(server.reply_latencies)
+    alerts_delivered = sum(n for chat_id, n in server.messages.items() if chat_id >= 500_000)
+    dispatcher = telegram_bot.notifier.stats()
+    return {
+        "load_sec": load_end - started,
+        "total_sec": finished - started,
+        "commands_pushed": commands_pushed,
+        "commands_answered": len(latencies),
+        "commands_unanswered": sum(len(v) for v in server.pending_replies.values()) + len(server.pending_callbacks),
+        "commands_per_sec": len(latencies) / (finished - started),
+        "command_latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "command_latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "alerts_submitted": submitted,
+        "alerts_delivered": alerts_delivered,
+        "alerts_per_sec": alerts_delivered / (finished - started),
+        "alerts_merged": dispatcher["merged"],
+        "alerts_failed": dispatcher["failed"],
+        "alerts_dropped": dispatcher["dropped"],
+        "alerts_stale": dispatcher["stale"],
+        "alert_latency_avg_ms": dispatcher["avg_latency"] * 1000,
+        "alert_latency_max_ms": dispatcher["max_latency"] * 1000,
+        "server": server.stats(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="bot-tg-load-") as workdir:
+        configure_env(args, workdir)
+        results = asyncio.run(run(args))
+    report = {
+        "benchmark": "telegram_load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
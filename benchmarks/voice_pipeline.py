@@ -0,0 +1,221 @@
+# Нагрузочный прогон цепочки голосовое событие -> проверка порогов -> хранилище -> уведомление.
+# Работает полностью офлайн: гильдии синтетические, Telegram заменён заглушкой отправки.
+#
+#   python benchmarks/voice_pipeline.py --guilds 200 --events 20000 --output before.json
+#   python benchmarks/voice_pipeline.py --guilds 200 --events 20000 --compare before.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Voice event -> alert pipeline benchmark.")
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=8, help="voice channels per guild")
+    parser.add_argument("--members", type=int, default=200, help="members per guild")
+    parser.add_argument("--occupancy", type=float, default=0.2, help="share of members in voice at start")
+    parser.add_argument("--bots", type=float, default=0.02, help="share of members that are bots")
+    parser.add_argument("--subscribers", type=int, default=2000)
+    parser.add_argument("--servers-per-user", type=int, default=3)
+    parser.add_argument("--max-channel-share", type=float, default=0.5, help="share of users in max_channel mode")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--leave-share", type=float, default=0.3)
+    parser.add_argument("--cooldown-sec", type=int, default=60)
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--journal", choices=("true", "false"), default="true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true", help="measure Python peak memory with tracemalloc (slower)")
+    parser.add_argument("--record-trace", help="write the generated voice events as a trace for voice_replay.py")
+    parser.add_argument("--output", help="write results JSON to this file")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    return parser.parse_args(argv)
+
+
+def configure_env(args, workdir):
+    # Модули бота читают настройки при импорте, поэтому окружение задаётся до импорта
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "data.json"),
+        "SQLITE_DB_PATH": os.path.join(workdir, "data.db"),
+        "STORAGE_BACKEND": args.backend,
+        "STORAGE_JOURNAL": args.journal,
+        "TELEGRAM_BOT_TOKEN": "123456789:benchmark-token-not-used-for-network",
+        "TRACKING_TIMEOUT_SEC": str(args.cooldown_sec),
+        "VOICE_COALESCE_MS": "0",  # каждое событие проверяется сразу, иначе задержка события бессмысленна
+        "VOICE_RESYNC_INTERVAL_SEC": "0",
+        "NOTIFY_GLOBAL_RATE": "1000000",
+        "NOTIFY_CHAT_RATE": "1000000",
+        "NOTIFY_CHAT_BURST": "1000000",
+        "NOTIFY_QUEUE_SIZE": "1000000",
+        "ENABLE_LOGGING": "false",
+        "VOICE_TRACE_PATH": os.path.abspath(args.record_trace) if args.record_trace else "",
+    })
+    sys.path.insert(0, ROOT)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def populate(storage, world, args):
+    rng = world.rng
+    guild_ids = [g.id for g in world.guilds]
+    with storage.defer_writes():
+        for u in range(args.subscribers):
+            servers = rng.sample(guild_ids, min(args.servers_per_user, len(guild_ids)))
+            storage.update_user_settings(str(100 + u), {
+                "servers": servers,
+                "threshold": rng.randint(1, max(1, args.members // 10)),
+                "mode": "max_channel" if rng.random() < args.max_channel_share else "total",
+            })
+    storage.flush(compact=True)
+
+
+async def run(args):
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    from fake_discord import FakeWorld
+    from storage import create_storage
+    from discord_bot import DiscordBot
+    from telegram_bot import TelegramBot
+    from metrics import STORAGE_FLUSH_DURATION
+
+    world = FakeWorld(args.guilds, args.channels, args.members, args.occupancy, args.bots, args.seed)
+    storage = create_storage()
+    populate(storage, world, args)
+
+    changes = 0
+    record_change = storage.record_change
+
+    def counting_record_change(change):
+        nonlocal changes
+        changes += 1
+        record_change(change)
+    storage.record_change = counting_record_change
+
+    sent = 0
+
+    async def stub_send(chat_id, text):
+        nonlocal sent
+        sent += 1
+
+    telegram_bot = TelegramBot(storage)
+    telegram_bot.notifier.send = stub_send
+    telegram_bot.notifier.start()
+    discord_bot = DiscordBot(storage)
+    discord_bot.client.get_guild = world.get_guild
+    telegram_bot.set_discord_bot(discord_bot)
+    discord_bot.set_telegram_bot(telegram_bot)
+    storage.start_flusher()
+
+    # То же, что делает on_ready, но без подключения к шлюзу
+    started = time.perf_counter()
+    discord_bot.voice_tracker.seed_all(world.guilds)
+    discord_bot.initialized = True
+    # client.guilds у неподключённого клиента пуст, поэтому гильдии передаются явно
+    await discord_bot.initial_check_all_guilds(world.guilds)
+    initial_check_sec = time.perf_counter() - started
+
+    events = [world.random_event(args.leave_share) for _ in range(args.events)]
+    handler = discord_bot.client.on_voice_state_update
+    flushes_before = sum(s[2] for s in STORAGE_FLUSH_DURATION.series.values())
+    changes = 0
+    sent = 0
+    latencies = []
+    if args.trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    for member, before, after in events:
+        t = time.perf_counter()
+        await handler(member, before, after)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+
+    if discord_bot.trace is not None:
+        discord_bot.trace.close()
+    await telegram_bot.stop_async()
+    await storage.close()
+    python_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    if args.trace_memory:
+        tracemalloc.stop()
+    flushes = sum(s[2] for s in STORAGE_FLUSH_DURATION.series.values()) - flushes_before
+
+    latencies.sort()
+    return {
+        "events": args.events,
+        "elapsed_sec": elapsed,
+        "events_per_sec": args.events / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "latency_max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        "initial_check_sec": initial_check_sec,
+        "storage_changes_per_event": changes / args.events if args.events else 0.0,
+        "storage_flushes": flushes,
+        "alerts_sent": sent,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "python_peak_mb": python_peak / (1024 * 1024) if python_peak is not None else None,
+    }
+
+
+def compare(results, previous):
+    # Относительное изменение ключевых метрик; для задержек и памяти рост - это плохо
+    lines = []
+    for key in ("events_per_sec", "latency_p50_ms", "latency_p99_ms", "storage_changes_per_event", "peak_rss_mb"):
+        old = previous["results"].get(key)
+        new = results.get(key)
+        if not old or new is None:
+            continue
+        lines.append(f"{key:28} {old:12.3f} -> {new:12.3f} ({(new - old) / old * 100:+.1f}%)")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as workdir:
+        configure_env(args, workdir)
+        results = asyncio.run(run(args))
+    report = {
+        "benchmark": "voice_pipeline",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "record_trace")},
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous.get("params") != report["params"]:
+            print("Warning: parameters differ from the compared run.", file=sys.stderr)
+        print(compare(results, previous))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# Воспроизведение записанных голосовых событий (VOICE_TRACE_PATH) через цепочку проверки порогов
+# на синтетических гильдиях, под cProfile или tracemalloc. Показывает горячие функции и выданные
+# уведомления, чтобы проверить, что изменение даёт те же уведомления за меньшее время.
+#
+#   python benchmarks/voice_pipeline.py --events 20000 --record-trace /tmp/voice.trace
+#   python benchmarks/voice_replay.py /tmp/voice.trace --alerts-out before.alerts
+#   python benchmarks/voice_replay.py /tmp/voice.trace --compare-alerts before.alerts --speed 10
+import argparse
+import asyncio
+import cProfile
+import hashlib
+import json
+import os
+import platform
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+from voice_pipeline import percentile, git_commit
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded voice event trace through the threshold pipeline.")
+    parser.add_argument("trace", nargs="+", help="trace files, oldest first (rotated: trace.2 trace.1 trace)")
+    parser.add_argument("--speed", type=float, default=0.0, help="1 - real time, 10 - ten times faster, 0 - max")
+    parser.add_argument("--profile", choices=("cprofile", "tracemalloc", "none"), default="cprofile")
+    parser.add_argument("--top", type=int, default=25, help="hot spots to report")
+    parser.add_argument("--settings", help="data.json with real subscribers instead of synthetic ones")
+    parser.add_argument("--subscribers", type=int, default=2000)
+    parser.add_argument("--servers-per-user", type=int, default=3)
+    parser.add_argument("--max-threshold", type=int, default=10)
+    parser.add_argument("--max-channel-share", type=float, default=0.5, help="share of users in max_channel mode")
+    parser.add_argument("--cooldown-sec", type=int, default=0,
+                        help="notification cooldown; 0 keeps alerts independent of replay speed")
+    parser.add_argument("--coalesce-ms", type=int, help="VOICE_COALESCE_MS, default 0 at max speed and 250 otherwise")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--alerts-out", help="write produced alerts as JSONL")
+    parser.add_argument("--compare-alerts", help="alerts JSONL from a previous replay to compare against")
+    parser.add_argument("--output", help="write results JSON to this file")
+    return parser.parse_args(argv)
+
+
+def configure_env(args, workdir):
+    # Модули бота читают настройки при импорте, поэтому окружение задаётся до импорта
+    coalesce_ms = args.coalesce_ms if args.coalesce_ms is not None else (0 if args.speed <= 0 else 250)
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "data.json"),
+        "SQLITE_DB_PATH": os.path.join(workdir, "data.db"),
+        "STORAGE_BACKEND": "json",
+        "TELEGRAM_BOT_TOKEN": "123456789:replay-token-not-used-for-network",
+        "TRACKING_TIMEOUT_SEC": str(args.cooldown_sec),
+        "VOICE_COALESCE_MS": str(coalesce_ms),
+        "VOICE_RESYNC_INTERVAL_SEC": "0",
+        "NOTIFY_GLOBAL_RATE": "1000000",
+        "NOTIFY_CHAT_RATE": "1000000",
+        "NOTIFY_CHAT_BURST": "1000000",
+        "NOTIFY_QUEUE_SIZE": "1000000",
+        "ENABLE_LOGGING": "false",
+        "VOICE_TRACE_PATH": "",
+    })
+    if args.settings:
+        shutil.copy(args.settings, os.environ["DB_PATH"])
+    sys.path.insert(0, ROOT)
+    return coalesce_ms
+
+
+def build_world(events):
+    # Гильдии, каналы и участники - ровно те, что встречаются в записи. Участник, чьё первое событие
+    # начинается из канала, изначально сидит в этом канале, иначе начальная заполненность была бы нулевой
+    from fake_discord import FakeGuild
+    guilds = {}
+    seen = set()
+    for _, guild_id, member_hash, before_id, after_id in events:
+        guild = guilds.get(guild_id)
+        if guild is None:
+            guild = guilds[guild_id] = FakeGuild(guild_id, f"guild-{len(guilds)}", 0)
+        for channel_id in (before_id, after_id):
+            if channel_id is not None:
+                guild.add_channel(channel_id)
+        member = guild.add_member(member_hash, f"m{member_hash:016x}"[:9])
+        if (guild_id, member_hash) not in seen:
+            seen.add((guild_id, member_hash))
+            if before_id is not None:
+                guild.move(member, guild.get_channel(before_id))
+    return guilds
+
+
+def populate(storage, guild_ids, args):
+    import random
+    rng = random.Random(args.seed)
+    with storage.defer_writes():
+        for u in range(args.subscribers):
+            storage.update_user_settings(str(100 + u), {
+                "servers": rng.sample(guild_ids, min(args.servers_per_user, len(guild_ids))),
+                "threshold": rng.randint(1, args.max_threshold),
+                "mode": "max_channel" if rng.random() < args.max_channel_share else "total",
+            })
+    storage.flush(compact=True)
+
+
+def hot_spots(profiler, top):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        if filename.startswith(ROOT):
+            filename = os.path.relpath(filename, ROOT)
+        rows.append({
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "tottime_ms": tottime * 1000,
+            "cumtime_ms": cumtime * 1000,
+        })
+    rows.sort(key=lambda row: row["tottime_ms"], reverse=True)
+    return rows[:top]
+
+
+def memory_spots(snapshot, top):
+    rows = []
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        filename = os.path.relpath(frame.filename, ROOT) if frame.filename.startswith(ROOT) else frame.filename
+        rows.append({"line": f"{filename}:{frame.lineno}", "size_kb": stat.size / 1024, "blocks": stat.count})
+    return rows
+
+
+async def run(args, events, coalesce_ms):
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    from fake_discord import FakeVoiceState
+    from storage import create_storage
+    from discord_bot import DiscordBot
+    from telegram_bot import TelegramBot
+
+    guilds = build_world(events)
+    storage = create_storage()
+    if not args.settings:
+        populate(storage, list(guilds), args)
+
+    alerts = []
+    telegram_bot = TelegramBot(storage)
+    put = telegram_bot.notifier.put
+
+    async def recording_put(chat_id, text, key=None, origin=None):
+        # Порядок постановки в очередь детерминирован, в отличие от порядка отправки несколькими воркерами
+        alerts.append([chat_id, text])
+        return await put(chat_id, text, key=key, origin=origin)
+    telegram_bot.notifier.put = recording_put
+
+    async def stub_send(chat_id, text):
+        pass
+    telegram_bot.notifier.send = stub_send
+    telegram_bot.notifier.start()
+    discord_bot = DiscordBot(storage)
+    discord_bot.client.get_guild = guilds.get
+    telegram_bot.set_discord_bot(discord_bot)
+    discord_bot.set_telegram_bot(telegram_bot)
+    storage.start_flusher()
+
+    # То же, что делает on_ready, но без подключения к шлюзу
+    discord_bot.voice_tracker.seed_all(guilds.values())
+    discord_bot.initialized = True
+    await discord_bot.initial_check_all_guilds(list(guilds.values()))
+
+    handler = discord_bot.client.on_voice_state_update
+    loop = asyncio.get_running_loop()
+    latencies = []
+    profiler = cProfile.Profile() if args.profile == "cprofile" else None
+    if args.profile == "tracemalloc":
+        tracemalloc.start()
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+
+    first_ts = events[0][0] if events else 0.0
+    replay_started = loop.time()
+    for ts, guild_id, member_hash, before_id, after_id in events:
+        if args.speed > 0:
+            delay = replay_started + (ts - first_ts) / args.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        guild = guilds[guild_id]
+        member = guild.members[member_hash]
+        # Кэш гильдии меняется так же, как discord.py меняет его перед on_voice_state_update
+        guild.move(member, guild.get_channel(after_id) if after_id is not None else None)
+        t = time.perf_counter()
+        await handler(member, FakeVoiceState(guild.get_channel(before_id) if before_id is not None else None),
+                      FakeVoiceState(guild.get_channel(after_id) if after_id is not None else None))
+        latencies.append(time.perf_counter() - t)
+    # Дожидаемся последних склеенных проверок, их уведомления тоже часть результата
+    while discord_bot.pending_evaluations:
+        await asyncio.sleep(0.01)
+    if discord_bot.evaluation_tasks:
+        await asyncio.gather(*list(discord_bot.evaluation_tasks))
+
+    if profiler is not None:
+        profiler.disable()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    memory = None
+    if args.profile == "tracemalloc":
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        memory = {"python_peak_mb": peak / (1024 * 1024), "top": memory_spots(snapshot, args.top)}
+
+    await telegram_bot.stop_async()
+    await storage.close()
+
+    latencies.sort()
+    results = {
+        "events": len(events),
+        "guilds": len(guilds),
+        "speed": args.speed or "max",
+        "coalesce_ms": coalesce_ms,
+        "trace_span_sec": events[-1][0] - first_ts if events else 0.0,
+        "elapsed_sec": elapsed,
+        "cpu_sec": cpu,
+        "events_per_sec": len(events) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "alerts": len(alerts),
+        "alerts_sha256": hashlib.sha256(json.dumps(alerts, ensure_ascii=False).encode("utf-8")).hexdigest(),
+    }
+    if profiler is not None:
+        results["hot_spots"] = hot_spots(profiler, args.top)
+    if memory is not None:
+        results["memory"] = memory
+    return results, alerts
+
+
+def compare_alerts(alerts, path):
+    with open(path, "r", encoding="utf-8") as f:
+        previous = [json.loads(line) for line in f if line.strip()]
+    if previous == alerts:
+        return f"alerts: same {len(alerts)} alerts"
+    for index, (old, new) in enumerate(zip(previous, alerts)):
+        if old != new:
+            return f"alerts: DIFFER at #{index}: {old} -> {new} ({len(previous)} -> {len(alerts)} alerts)"
+    return f"alerts: DIFFER in count, {len(previous)} -> {len(alerts)}"
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, ROOT)
+    from voice_trace import read_trace
+    events = list(read_trace(args.trace))
+    with tempfile.TemporaryDirectory(prefix="bot-replay-") as workdir:
+        coalesce_ms = configure_env(args, workdir)
+        results, alerts = asyncio.run(run(args, events, coalesce_ms))
+    report = {
+        "benchmark": "voice_replay",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "alerts_out", "compare_alerts")},
+        "results": results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.alerts_out:
+        with open(args.alerts_out, "w", encoding="utf-8") as f:
+            for alert in alerts:
+                f.write(json.dumps(alert, ensure_ascii=False) + "\n")
+    if args.compare_alerts:
+        print(compare_alerts(alerts, args.compare_alerts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import heapq
+import logging
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MAX_COOLDOWNS = int(os.getenv("MAX_COOLDOWNS", "100000"))
+
+
+class CooldownStore:
+    # Таймауты уведомлений (user_str, server_id) -> время (time.time()), до которого не уведомлять.
+    # Истёкшие записи вычищаются по min-куче за O(log n) каждая, размер ограничен max_size.
+    def __init__(self, max_size=MAX_COOLDOWNS):
+        self.max_size = max_size
+        self.expiry = {}
+        # (время истечения, ключ). Устаревшие элементы кучи не удаляем сразу, а пропускаем при извлечении
+        self.heap = []
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def is_active(self, key, now):
+        expiry = self.expiry.get(key)
+        return expiry is not None and now < expiry
+
+    def set(self, key, expiry, now):
+        # Возвращает ключи, которые пришлось выбросить (истекли или вытеснены), чтобы их убрали и из хранилища
+        self.expiry[key] = expiry
+        heapq.heappush(self.heap, (expiry, key))
+        removed = self.purge(now)
+        while len(self.expiry) > self.max_size:
+            # Переполнение: выбрасываем те, что истекают раньше всех
+            removed.append(self.pop_soonest())
+        if len(self.heap) > 2 * len(self.expiry) + 1024:
+            self.heap = [(e, k) for k, e in self.expiry.items()]
+            heapq.heapify(self.heap)
+        return removed
+
+    def pop_soonest(self):
+        while self.heap:
+            expiry, key = heapq.heappop(self.heap)
+            if self.expiry.get(key) == expiry:
+                del self.expiry[key]
+                return key
+        return None
+
+    def purge(self, now):
+        removed = []
+        while self.heap and self.heap[0][0] <= now:
+            expiry, key = heapq.heappop(self.heap)
+            if self.expiry.get(key) == expiry:
+                del self.expiry[key]
+                removed.append(key)
+        return removed
+
+    def load(self, entries, now):
+        # entries: [(user_str, server_id, expiry), ...] из хранилища. Возвращает не поместившиеся ключи
+        for user_str, server_id, expiry in entries:
+            if expiry > now:
+                self.expiry[(user_str, server_id)] = expiry
+        self.heap = [(e, k) for k, e in self.expiry.items()]
+        heapq.heapify(self.heap)
+        removed = []
+        while len(self.expiry) > self.max_size:
+            removed.append(self.pop_soonest())
+        logger.debug(f"Loaded {len(self.expiry)} active cooldowns.")
+        return removed
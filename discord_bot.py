@@ -1,52 +1,272 @@
 import asyncio
 import discord
+import json
 import logging
 from dotenv import load_dotenv
 import os
 import time  # Для отсчета таймаута
 
+from voice_tracker import VoiceTracker, VoiceSnapshot
+from cooldowns import CooldownStore
+from threshold_index import MODES
+from voice_trace import VoiceTraceRecorder, VOICE_TRACE_PATH
+from occupancy_history import OccupancyHistory, HISTORY_ENABLED, HISTORY_PATH, HISTORY_SAVE_INTERVAL_SEC
+from storage import DB_PATH
+from metrics import (VOICE_EVENTS, THRESHOLD_EVALUATIONS, VOICE_EVALUATIONS_COALESCED, PROFILE_HOT_PATH,
+                     DISCORD_READY_SECONDS, FIRST_ALERT_SECONDS, timed, rss_bytes)
+
 load_dotenv()
+
+logger = logging.getLogger(__name__)
+
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN", "")
 TRACKING_TIMEOUT_SEC = int(os.getenv("TRACKING_TIMEOUT_SEC", "300"))  # таймаут по умолчанию 300 секунд (5 мин)
+VOICE_RESYNC_INTERVAL_SEC = int(os.getenv("VOICE_RESYNC_INTERVAL_SEC", "600"))  # периодическая сверка счётчиков, 0 - выключить
+# Склейка пачек событий: проверка порогов запускается через VOICE_COALESCE_MS после последнего события,
+# но не позже VOICE_COALESCE_MAX_DELAY_MS после первого. 0 - проверять на каждое событие
+VOICE_COALESCE_MS = int(os.getenv("VOICE_COALESCE_MS", "250"))
+VOICE_COALESCE_MAX_DELAY_MS = int(os.getenv("VOICE_COALESCE_MAX_DELAY_MS", "1000"))
+INITIAL_SWEEP_CONCURRENCY = int(os.getenv("INITIAL_SWEEP_CONCURRENCY", "8"))  # гильдий одновременно при старте
+# "default" - кэш всех участников (intent members), "voice" - только тех, кто сейчас в голосовых каналах
+DISCORD_CACHE_PROFILE = os.getenv("DISCORD_CACHE_PROFILE", "default")
+# Тёплый старт: при остановке сюда пишется заполненность каналов и таймауты, при запуске они читаются,
+# если снимок не старше WARM_START_MAX_AGE_SEC
+WARM_START_PATH = os.getenv("WARM_START_PATH", DB_PATH + ".warm")
+WARM_START_MAX_AGE_SEC = int(os.getenv("WARM_START_MAX_AGE_SEC", "600"))
+
+
+def client_options():
+    if DISCORD_CACHE_PROFILE == "voice":
+        # Участники попадают в кэш discord.py только пока сидят в голосовом канале, этого хватает
+        # и для подсчёта, и для имён в уведомлении. Привилегированный intent members не нужен,
+        # а без chunk_guilds_at_startup старт не ждёт загрузки списков участников
+        member_cache_flags = discord.MemberCacheFlags.none()
+        member_cache_flags.voice = True
+        return {
+            "intents": discord.Intents(guilds=True, voice_states=True),
+            "member_cache_flags": member_cache_flags,
+            "chunk_guilds_at_startup": False,
+        }
+    return {"intents": discord.Intents(guilds=True, voice_states=True, members=True)}
 
 class DiscordBot:
-    def __init__(self, storage):
-        logging.debug("Initializing DiscordBot.")
+    def __init__(self, storage, shard_ids=None, shard_count=None):
+        logger.debug("Initializing DiscordBot.")
         self.storage = storage
         self.telegram_bot = None
-        self.client = discord.Client(intents=discord.Intents(guilds=True, voice_states=True, members=True))
+        options = client_options()
+        if shard_ids is not None:
+            # Процесс-шард: обслуживает только свою часть гильдий
+            self.client = discord.AutoShardedClient(shard_ids=shard_ids, shard_count=shard_count, **options)
+        else:
+            self.client = discord.Client(**options)
+        self.started_at = None
         self.initialized = False
-        self.notification_cooldowns = {}  # (user_str, server_id) -> timestamp, до которого не уведомлять
+        # (user_str, server_id) -> timestamp, до которого не уведомлять. Сохраняются в storage,
+        # чтобы после перезапуска не уведомить всех повторно
+        self.notification_cooldowns = CooldownStore()
+        self.forget_cooldowns(self.notification_cooldowns.load(self.storage.get_cooldowns(), time.time()))
+        # Инкрементальная заполненность голосовых каналов, обновляется по событиям
+        self.voice_tracker = VoiceTracker()
+        self.resync_task = None
+        self.sweep_task = None
+        self.stopping = False
+        self.first_alert_reported = False
+        # У процесса-шарда свои файлы истории и тёплого старта - гильдии у шардов не пересекаются
+        suffix = f".shard{min(shard_ids)}" if shard_ids else ""
+        self.warm_start_path = WARM_START_PATH + suffix
+        self.warm_started = self.load_warm_start()
+        # Запись голосовых событий для benchmarks/voice_replay.py, только если задан VOICE_TRACE_PATH
+        self.trace = VoiceTraceRecorder(VOICE_TRACE_PATH + suffix) if VOICE_TRACE_PATH else None
+        # История заполненности для /stats
+        self.history = None
+        self.history_task = None
+        if HISTORY_ENABLED:
+            self.history = OccupancyHistory(HISTORY_PATH + suffix)
+            try:
+                self.history.load()
+            except (OSError, ValueError):
+                logger.exception("Failed to load occupancy history, starting empty.")
+        # Отложенные проверки порогов: guild_id -> [время первого события, таймер]
+        self.pending_evaluations = {}
+        self.evaluation_tasks = set()
+        self.guild_locks = {}
+        # guild_id -> time.monotonic() первого ещё не проверенного события (только при PROFILE_HOT_PATH)
+        self.event_started = {}
 
         @self.client.event
         async def on_ready():
-            logging.debug("DiscordBot is ready.")
-            # Просто помечаем что инициализированы. Начальный опрос отдельно не нужен
-            # так как при любом обновлении голосовых каналов мы будем проверять.
+            ready_sec = time.monotonic() - self.started_at if self.started_at is not None else 0.0
+            DISCORD_READY_SECONDS.set(ready_sec)
+            logger.info(
+                f"DiscordBot is ready in {ready_sec:.1f}s with {len(self.client.guilds)} guilds, "
+                f"cache profile {DISCORD_CACHE_PROFILE}, RSS {rss_bytes() / (1024 * 1024):.0f} MB."
+            )
+            if self.stopping:
+                return
+            # on_ready приходит и после переподключения, поэтому здесь полностью пересчитываем каналы
+            self.voice_tracker.seed_all(self.client.guilds)
+            self.publish_guilds({guild.id: guild.name for guild in self.client.guilds})
+            if VOICE_RESYNC_INTERVAL_SEC > 0 and self.resync_task is None:
+                self.resync_task = asyncio.create_task(self.voice_resync_loop())
+            if self.history is not None and HISTORY_SAVE_INTERVAL_SEC > 0 and self.history_task is None:
+                self.history_task = asyncio.create_task(self.history_save_loop())
+            # Помечаем что инициализированы: события обрабатываются сразу, не дожидаясь начальной проверки.
+            # Порядок внутри гильдии сохраняется за счёт guild_locks в evaluate_guild
             self.initialized = True
 
-            # Дополнительно можем вручную запустить проверку всех гильдий:
-            await self.initial_check_all_guilds()
+            # Начальная проверка всех гильдий идёт в фоне
+            if self.sweep_task is not None and not self.sweep_task.done():
+                self.sweep_task.cancel()
+            self.sweep_task = asyncio.create_task(self.initial_check_all_guilds())
 
         @self.client.event
+        @timed("voice_event")
         async def on_voice_state_update(member, before, after):
             if not self.initialized:
                 return
             guild = member.guild
-            logging.debug(f"Voice state update in guild_id={guild.id} for member={member.name}.")
-            user_id_list, max_in_channel, total_in_channels = await self.get_current_users_in_channels(guild.id)
-            await self.check_thresholds_for_guild(guild.id, user_id_list, max_in_channel, total_in_channels)
+            VOICE_EVENTS.inc()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Voice state update in guild_id=%s for member=%s.", guild.id, member.name)
+            if self.trace is not None and not member.bot:
+                self.trace.record(guild.id, member.id, before.channel, after.channel)
+            if not self.voice_tracker.apply(member, before.channel, after.channel):
+                # Мьют, стрим и т.п. - число людей в каналах не изменилось
+                return
+            if PROFILE_HOT_PATH:
+                self.event_started.setdefault(guild.id, time.monotonic())
+            if VOICE_COALESCE_MS <= 0:
+                await self.evaluate_guild(guild.id)
+                return
+            self.schedule_evaluation(guild.id)
+
+        @self.client.event
+        async def on_guild_available(guild):
+            # При тёплом старте гильдии приходят задолго до on_ready (тот ждёт загрузки участников):
+            # пересчитываем каналы гильдии из её GUILD_CREATE и сразу проверяем пороги
+            self.publish_guilds({guild.id: guild.name})
+            if not self.initialized or self.stopping:
+                return
+            self.voice_tracker.seed_guild(guild)
+            await self.evaluate_guild(guild.id)
+
+        @self.client.event
+        async def on_guild_join(guild):
+            logger.debug(f"Joined guild_id={guild.id}.")
+            self.voice_tracker.seed_guild(guild)
+            self.publish_guilds({guild.id: guild.name})
+
+        @self.client.event
+        async def on_guild_remove(guild):
+            logger.debug(f"Removed from guild_id={guild.id}.")
+            self.voice_tracker.drop_guild(guild.id)
+            self.publish_guilds({guild.id: None})
+
+        @self.client.event
+        async def on_guild_update(before, after):
+            if before.name != after.name:
+                self.publish_guilds({after.id: after.name})
 
     def set_telegram_bot(self, telegram_bot):
-        logging.debug("Setting telegram bot in DiscordBot.")
+        # telegram_bot - получатель событий: сам TelegramBot в одном процессе или HubClient в процессе-шарде.
+        # От него нужны только notify_users и update_guilds
+        logger.debug("Setting telegram bot in DiscordBot.")
         self.telegram_bot = telegram_bot
 
+    def forget_cooldowns(self, keys):
+        # Таймауты, не поместившиеся в CooldownStore при загрузке, убираем и из хранилища
+        if keys:
+            with self.storage.defer_writes():
+                self.storage.remove_cooldowns(keys)
+
+    def load_warm_start(self):
+        if not os.path.exists(self.warm_start_path):
+            return False
+        try:
+            with open(self.warm_start_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            # Снимок одноразовый: после падения следующий запуск не должен взять устаревшие данные
+            os.remove(self.warm_start_path)
+        except (OSError, ValueError):
+            logger.exception("Failed to read warm-start snapshot, starting cold.")
+            return False
+        age = time.time() - state.get("saved_at", 0)
+        if age > WARM_START_MAX_AGE_SEC:
+            logger.info(f"Warm-start snapshot is {age:.0f}s old, starting cold.")
+            return False
+        self.voice_tracker.load_state(state.get("occupancy", {}))
+        cooldowns = [(user_str, int(server_id), expiry) for user_str, server_id, expiry in state.get("cooldowns", [])]
+        # Таймауты из снимка не старше тех, что в хранилище, поэтому идут последними
+        self.forget_cooldowns(self.notification_cooldowns.load(self.storage.get_cooldowns() + cooldowns, time.time()))
+        # События применяются к сохранённой заполненности сразу, не дожидаясь on_ready
+        self.initialized = True
+        logger.info(
+            f"Warm start from a {age:.0f}s old snapshot: {len(self.voice_tracker.guilds)} guilds, "
+            f"{len(self.notification_cooldowns)} cooldowns."
+        )
+        return True
+
+    def save_warm_start(self):
+        if not self.voice_tracker.guilds:
+            return
+        state = {
+            "saved_at": time.time(),
+            "occupancy": self.voice_tracker.dump_state(),
+            "cooldowns": [[user_str, server_id, expiry]
+                          for (user_str, server_id), expiry in self.notification_cooldowns.expiry.items()],
+        }
+        tmp_path = self.warm_start_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp_path, self.warm_start_path)
+        logger.info(f"Warm-start snapshot saved for {len(state['occupancy'])} guilds.")
+
+    async def shutdown(self):
+        # Новые события больше не принимаем, отложенные проверки досчитываем сразу,
+        # чтобы их уведомления успели уйти, пока Telegram-сторона разбирает очередь
+        logger.info("Stopping DiscordBot.")
+        self.stopping = True
+        self.initialized = False
+        for server_id, (_, handle) in list(self.pending_evaluations.items()):
+            handle.cancel()
+            self.fire_evaluation(server_id)
+        for task in (self.sweep_task, self.resync_task, self.history_task):
+            if task is not None:
+                task.cancel()
+        if self.evaluation_tasks:
+            await asyncio.gather(*list(self.evaluation_tasks), return_exceptions=True)
+        await self.save_history()
+        try:
+            self.save_warm_start()
+        except OSError:
+            logger.exception("Failed to save warm-start snapshot.")
+        if self.trace is not None:
+            self.trace.close()
+        await self.client.close()
+
+    def report_first_alert(self):
+        self.first_alert_reported = True
+        if self.started_at is None:
+            return
+        elapsed = time.monotonic() - self.started_at
+        start = "warm" if self.warm_started else "cold"
+        # Метка start позволяет сравнить тёплый и холодный запуск
+        FIRST_ALERT_SECONDS.set(elapsed, labels=(start,))
+        logger.info(f"First alert {elapsed:.1f}s after start ({start} start).")
+
+    def publish_guilds(self, names):
+        # Имена гильдий для Telegram-стороны: guild_id -> имя, None - бот больше не на сервере
+        if self.telegram_bot:
+            self.telegram_bot.update_guilds(names)
+
     async def start_async(self):
-        logging.debug("Starting DiscordBot client.")
+        logger.debug("Starting DiscordBot client.")
+        self.started_at = time.monotonic()
         await self.client.start(DISCORD_BOT_TOKEN)
 
     def check_server_permissions(self, server_id):
-        logging.debug(f"Checking permissions on server_id={server_id}.")
+        logger.debug("Checking permissions on server_id=%s.", server_id)
         guild = self.client.get_guild(server_id)
         if not guild:
             return False
@@ -55,83 +275,147 @@ class DiscordBot:
             return False
         return True
 
-    async def initial_check_all_guilds(self):
+    def schedule_evaluation(self, server_id):
+        # Пачка событий по одной гильдии схлопывается в одну проверку с последним состоянием
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        pending = self.pending_evaluations.get(server_id)
+        if pending is None:
+            handle = loop.call_later(VOICE_COALESCE_MS / 1000, self.fire_evaluation, server_id)
+            self.pending_evaluations[server_id] = [now, handle]
+            return
+        # Событие влилось в уже запланированную проверку: bot_voice_evaluations_coalesced_total
+        # против bot_threshold_evaluations_total показывает, сколько проверок сэкономила склейка
+        VOICE_EVALUATIONS_COALESCED.inc()
+        first_event, handle = pending
+        deadline = min(now + VOICE_COALESCE_MS / 1000, first_event + VOICE_COALESCE_MAX_DELAY_MS / 1000)
+        handle.cancel()
+        pending[1] = loop.call_at(deadline, self.fire_evaluation, server_id)
+
+    def fire_evaluation(self, server_id):
+        self.pending_evaluations.pop(server_id, None)
+        task = asyncio.create_task(self.evaluate_guild(server_id))
+        self.evaluation_tasks.add(task)
+        task.add_done_callback(self.evaluation_tasks.discard)
+
+    async def evaluate_guild(self, server_id):
+        # Проверки одной гильдии не должны перекрываться, иначе старые счётчики прочитаются дважды
+        lock = self.guild_locks.get(server_id)
+        if lock is None:
+            lock = self.guild_locks[server_id] = asyncio.Lock()
+        async with lock:
+            THRESHOLD_EVALUATIONS.inc()
+            event_time = self.event_started.pop(server_id, None)
+            snapshot = await self.get_current_users_in_channels(server_id)
+            await self.check_thresholds_for_guild(server_id, snapshot, event_time)
+
+    async def voice_resync_loop(self):
+        # Периодическая сверка инкрементальных счётчиков с кэшем discord.py
+        while True:
+            await asyncio.sleep(VOICE_RESYNC_INTERVAL_SEC)
+            for guild in list(self.client.guilds):
+                self.voice_tracker.reconcile(guild)
+                # Отдаём управление циклу, чтобы не задерживать события на больших инстансах
+                await asyncio.sleep(0)
+
+    async def history_save_loop(self):
+        while True:
+            await asyncio.sleep(HISTORY_SAVE_INTERVAL_SEC)
+            await self.save_history()
+
+    async def save_history(self):
+        if self.history is None or not self.history.dirty:
+            return
+        payload = self.history.dump()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.history.write_file, payload)
+        except OSError:
+            self.history.dirty = True
+            logger.exception("Failed to save occupancy history.")
+
+    async def history_summary(self, server_id):
+        return self.history.summary(server_id) if self.history is not None else None
+
+    async def initial_check_all_guilds(self, guilds=None):
         # Проверим все гильдии при старте, чтобы если после перезапуска число сразу превышает порог,
-        # то уведомить (если раньше было ниже).
-        for guild in self.client.guilds:
-            user_id_list, max_in_channel, total_in_channels = await self.get_current_users_in_channels(guild.id)
-            await self.check_thresholds_for_guild(guild.id, user_id_list, max_in_channel, total_in_channels)
+        # то уведомить (если раньше было ниже). Гильдии с большим числом подписчиков - первыми,
+        # несколько воркеров параллельно, а все изменения счётчиков уходят в хранилище одним commit.
+        started = time.perf_counter()
+        ranked = []
+        for guild in (self.client.guilds if guilds is None else guilds):
+            subscribers = len(self.storage.get_subscribers(guild.id))
+            if subscribers:
+                ranked.append((subscribers, guild.id))
+        ranked.sort(reverse=True)
+        queue = iter([guild_id for _, guild_id in ranked])
+
+        async def worker():
+            for guild_id in queue:
+                await self.evaluate_guild(guild_id)
+                # Даём обработаться событиям, пришедшим во время проверки
+                await asyncio.sleep(0)
 
+        async with self.storage.batch():
+            await asyncio.gather(*(worker() for _ in range(max(1, INITIAL_SWEEP_CONCURRENCY))))
+        elapsed = time.perf_counter() - started
+        rate = len(ranked) / elapsed if elapsed else 0.0
+        logger.info(f"Initial sweep of {len(ranked)} guilds finished in {elapsed:.2f}s ({rate:.0f} guilds/s).")
+
+    @timed("snapshot")
     async def get_current_users_in_channels(self, server_id):
-        logging.debug(f"Getting current users in channels for server_id={server_id}.")
+        logger.debug("Getting current users in channels for server_id=%s.", server_id)
+        # Один срез на событие: и total, и max_channel, общий для всех подписчиков
         guild = self.client.get_guild(server_id)
         if not guild:
-            return [], 0, 0
-        user_set = set()
-        max_count = 0
-        total_count = 0
-        for vc in guild.voice_channels:
-            members_list = [m for m in vc.members if not m.bot]
-            c_len = len(members_list)
-            total_count += c_len
-            if c_len > max_count:
-                max_count = c_len
-            for m in members_list:
-                user_set.add(m.name)
-        return list(user_set), max_count, total_count
-
-    async def check_thresholds_for_guild(self, server_id, user_id_list, max_in_channel, total_in_channels):
-        guild = self.client.get_guild(server_id)
+            return VoiceSnapshot(None, None)
+        occupancy = self.voice_tracker.get(server_id)
+        if occupancy is None:
+            occupancy = self.voice_tracker.seed_guild(guild)
+        snapshot = VoiceSnapshot(guild, occupancy)
+        if self.history is not None:
+            self.history.record(server_id, snapshot.total, snapshot.max_channel)
+        return snapshot
+
+    @timed("thresholds")
+    async def check_thresholds_for_guild(self, server_id, snapshot, event_time=None):
+        guild = snapshot.guild
         if not guild:
             return
+        origin = (server_id, event_time) if event_time is not None else None
 
         current_time = time.time()
 
-        for user_str in self.storage.get_all_users():
-            user_settings = self.storage.get_user_settings(user_str)
-            if not user_settings:
+        index = self.storage.threshold_index
+        for mode in MODES:
+            if not index.has_subscribers(server_id, mode):
                 continue
-            servers = user_settings.get("servers", [])
-            if server_id not in servers:
-                continue
-            mode = user_settings.get("mode", "total")
-            threshold = user_settings.get("threshold", 0)
-
-            cooldown_key = (user_str, server_id)
-            cooldown_expiry = self.notification_cooldowns.get(cooldown_key, 0)
-            if current_time < cooldown_expiry:
-                # Еще действует таймаут, не уведомляем
+            count, channel_name, get_user_list = snapshot.view(mode)
+            # Одно сохранённое значение на (сервер, режим) вместо счётчика на каждого подписчика
+            old_count = self.storage.get_guild_count(server_id, mode)
+            if count == old_count:
                 continue
 
-            if mode == "total":
-                count = total_in_channels
-                user_list = user_id_list
-                channel_name = f"Сервер {guild.name} (все каналы)"
-            else:
-                # mode = max_channel
-                max_count = 0
-                max_channel_users = []
-                max_channel_name = ""
-                for vc in guild.voice_channels:
-                    members_list = [m for m in vc.members if not m.bot]
-                    c_len = len(members_list)
-                    if c_len > max_count:
-                        max_count = c_len
-                        max_channel_users = [m.name for m in members_list]
-                        max_channel_name = vc.name
-                count = max_count
-                user_list = max_channel_users
-                channel_name = f"Сервер {guild.name}, канал {max_channel_name}"
-
-            # Получаем старое значение из хранилища
-            old_count = self.storage.get_user_server_count(user_str, server_id)
-
-            # Проверяем переход через порог
-            if old_count < threshold and count >= threshold:
-                logging.debug(f"Threshold reached for user_id={user_str} on guild_id={guild.id}.")
-                if self.telegram_bot:
-                    self.telegram_bot.notify_user(user_str, channel_name, count, user_list)
-                self.notification_cooldowns[cooldown_key] = current_time + TRACKING_TIMEOUT_SEC
+            # Порог пересекли только те, у кого old_count < threshold <= count - это срез отсортированного индекса
+            notify = []
+            for user_str in index.crossed(server_id, mode, old_count, count):
+                cooldown_key = (user_str, server_id)
+                if self.notification_cooldowns.is_active(cooldown_key, current_time):
+                    # Еще действует таймаут, не уведомляем
+                    continue
+                user_settings = self.storage.get_user_settings(user_str) or {}
+                logger.debug("Threshold reached for user_id=%s on guild_id=%s.", user_str, guild.id)
+                notify.append(user_str)
+                # У пользователя может быть свой таймаут вместо общего TRACKING_TIMEOUT_SEC
+                cooldown_expiry = current_time + user_settings.get("cooldown_sec", TRACKING_TIMEOUT_SEC)
+                removed = self.notification_cooldowns.set(cooldown_key, cooldown_expiry, current_time)
+                await self.storage.aset_cooldown(user_str, server_id, cooldown_expiry)
+                if removed:
+                    await self.storage.aremove_cooldowns(removed)
+            if notify and self.telegram_bot:
+                # Одно событие на пересечение: имена участников собираются один раз для всех получателей
+                await self.telegram_bot.notify_users(notify, channel_name, count, get_user_list(), origin)
+                if not self.first_alert_reported:
+                    self.report_first_alert()
 
             # Обновляем сохраненное количество
-            self.storage.update_user_server_count(user_str, server_id, count)
+            await self.storage.aupdate_guild_count(server_id, mode, count)
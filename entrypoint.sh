@@ -1,23 +1,46 @@
 #!/usr/bin/env bash
-set -e
 
 BOT_CMD="python3 main.py"
+# Сколько ждать корректной остановки (дослать уведомления, сбросить хранилище, сохранить тёплый снимок)
+SHUTDOWN_TIMEOUT_SEC="${SHUTDOWN_TIMEOUT_SEC:-40}"
 
-# Запускаем бота в фоне и сохраняем его PID
-$BOT_CMD &
-BOT_PID=$!
-
-cleanup() {
-    echo "Получен SIGTERM, перезапускаем бота..."
-    # Принудительно убиваем старый процесс бота
-    kill -9 $BOT_PID || true
-    sleep 2
-    # Запускаем бота снова
+start_bot() {
     $BOT_CMD &
     BOT_PID=$!
 }
 
+stop_bot() {
+    # Сначала просим бота завершиться самому, kill -9 - только если он не уложился в таймаут
+    kill -TERM "$BOT_PID" 2>/dev/null || return 0
+    for _ in $(seq "$SHUTDOWN_TIMEOUT_SEC"); do
+        kill -0 "$BOT_PID" 2>/dev/null || break
+        sleep 1
+    done
+    if kill -0 "$BOT_PID" 2>/dev/null; then
+        echo "Бот не остановился за ${SHUTDOWN_TIMEOUT_SEC} с, завершаем принудительно"
+        kill -9 "$BOT_PID" || true
+    fi
+    wait "$BOT_PID" 2>/dev/null || true
+}
+
+cleanup() {
+    echo "Получен SIGTERM, останавливаем и перезапускаем бота..."
+    stop_bot
+    # Новый процесс поднимется с тёплого снимка, который старый записал при остановке
+    start_bot
+}
+
 trap 'cleanup' SIGTERM
 
-# Ожидаем завершения процессов
-wait
+# Запускаем бота в фоне и сохраняем его PID
+start_bot
+
+# wait прерывается при каждом сигнале, поэтому ждём в цикле, пока жив текущий процесс бота
+while true; do
+    wait "$BOT_PID"
+    status=$?
+    if kill -0 "$BOT_PID" 2>/dev/null; then
+        continue
+    fi
+    exit "$status"
+done
@@ -0,0 +1,94 @@
+import json
+import logging
+import math
+import os
+from aiohttp import web
+from dotenv import load_dotenv
+
+from metrics import render_prometheus
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "5000"))
+HEALTH_MAX_DISCORD_LATENCY_SEC = float(os.getenv("HEALTH_MAX_DISCORD_LATENCY_SEC", "10"))  # задержка heartbeat шлюза
+HEALTH_MAX_POLL_AGE_SEC = float(os.getenv("HEALTH_MAX_POLL_AGE_SEC", "90"))  # с последнего успешного getUpdates
+
+
+def discord_check(discord_bot):
+    def check():
+        # latency - время ответа на heartbeat шлюза; inf/nan, пока соединения нет
+        latency = discord_bot.client.latency
+        connected = latency is not None and math.isfinite(latency)
+        ok = discord_bot.initialized and connected and latency < HEALTH_MAX_DISCORD_LATENCY_SEC
+        return ok, {"ready": discord_bot.initialized, "latency_sec": latency if connected else None}
+    return check
+
+
+def telegram_check(telegram_bot):
+    def check():
+        if telegram_bot.webhook_mode:
+            # В режиме webhook опрашивать нечего: живы, если webhook зарегистрирован
+            return telegram_bot.webhook_ready, {"webhook": True, "queue_depth": telegram_bot.notifier.queue_depth}
+        age = telegram_bot.seconds_since_poll()
+        ok = age is not None and age < HEALTH_MAX_POLL_AGE_SEC
+        return ok, {"last_poll_age_sec": age, "queue_depth": telegram_bot.notifier.queue_depth}
+    return check
+
+
+def workers_check(supervisor):
+    def check():
+        alive = sum(1 for w in supervisor.workers if w["process"] is not None and w["process"].is_alive())
+        return alive == len(supervisor.workers), {"alive": alive, "total": len(supervisor.workers)}
+    return check
+
+
+class HttpServer:
+    # HTTP в том же цикле событий, что и боты: / для старых проверок, /healthz и /metrics
+    def __init__(self):
+        self.checks = {}
+        self.runner = None
+        self.app = web.Application()
+        self.app.router.add_get("/", self.handle_home)
+        self.app.router.add_get("/healthz", self.handle_healthz)
+        self.app.router.add_get("/metrics", self.handle_metrics)
+
+    def add_check(self, name, check):
+        # check() -> (ok, подробности для JSON)
+        self.checks[name] = check
+
+    async def start(self, host=HTTP_HOST, port=HTTP_PORT):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"HTTP server listening on {host}:{port}.")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_home(self, request):
+        return web.Response(text="Bot is running!")
+
+    async def handle_healthz(self, request):
+        healthy = True
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                ok, details = check()
+            except Exception as e:
+                logger.exception(f"Health check {name} failed.")
+                ok, details = False, {"error": str(e)}
+            healthy = healthy and ok
+            results[name] = {"ok": ok, **details}
+        body = {"status": "ok" if healthy else "fail", "checks": results}
+        return web.json_response(body, status=200 if healthy else 503, dumps=lambda o: json.dumps(o, ensure_ascii=False))
+
+    async def handle_metrics(self, request):
+        return web.Response(
+            body=render_prometheus().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
@@ -0,0 +1,429 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dotenv import load_dotenv
+
+from storage import Storage
+from metrics import NOTIFICATIONS_FAILED, WORKER_SNAPSHOTS, snapshot_metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+IPC_SOCKET_PATH = os.getenv("IPC_SOCKET_PATH", "/tmp/bot-albert.sock")
+IPC_QUEUE_SIZE = int(os.getenv("IPC_QUEUE_SIZE", "10000"))  # исходящие сообщения на одно соединение
+# Сколько шард ждёт места в очереди к хабу, прежде чем выбросить событие о пересечении порога
+IPC_PUBLISH_TIMEOUT_SEC = float(os.getenv("IPC_PUBLISH_TIMEOUT_SEC", "5"))
+# Как часто шард присылает хабу свои метрики для /metrics
+IPC_METRICS_INTERVAL_SEC = float(os.getenv("IPC_METRICS_INTERVAL_SEC", "15"))
+# Сколько хаб ждёт ответа шарда на запрос /stats
+IPC_REQUEST_TIMEOUT_SEC = float(os.getenv("IPC_REQUEST_TIMEOUT_SEC", "5"))
+IPC_SNAPSHOT_CHUNK = 500  # пользователей в одном сообщении начального снимка
+IPC_LINE_LIMIT = 16 * 1024 * 1024
+
+# Протокол: по unix-сокету ходят JSON-объекты, по одному на строку.
+#   шард -> хаб: {"t": "hello", "shards": [...], "shard_count": N, "worker": номер процесса}
+#                {"t": "cross", "u": [user_id, ...], "c": channel_name, "n": count, "l": [имена], "o": [guild_id, время]}
+#                - одно пересечение порога на всех сработавших подписчиков
+#                {"t": "guilds", "g": {guild_id: имя или null}} - кэш имён гильдий для Telegram; после
+#                подключения приходит целиком, дальше только изменения (null - бот ушёл с сервера)
+#                {"t": "gcount", "g": server_id, "m": mode, "c": count}
+#                {"t": "cooldown", "u": user_id, "g": server_id, "e": expiry} - "e": null, если таймаут удалён
+#                {"t": "metrics", "w": номер процесса, "m": {имя метрики: ряды}} - снимок metrics.snapshot_metrics()
+#                {"t": "state", "guild_counts": {server_id: {mode: count}}, "cooldowns": [[user_id, server_id, expiry]]}
+#                - после переподключения: счётчики и таймауты ведёт шард, хаб заменяет ими свою копию
+#                {"t": "history", "id": номер запроса, "s": OccupancyHistory.summary() или null} - ответ для /stats
+#   хаб -> шард: {"t": "snapshot", "users": {...}, "last": bool} - начальная копия настроек, частями;
+#                в последней части ещё "cooldowns": [[user_id, server_id, expiry], ...]
+#                и "guild_counts": {server_id: {mode: count}} для гильдий этого шарда
+#                {"t": "set", "u": user_id, "s": settings} - изменение настроек пользователя
+#                {"t": "history", "id": номер запроса, "g": server_id} - запрос истории заполненности для /stats
+
+
+def encode(message):
+    return (json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def shard_for_guild(guild_id, shard_count):
+    # Та же формула, по которой Discord распределяет гильдии по шардам
+    return (int(guild_id) >> 22) % shard_count
+
+
+class Connection:
+    # Соединение с очередью исходящих сообщений. Очередь ограничена: если другая сторона
+    # не успевает читать, соединение рвётся, а шард переподключится и получит свежий снимок.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.outgoing = asyncio.Queue(maxsize=IPC_QUEUE_SIZE)
+        self.sender_task = asyncio.create_task(self.sender())
+
+    def send(self, message):
+        try:
+            self.outgoing.put_nowait(encode(message))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def put(self, message, timeout):
+        # Для событий, которые нельзя просто выбросить: ждём, пока другая сторона разберёт очередь.
+        # Когда хаб не успевает, сокет и очередь заполняются, и шард сам замедляется на этом await
+        try:
+            await asyncio.wait_for(self.outgoing.put(encode(message)), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def sender(self):
+        try:
+            while True:
+                data = await self.outgoing.get()
+                self.writer.write(data)
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def messages(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            yield json.loads(line)
+
+    async def close(self):
+        self.sender_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class IpcHub:
+    # Живёт в процессе с Telegram-ботом и основным хранилищем. Шарды Discord получают
+    # отсюда копию настроек пользователей, а обратно присылают уведомления и счётчики.
+    def __init__(self, storage, telegram_bot):
+        self.storage = storage
+        self.telegram_bot = telegram_bot
+        self.connections = set()
+        self.shards = {}  # соединение -> (shard_ids, shard_count), для запросов к шарду нужной гильдии
+        self.requests = {}  # номер запроса -> Future с ответом шарда
+        self.next_request_id = 0
+        self.server = None
+        storage.add_listener(self.on_storage_change)
+
+    async def start(self):
+        if os.path.exists(IPC_SOCKET_PATH):
+            os.unlink(IPC_SOCKET_PATH)
+        self.server = await asyncio.start_unix_server(self.handle_client, IPC_SOCKET_PATH, limit=IPC_LINE_LIMIT)
+        logger.info(f"IPC hub listening on {IPC_SOCKET_PATH}.")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for conn in list(self.connections):
+            await conn.close()
+        self.connections.clear()
+
+    def on_storage_change(self, change):
+        # Счётчики приходят из самих шардов, обратно рассылаем только изменения настроек
+        if change[0] != "settings":
+            return
+        user_str = change[1]
+        message = {"t": "set", "u": user_str, "s": self.storage.get_user_settings(user_str)}
+        for conn in list(self.connections):
+            if not conn.send(message):
+                logger.warning("IPC client is not keeping up, dropping connection.")
+                self.connections.discard(conn)
+                asyncio.create_task(conn.close())
+
+    def send_snapshot(self, conn, shard_ids, shard_count):
+        # False - снимок не поместился в очередь соединения, и шард остался бы с частью подписчиков
+        users = {}
+        for user_str, settings in self.storage.data["users"].items():
+            servers = settings.get("servers", [])
+            if shard_ids is not None and not any(shard_for_guild(s, shard_count) in shard_ids for s in servers):
+                continue
+            users[user_str] = settings
+            if len(users) >= IPC_SNAPSHOT_CHUNK:
+                if not conn.send({"t": "snapshot", "users": users, "last": False}):
+                    return False
+                users = {}
+        cooldowns = [
+            [user_str, server_id, expiry] for user_str, server_id, expiry in self.storage.get_cooldowns()
+            if shard_ids is None or shard_for_guild(server_id, shard_count) in shard_ids
+        ]
+        guild_counts = {
+            server_str: counts for server_str, counts in self.storage.data["guild_counts"].items()
+            if shard_ids is None or shard_for_guild(server_str, shard_count) in shard_ids
+        }
+        return conn.send(
+            {"t": "snapshot", "users": users, "last": True, "cooldowns": cooldowns, "guild_counts": guild_counts}
+        )
+
+    async def apply_shard_state(self, guild_counts, cooldowns, shard_ids, shard_count):
+        # Пока шард был отключён, его изменения до хаба не доходили, так что верна его копия, а не наша
+        def own(server_id):
+            return shard_ids is None or shard_for_guild(server_id, shard_count) in shard_ids
+        with self.storage.defer_writes():
+            for server_str, counts in guild_counts.items():
+                for mode, count in counts.items():
+                    if self.storage.get_guild_count(server_str, mode) != count:
+                        self.storage.update_guild_count(server_str, mode, count)
+            current = {(user_str, server_id): expiry for user_str, server_id, expiry in self.storage.get_cooldowns()
+                       if own(server_id)}
+            for user_str, server_id, expiry in cooldowns:
+                if current.pop((user_str, int(server_id)), None) != expiry:
+                    self.storage.set_cooldown(user_str, server_id, expiry)
+            # Оставшиеся шард уже выбросил
+            self.storage.remove_cooldowns(list(current))
+        await self.storage.commit()
+        logger.info(f"Applied shard state: {len(guild_counts)} guild counts, {len(cooldowns)} cooldowns.")
+
+    async def history_summary(self, server_id):
+        # История заполненности копится в шарде, который обслуживает гильдию, - спрашиваем его
+        for conn, (shard_ids, shard_count) in list(self.shards.items()):
+            if shard_ids is None or shard_for_guild(server_id, shard_count) in shard_ids:
+                break
+        else:
+            logger.warning(f"No Discord worker connected for guild {server_id}, stats unavailable.")
+            return None
+        self.next_request_id += 1
+        request_id = self.next_request_id
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request_id] = future
+        try:
+            if not conn.send({"t": "history", "id": request_id, "g": server_id}):
+                return None
+            return await asyncio.wait_for(future, IPC_REQUEST_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logger.warning(f"Discord worker did not answer stats request for guild {server_id}.")
+            return None
+        finally:
+            self.requests.pop(request_id, None)
+
+    async def handle_client(self, reader, writer):
+        conn = Connection(reader, writer)
+        shard_ids = None
+        shard_count = 1
+        try:
+            async for message in conn.messages():
+                kind = message.get("t")
+                if kind == "hello":
+                    shard_ids = message.get("shards")
+                    logger.info(f"Discord worker connected, shards={shard_ids}.")
+                    shard_ids = set(shard_ids) if shard_ids is not None else None
+                    # Снимок и подписка на изменения - в одном синхронном шаге, чтобы ничего не потерять
+                    shard_count = message.get("shard_count") or 1
+                    if not self.send_snapshot(conn, shard_ids, shard_count):
+                        # Снимок отправляется целиком синхронно, так что обрыв повторится: нужен больший IPC_QUEUE_SIZE
+                        logger.error(
+                            f"Settings snapshot does not fit into IPC_QUEUE_SIZE={IPC_QUEUE_SIZE}, dropping connection."
+                        )
+                        break
+                    self.connections.add(conn)
+                    self.shards[conn] = (shard_ids, shard_count)
+                elif kind == "history":
+                    future = self.requests.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message["s"])
+                elif kind == "cross":
+                    # Время события - time.monotonic() шарда, на Linux часы общие для всех процессов.
+                    # При полной очереди уведомлений notify_users ждёт, и сокет этого шарда не читается,
+                    # пока место не освободится: шард упирается в Connection.put, а не теряет события
+                    origin = message.get("o")
+                    await self.telegram_bot.notify_users(
+                        message["u"], message["c"], message["n"], message["l"], tuple(origin) if origin else None
+                    )
+                elif kind == "guilds":
+                    self.telegram_bot.update_guilds(message["g"])
+                elif kind == "metrics":
+                    # Счётчики шарда после его перезапуска начинаются с нуля, Prometheus такой сброс понимает
+                    WORKER_SNAPSHOTS[str(message["w"])] = message["m"]
+                elif kind == "state":
+                    await self.apply_shard_state(message["guild_counts"], message["cooldowns"], shard_ids, shard_count)
+                elif kind == "gcount":
+                    await self.storage.aupdate_guild_count(message["g"], message["m"], message["c"])
+                elif kind == "cooldown":
+                    if message["e"] is None:
+                        await self.storage.aremove_cooldowns([(message["u"], message["g"])])
+                    else:
+                        await self.storage.aset_cooldown(message["u"], message["g"], message["e"])
+                else:
+                    logger.warning(f"Unknown IPC message type {kind!r}.")
+        except (ConnectionError, ValueError):
+            logger.exception("IPC client connection failed.")
+        finally:
+            self.connections.discard(conn)
+            self.shards.pop(conn, None)
+            await conn.close()
+            logger.info("Discord worker disconnected.")
+
+
+class ReplicaStorage(Storage):
+    # Копия настроек в процессе-шарде: читается как обычный Storage,
+    # а изменения счётчиков уходят в хаб, который пишет их в настоящее хранилище.
+    def __init__(self):
+        self.client = None
+        self.incoming = None  # снимок, который ещё приходит частями
+        self.synced = False  # первый снимок уже получен
+        super().__init__()
+
+    def open(self):
+        logger.debug("Replica storage waits for snapshot from IPC hub.")
+
+    def load_snapshot_part(self, users, first, cooldowns=None, guild_counts=None, last=True):
+        # Части копятся отдельно и подменяют данные целиком с последней: индекс строится один раз на снимок,
+        # а проверки порогов до этого момента работают со старой, но полной копией
+        if first or self.incoming is None:
+            self.incoming = {"users": {}, "cooldowns": {}, "guild_counts": {}}
+        self.incoming["users"].update(users)
+        self.incoming["guild_counts"].update(guild_counts or {})
+        for user_str, server_id, expiry in cooldowns or ():
+            self.incoming["cooldowns"][f"{user_str}:{server_id}"] = expiry
+        if not last:
+            return
+        if self.synced:
+            # После переподключения счётчики и таймауты не берём у хаба: изменения, отправленные, пока связи
+            # не было, до него не дошли. Свою копию шард сам отправит хабу (HubClient.push_state)
+            self.incoming["guild_counts"] = self.data["guild_counts"]
+            self.incoming["cooldowns"] = self.data["cooldowns"]
+        self.data, self.incoming = self.incoming, None
+        self.synced = True
+        self.rebuild_server_index()
+
+    def apply_remote_settings(self, user_str, settings):
+        if settings is None:
+            self.data["users"].pop(user_str, None)
+        else:
+            self.data["users"][user_str] = settings
+        self._reindex_user(user_str, settings)
+
+    def record_change(self, change):
+        if self.client is None:
+            return
+        if change[0] == "guild_count":
+            _, server_str, mode, count = change
+            self.client.send({"t": "gcount", "g": server_str, "m": mode, "c": count})
+        elif change[0] == "cooldown":
+            _, user_str, server_str, expiry = change
+            self.client.send({"t": "cooldown", "u": user_str, "g": server_str, "e": expiry})
+
+    def start_flusher(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class HubClient:
+    # Сторона шарда. Для DiscordBot выглядит как telegram_bot: у неё есть notify_users и update_guilds.
+    def __init__(self, storage, shard_ids, shard_count, worker=0):
+        self.storage = storage
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.worker = worker
+        self.conn = None
+        self.guild_names = {}  # имена гильдий этого шарда, отправляются хабу целиком при каждом подключении
+        self.history = None  # OccupancyHistory шарда, для ответов на /stats
+        self.ready = asyncio.Event()
+        storage.client = self
+
+    def send(self, message):
+        if self.conn is None:
+            # После переподключения хаб получит всё состояние целиком (push_state)
+            logger.debug("IPC hub unavailable, dropping %s message.", message.get("t"))
+            return
+        if not self.conn.send(message):
+            # Очередь к хабу переполнена: рвём соединение, как это делает хаб, и после переподключения
+            # отправляем состояние целиком вместо того, чтобы молча терять изменения
+            logger.warning("IPC hub is not keeping up, dropping %s message and reconnecting.", message.get("t"))
+            asyncio.create_task(self.conn.close())
+            self.conn = None
+
+    def push_state(self):
+        cooldowns = []
+        for key, expiry in self.storage.data["cooldowns"].items():
+            user_str, server_str = key.rsplit(":", 1)
+            cooldowns.append([user_str, int(server_str), expiry])
+        self.send({"t": "state", "guild_counts": self.storage.data["guild_counts"], "cooldowns": cooldowns})
+
+    async def notify_users(self, user_ids, channel_name, user_count, user_list, origin=None):
+        message = {"t": "cross", "u": user_ids, "c": channel_name, "n": user_count, "l": user_list, "o": origin}
+        if self.conn is None or not await self.conn.put(message, IPC_PUBLISH_TIMEOUT_SEC):
+            logger.warning("IPC hub unavailable, dropping threshold crossing for %d users.", len(user_ids))
+            NOTIFICATIONS_FAILED.inc(len(user_ids), labels=("ipc",))
+            return False
+        return True
+
+    def update_guilds(self, names):
+        for guild_id, name in names.items():
+            if name is None:
+                self.guild_names.pop(guild_id, None)
+            else:
+                self.guild_names[guild_id] = name
+        if self.conn is not None:
+            self.send({"t": "guilds", "g": names})
+
+    async def publish_metrics(self):
+        # Голосовые события считаются в процессе-шарде, а /metrics отдаёт хаб: шлём ему снимок раз в интервал
+        while True:
+            await asyncio.sleep(IPC_METRICS_INTERVAL_SEC)
+            self.push_metrics()
+
+    def push_metrics(self):
+        if self.conn is not None:
+            self.send({"t": "metrics", "w": self.worker, "m": snapshot_metrics()})
+
+    async def drain(self, timeout):
+        # Ждём, пока очередь к хабу опустеет, но не дольше timeout
+        deadline = time.monotonic() + timeout
+        while self.conn is not None and not self.conn.outgoing.empty() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def run(self):
+        delay = 1
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(IPC_SOCKET_PATH, limit=IPC_LINE_LIMIT)
+            except OSError as e:
+                logger.warning(f"Cannot connect to IPC hub: {e}, retrying in {delay}s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1
+            conn = Connection(reader, writer)
+            self.conn = conn
+            conn.send({"t": "hello", "shards": self.shard_ids, "shard_count": self.shard_count, "worker": self.worker})
+            if self.guild_names:
+                conn.send({"t": "guilds", "g": self.guild_names})
+            first = True
+            try:
+                async for message in conn.messages():
+                    kind = message.get("t")
+                    if kind == "snapshot":
+                        self.storage.load_snapshot_part(
+                            message["users"], first, message.get("cooldowns"), message.get("guild_counts"),
+                            bool(message.get("last"))
+                        )
+                        first = False
+                        if message.get("last"):
+                            logger.info(f"Received settings snapshot for {len(self.storage.data['users'])} users.")
+                            if self.ready.is_set():
+                                self.push_state()
+                            self.ready.set()
+                    elif kind == "set":
+                        self.storage.apply_remote_settings(message["u"], message["s"])
+                    elif kind == "history":
+                        summary = self.history.summary(message["g"]) if self.history is not None else None
+                        self.send({"t": "history", "id": message["id"], "s": summary})
+            except (ConnectionError, ValueError):
+                logger.exception("IPC hub connection failed.")
+            finally:
+                self.conn = None
+                await conn.close()
+            logger.warning("Disconnected from IPC hub, reconnecting.")
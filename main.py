@@ -1,10 +1,12 @@
 import asyncio
 import logging
+import multiprocessing
 import os
+import signal
+import time
 from dotenv import load_dotenv
-from logging.handlers import RotatingFileHandler
-from flask import Flask
-from threading import Thread
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 load_dotenv()  # загрузка переменных окружения из .env
 
@@ -13,33 +15,293 @@ LOGGING_TARGET = os.getenv("LOGGING_TARGET", "stdout")  # "file", "stdout", "bot
 LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", "1048576"))  # 1 MB
 LOG_FILE_PATH = os.getenv("LOG_FILE_PATH", "bot.log")  # Если нужно переопределить имя файла
 LOG_FILE_BACKUP_COUNT = 1
+# Уровни отдельных модулей поверх общего: "storage=INFO,voice_tracker=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# Из каждой DEBUG-строки пишется только каждая N-я. 1 - писать все
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", "1"))
+# Шардирование Discord: DISCORD_WORKERS процессов, каждый со своей частью шардов.
+# 0 - Discord работает в одном процессе с Telegram, как раньше. 1 - Discord в отдельном процессе без шардирования:
+# шлюз и голосовые события не делят ядро с командами Telegram и записью хранилища
+DISCORD_WORKERS = int(os.getenv("DISCORD_WORKERS", "0"))
+DISCORD_SHARD_COUNT = int(os.getenv("DISCORD_SHARD_COUNT", "0")) or DISCORD_WORKERS
+WORKER_CHECK_INTERVAL_SEC = 5
+WORKER_RESTART_MAX_DELAY_SEC = 60
+# Сколько ждать, пока процессы-шарды досчитают и дошлют последние события после SIGTERM
+WORKER_STOP_TIMEOUT_SEC = int(os.getenv("WORKER_STOP_TIMEOUT_SEC", "15"))
+WORKER_DRAIN_TIMEOUT_SEC = 5
 
 from telegram_bot import TelegramBot
 from discord_bot import DiscordBot
-from storage import Storage
+from storage import create_storage
+from metrics import LoopLagMonitor
+from ipc import IpcHub, HubClient, ReplicaStorage
+from http_server import HttpServer, discord_check, telegram_check, workers_check
 
-app = Flask(__name__)
+log_listener = None
 
 
-@app.route("/")
-def home():
-    return "Bot is running!"
+def install_stop_signals(stop):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+
+async def run_until_stopped(stop, *coros):
+    # Работает, пока не придёт SIGTERM/SIGINT или пока не завершится одна из задач (например, с ошибкой)
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    stop_task = asyncio.create_task(stop.wait())
+    await asyncio.wait([stop_task, *tasks], return_when=asyncio.FIRST_COMPLETED)
+    stop_task.cancel()
+    if stop.is_set():
+        logging.info("Received stop signal, shutting down.")
+    return tasks
+
+
+async def finish_tasks(tasks):
+    # Отменяет то, что ещё работает, и пробрасывает ошибку задачи, из-за которой остановились
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            raise result
 
 
 async def main_async():
-    storage = Storage()
+    storage = create_storage()
     telegram_bot = TelegramBot(storage)
     discord_bot = DiscordBot(storage)
     telegram_bot.set_discord_bot(discord_bot)
     discord_bot.set_telegram_bot(telegram_bot)
+    storage.start_flusher()
+    loop_lag_task = asyncio.create_task(LoopLagMonitor().run())
+    http_server = HttpServer()
+    http_server.add_check("discord", discord_check(discord_bot))
+    http_server.add_check("telegram", telegram_check(telegram_bot))
+    if telegram_bot.webhook_mode:
+        telegram_bot.setup_webhook(http_server.app)
+    await http_server.start()
+    stop = asyncio.Event()
+    install_stop_signals(stop)
 
-    await asyncio.gather(
-        telegram_bot.start_async(),
-        discord_bot.start_async()
-    )
+    tasks = []
+    try:
+        tasks = await run_until_stopped(stop, telegram_bot.start_async(), discord_bot.start_async())
+    finally:
+        # Порядок важен: сначала перестаём принимать команды и события, потом досылаем уведомления
+        # (не дольше NOTIFY_DRAIN_TIMEOUT_SEC) и только после этого сбрасываем хранилище на диск
+        started = time.monotonic()
+        await telegram_bot.stop_intake()
+        await http_server.stop()
+        await discord_bot.shutdown()
+        await telegram_bot.stop_async()
+        # Финальный сброс отложенных изменений на диск
+        await storage.close()
+        loop_lag_task.cancel()
+        logging.info(f"Shutdown finished in {time.monotonic() - started:.1f}s.")
+    await finish_tasks(tasks)
 
 
-def main():
+def run_discord_worker(index, shard_ids, shard_count):
+    # Точка входа процесса-шарда (запускается через multiprocessing spawn)
+    setup_logging(f".worker{index}")
+    logging.info(f"Discord worker {index} starting with shards {shard_ids}/{shard_count}.")
+    try:
+        asyncio.run(discord_worker_async(index, shard_ids, shard_count))
+    finally:
+        stop_logging()
+
+
+async def discord_worker_async(index, shard_ids, shard_count):
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+    storage = ReplicaStorage()
+    hub_client = HubClient(storage, shard_ids, shard_count, index)
+    hub_task = asyncio.create_task(hub_client.run())
+    # Без копии настроек проверять пороги не для кого
+    await finish_tasks(await run_until_stopped(stop, hub_client.ready.wait()))
+    if stop.is_set():
+        hub_task.cancel()
+        return
+    discord_bot = DiscordBot(storage, shard_ids=shard_ids, shard_count=shard_count)
+    discord_bot.set_telegram_bot(hub_client)
+    hub_client.history = discord_bot.history
+    # Голосовые события обрабатываются здесь, поэтому задержка цикла и сводка по этапам
+    # горячего пути (PROFILE_HOT_PATH) пишутся в лог процесса-шарда
+    loop_lag_task = asyncio.create_task(LoopLagMonitor().run())
+    # Метрики шарда попадают в /metrics хаба с меткой worker
+    metrics_task = asyncio.create_task(hub_client.publish_metrics())
+    tasks = []
+    try:
+        tasks = await run_until_stopped(stop, discord_bot.start_async())
+    finally:
+        await discord_bot.shutdown()
+        hub_client.push_metrics()
+        # Последние события о пересечении порогов должны уйти в хаб до выхода процесса
+        await hub_client.drain(WORKER_DRAIN_TIMEOUT_SEC)
+        hub_task.cancel()
+        loop_lag_task.cancel()
+        metrics_task.cancel()
+    await finish_tasks(tasks)
+
+
+class WorkerSupervisor:
+    # Запускает процессы-шарды и перезапускает упавшие с экспоненциальной задержкой
+    def __init__(self, workers, shard_count):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.shard_count = shard_count
+        self.workers = []
+        for index in range(workers):
+            shard_ids = [s for s in range(shard_count) if s % workers == index]
+            self.workers.append({
+                "index": index, "shard_ids": shard_ids, "process": None,
+                "restarts": 0, "started": 0.0, "restart_at": 0.0
+            })
+
+    def spawn(self, worker):
+        process = self.ctx.Process(
+            target=run_discord_worker,
+            args=(worker["index"], worker["shard_ids"], self.shard_count),
+            name=f"discord-worker-{worker['index']}",
+            daemon=True
+        )
+        process.start()
+        worker["process"] = process
+        worker["started"] = time.monotonic()
+        logging.info(f"Started Discord worker {worker['index']} (pid={process.pid}, shards={worker['shard_ids']}).")
+
+    async def run(self):
+        for worker in self.workers:
+            self.spawn(worker)
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL_SEC)
+            now = time.monotonic()
+            for worker in self.workers:
+                process = worker["process"]
+                if process is not None and process.is_alive():
+                    # Проработал дольше максимальной задержки - считаем, что серия падений закончилась
+                    if now - worker["started"] > WORKER_RESTART_MAX_DELAY_SEC:
+                        worker["restarts"] = 0
+                    continue
+                if process is not None:
+                    logging.error(f"Discord worker {worker['index']} exited with code {process.exitcode}.")
+                    worker["process"] = None
+                    delay = min(WORKER_RESTART_MAX_DELAY_SEC, 2 ** worker["restarts"])
+                    worker["restarts"] += 1
+                    worker["restart_at"] = now + delay
+                if now >= worker["restart_at"]:
+                    self.spawn(worker)
+
+    async def stop(self, timeout=WORKER_STOP_TIMEOUT_SEC):
+        # SIGTERM и ожидание без блокировки цикла: хаб в это время принимает последние события от шардов
+        processes = [w["process"] for w in self.workers if w["process"] is not None and w["process"].is_alive()]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        while any(p.is_alive() for p in processes) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for process in processes:
+            if process.is_alive():
+                logging.warning(f"Discord worker pid={process.pid} did not stop in {timeout}s, killing it.")
+                process.kill()
+            process.join(timeout=1)
+
+
+async def main_sharded_async():
+    # Этот процесс держит Telegram и хранилище, Discord работает в DISCORD_WORKERS дочерних процессах
+    storage = create_storage()
+    telegram_bot = TelegramBot(storage)
+    hub = IpcHub(storage, telegram_bot)
+    telegram_bot.set_history_source(hub)
+    await hub.start()
+    storage.start_flusher()
+    loop_lag_task = asyncio.create_task(LoopLagMonitor().run())
+    supervisor = WorkerSupervisor(DISCORD_WORKERS, DISCORD_SHARD_COUNT)
+    supervisor_task = asyncio.create_task(supervisor.run())
+    http_server = HttpServer()
+    http_server.add_check("telegram", telegram_check(telegram_bot))
+    http_server.add_check("discord_workers", workers_check(supervisor))
+    if telegram_bot.webhook_mode:
+        telegram_bot.setup_webhook(http_server.app)
+    await http_server.start()
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    tasks = []
+    try:
+        tasks = await run_until_stopped(stop, telegram_bot.start_async())
+    finally:
+        started = time.monotonic()
+        await telegram_bot.stop_intake()
+        supervisor_task.cancel()
+        await supervisor.stop()
+        await http_server.stop()
+        await hub.stop()
+        await telegram_bot.stop_async()
+        await storage.close()
+        loop_lag_task.cancel()
+        logging.info(f"Shutdown finished in {time.monotonic() - started:.1f}s.")
+    await finish_tasks(tasks)
+
+
+class DebugSampler(logging.Filter):
+    # Из частых DEBUG-строк пропускает только каждую N-ю, счёт отдельный для каждого места в коде
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.lineno)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        return count % self.every == 0
+
+
+# Аргументы этих типов не меняются, пока запись ждёт в очереди, их можно форматировать позже
+LAZY_LOG_ARG_TYPES = {str, int, float, bool, bytes, type(None)}
+
+
+class LazyQueueHandler(QueueHandler):
+    # Стандартный QueueHandler форматирует сообщение ещё в вызывающем потоке. Очередь у нас
+    # внутри процесса, поэтому запись передаётся как есть и форматируется в потоке QueueListener.
+    # Исключение и изменяемые аргументы всё же форматируются сразу: traceback держит кадры с живыми
+    # объектами, а объект в args к моменту записи в файл мог уже измениться
+    exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        # Один словарь в args logging передаёт как есть, а не кортежем - он тоже изменяемый
+        if record.args and (isinstance(record.args, dict)
+                            or any(type(arg) not in LAZY_LOG_ARG_TYPES for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def parse_log_levels(spec):
+    # "storage=INFO,voice_tracker=WARNING" -> {"storage": 20, "voice_tracker": 30}
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.strip().partition("=")
+        if not (name and level):
+            continue
+        level = level.strip()
+        # Для неизвестного имени getLevelName возвращает строку "Level X", и setLevel упал бы при старте
+        value = int(level) if level.isdigit() else logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            logging.warning(f"Unknown log level {level!r} for {name.strip()!r} in LOG_LEVELS, ignoring it.")
+            continue
+        levels[name.strip()] = value
+    return levels
+
+
+def setup_logging(file_suffix=""):
+    global log_listener
     if ENABLE_LOGGING:
         log_level = logging.DEBUG
     else:
@@ -51,40 +313,67 @@ def main():
     # Удаляем все существующие хэндлеры
     while logger.handlers:
         logger.handlers.pop()
+    if log_listener is not None:
+        log_listener.stop()
 
     # Настраиваем хэндлеры в зависимости от LOGGING_TARGET
+    handlers = []
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s')
     if LOGGING_TARGET in ("stdout", "both"):
         console_handler = logging.StreamHandler()
         console_handler.setLevel(log_level)
-        console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-        logger.addHandler(console_handler)
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
 
     if LOGGING_TARGET in ("file", "both"):
+        # У каждого процесса свой файл, иначе ротация из нескольких процессов ломается
         file_handler = RotatingFileHandler(
-            LOG_FILE_PATH,
+            LOG_FILE_PATH + file_suffix,
             maxBytes=LOG_FILE_MAX_BYTES,
             backupCount=LOG_FILE_BACKUP_COUNT,
             encoding='utf-8'
         )
         file_handler.setLevel(log_level)
-        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-        logger.addHandler(file_handler)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+
+    # В цикле событий запись лога только кладётся в очередь, а вывод в stdout/файл
+    # делает фоновый поток QueueListener
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    if LOG_DEBUG_SAMPLE_EVERY > 1:
+        queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_EVERY))
+    logger.addHandler(queue_handler)
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
 
     # Подавляем предупреждения от discord
-    logging.getLogger('discord').setLevel(logging.ERROR)
+    levels = {"discord": logging.ERROR}
+    levels.update(parse_log_levels(LOG_LEVELS))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
 
-    logging.debug("Starting main.")
 
-    # Запускаем Flask в отдельном потоке
-    def run_flask():
-        port = int(os.environ.get("PORT", 5000))
-        app.run(host="0.0.0.0", port=port, use_reloader=False)
+def stop_logging():
+    # Дописывает всё, что осталось в очереди
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
 
-    flask_thread = Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+def main():
+    setup_logging()
+    logging.debug("Starting main.")
 
-    # Запускаем основной asyncio-цикл в главном потоке
-    asyncio.run(main_async())
+    # HTTP-сервер (/, /healthz, /metrics) работает внутри этого же цикла событий
+    try:
+        if DISCORD_WORKERS > 0:
+            asyncio.run(main_sharded_async())
+        else:
+            asyncio.run(main_async())
+    finally:
+        stop_logging()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,337 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import logging
+import math
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL_MS = int(os.getenv("LOOP_LAG_INTERVAL_MS", "500"))  # как часто мерить задержку цикла
+LOOP_LAG_WARN_MS = int(os.getenv("LOOP_LAG_WARN_MS", "100"))  # выше этого пишем предупреждение
+LOOP_LAG_REPORT_SEC = int(os.getenv("LOOP_LAG_REPORT_SEC", "60"))  # период сводки в лог
+# Замеры времени по этапам обработки голосовых событий. Выключено - декораторы ничего не оборачивают
+PROFILE_HOT_PATH = os.getenv("PROFILE_HOT_PATH", "false").lower() == "true"
+
+
+# Минимальная реализация метрик в текстовом формате Prometheus, без внешних зависимостей
+REGISTRY = []
+# Последние снимки метрик процессов-шардов: worker -> {имя метрики: ряды}. Заполняет IpcHub,
+# в /metrics хаба они выводятся рядом со своими значениями с дополнительной меткой worker
+WORKER_SNAPSHOTS = {}
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005) + DEFAULT_BUCKETS
+E2E_BUCKETS = DEFAULT_BUCKETS + (30.0, 60.0, 120.0)
+
+
+def format_labels(labelnames, labelvalues, extra=""):
+    parts = [f'{name}="{str(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def bucket_quantile(bounds, counts, q):
+    # Оценка квантиля по корзинам гистограммы с линейной интерполяцией внутри корзины
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            upper = bounds[i]
+            lower = bounds[i - 1] if i else 0.0
+            if upper == math.inf:
+                return lower
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+    return bounds[-2]
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples(self.snapshot(), self.labelnames))
+        for worker, snapshot in WORKER_SNAPSHOTS.items():
+            series = snapshot.get(self.name)
+            if series:
+                lines.extend(self.samples(
+                    [[(*labels, worker), *values] for labels, *values in series], self.labelnames + ("worker",)
+                ))
+        return lines
+
+    def snapshot(self):
+        # [[значения меток, данные...], ...] - то же, что выводит samples, в виде, пригодном для JSON
+        return []
+
+    def samples(self, series, labelnames):
+        return []
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def snapshot(self):
+        return [[labels, value] for labels, value in self.values.items()]
+
+    def samples(self, series, labelnames):
+        return [f"{self.name}{format_labels(labelnames, labels)} {format_value(value)}" for labels, value in series]
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.function = None
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def set_function(self, function):
+        # Значение считается в момент запроса /metrics
+        self.function = function
+
+    def snapshot(self):
+        if self.function is not None:
+            return [[(), self.function()]]
+        return [[labels, value] for labels, value in self.values.items()]
+
+    def samples(self, series, labelnames):
+        return [f"{self.name}{format_labels(labelnames, labels)} {format_value(value)}" for labels, value in series]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.series = {}  # labels -> [counts по корзинам, sum, count]
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, q, labels=()):
+        series = self.series.get(labels)
+        return bucket_quantile(self.buckets, series[0], q) if series else 0.0
+
+    def snapshot(self):
+        return [[labels, counts, total, count] for labels, (counts, total, count) in self.series.items()]
+
+    def samples(self, series, labelnames):
+        lines = []
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = format_labels(labelnames, labels, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labelnames, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(labelnames, labels)} {count}")
+        return lines
+
+
+def rss_bytes():
+    # Текущий RSS процесса; без /proc (не Linux) - пиковый из getrusage
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render_prometheus():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_metrics():
+    # Значения всех метрик процесса для отправки в хаб: {имя: ряды}, пустые ряды не передаются
+    snapshot = {}
+    for metric in REGISTRY:
+        series = metric.snapshot()
+        if series:
+            snapshot[metric.name] = series
+    return snapshot
+
+
+VOICE_EVENTS = Counter("bot_voice_events_total", "Voice state updates handled.")
+THRESHOLD_EVALUATIONS = Counter("bot_threshold_evaluations_total", "Threshold passes run over a guild.")
+VOICE_EVALUATIONS_COALESCED = Counter(
+    "bot_voice_evaluations_coalesced_total", "Voice events merged into an already scheduled threshold pass."
+)
+NOTIFICATIONS_SENT = Counter("bot_notifications_sent_total", "Telegram alerts delivered.")
+NOTIFICATIONS_FAILED = Counter("bot_notifications_failed_total", "Telegram alerts that failed or were dropped.", ("reason",))
+NOTIFICATION_LATENCY = Histogram("bot_notification_latency_seconds", "Time from queueing an alert to delivering it.")
+NOTIFICATION_QUEUE_DEPTH = Gauge("bot_notification_queue_depth", "Alerts waiting in the dispatcher queue.")
+STORAGE_FLUSH_DURATION = Histogram("bot_storage_flush_seconds", "Duration of storage flushes to disk.")
+EVENT_LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Event loop scheduling lag.")
+PROCESS_RSS = Gauge("bot_process_rss_bytes", "Resident memory of this process.")
+PROCESS_RSS.set_function(rss_bytes)
+DISCORD_READY_SECONDS = Gauge("bot_discord_ready_seconds", "Time from Discord client start to the last on_ready.")
+FIRST_ALERT_SECONDS = Gauge(
+    "bot_first_alert_seconds", "Time from Discord client start to the first threshold alert.", ("start",)
+)
+STAGE_DURATION = Histogram(
+    "bot_stage_seconds", "Time spent in hot-path stages (PROFILE_HOT_PATH).", ("stage",), buckets=STAGE_BUCKETS
+)
+EVENT_TO_SEND = Histogram(
+    "bot_event_to_send_seconds", "From the first voice event of a batch to the Telegram alert being sent.",
+    buckets=E2E_BUCKETS
+)
+
+
+def timed(stage):
+    # Декоратор для этапов горячего пути. При PROFILE_HOT_PATH=false возвращает функцию как есть,
+    # так что в обычном режиме замеры ничего не стоят
+    def decorator(func):
+        if not PROFILE_HOT_PATH:
+            return func
+        labels = (stage,)
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    STAGE_DURATION.observe(time.perf_counter() - started, labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                STAGE_DURATION.observe(time.perf_counter() - started, labels)
+        return wrapper
+    return decorator
+
+
+class GuildLatencyTracker:
+    # Задержка событие -> отправка по каждой гильдии. В /metrics не попадает (слишком много рядов),
+    # доступна через команду администратора в Telegram
+    def __init__(self, buckets=E2E_BUCKETS):
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.guilds = {}  # guild_id -> [counts по корзинам, max]
+
+    def record(self, guild_id, latency):
+        EVENT_TO_SEND.observe(latency)
+        entry = self.guilds.get(guild_id)
+        if entry is None:
+            entry = self.guilds[guild_id] = [[0] * len(self.buckets), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, latency)] += 1
+        entry[1] = max(entry[1], latency)
+
+    def slowest(self, n):
+        # [(guild_id, count, p50, p99, max)], самые медленные по p99
+        rows = [
+            (guild_id, sum(counts), min(bucket_quantile(self.buckets, counts, 0.5), max_latency),
+             min(bucket_quantile(self.buckets, counts, 0.99), max_latency), max_latency)
+            for guild_id, (counts, max_latency) in self.guilds.items()
+        ]
+        rows.sort(key=lambda row: (row[3], row[4]), reverse=True)
+        return rows[:n]
+
+
+GUILD_LATENCY = GuildLatencyTracker()
+
+
+def report_hot_path():
+    if not PROFILE_HOT_PATH:
+        return
+    for (stage,), (counts, total, count) in STAGE_DURATION.series.items():
+        logger.info(
+            f"Stage {stage}: {count} calls, p50 {STAGE_DURATION.quantile(0.5, (stage,)) * 1000:.3f} ms, "
+            f"p99 {STAGE_DURATION.quantile(0.99, (stage,)) * 1000:.3f} ms."
+        )
+    if EVENT_TO_SEND.series:
+        logger.info(
+            f"Event to send: {EVENT_TO_SEND.series[()][2]} alerts, p50 {EVENT_TO_SEND.quantile(0.5) * 1000:.1f} ms, "
+            f"p99 {EVENT_TO_SEND.quantile(0.99) * 1000:.1f} ms."
+        )
+
+
+class LoopLagMonitor:
+    # Задержка цикла событий: насколько позже запланированного просыпается asyncio.sleep.
+    # Если кто-то блокирует цикл (синхронная запись на диск и т.п.), это сразу видно здесь.
+    def __init__(self):
+        self.interval = LOOP_LAG_INTERVAL_MS / 1000
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+
+    def record(self, lag):
+        EVENT_LOOP_LAG.observe(lag)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        self.samples += 1
+        if lag * 1000 > LOOP_LAG_WARN_MS:
+            logger.warning("Event loop lag %.1f ms.", lag * 1000)
+
+    def report(self):
+        avg = self.total_lag / self.samples if self.samples else 0.0
+        logger.info(
+            f"Event loop lag over {self.samples} samples: avg {avg * 1000:.2f} ms, max {self.max_lag * 1000:.2f} ms."
+        )
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.samples = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_report = loop.time() + LOOP_LAG_REPORT_SEC
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.record(max(0.0, now - started - self.interval))
+            if now >= next_report:
+                self.report()
+                report_hot_path()
+                next_report = now + LOOP_LAG_REPORT_SEC
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramNetworkError,
+    TelegramServerError,
+    TelegramAPIError
+)
+
+from metrics import (
+    NOTIFICATIONS_SENT,
+    NOTIFICATIONS_FAILED,
+    NOTIFICATION_LATENCY,
+    NOTIFICATION_QUEUE_DEPTH,
+    GUILD_LATENCY
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "1000"))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))  # сообщений в секунду на весь бот (лимит Telegram ~30)
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))  # сообщений в секунду в один чат
+NOTIFY_CHAT_BURST = int(os.getenv("NOTIFY_CHAT_BURST", "3"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "5"))
+NOTIFY_MAX_AGE_SEC = int(os.getenv("NOTIFY_MAX_AGE_SEC", "120"))  # старше - уведомление уже неактуально
+NOTIFY_DRAIN_TIMEOUT_SEC = int(os.getenv("NOTIFY_DRAIN_TIMEOUT_SEC", "10"))
+# Сколько put ждёт места в полной очереди, прежде чем выбросить уведомление
+NOTIFY_SUBMIT_TIMEOUT_SEC = float(os.getenv("NOTIFY_SUBMIT_TIMEOUT_SEC", "30"))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        # Забирает токен (возможно, в долг) и возвращает, сколько секунд нужно подождать до отправки
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def is_idle(self):
+        now = time.monotonic()
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class Alert:
+    __slots__ = ("chat_id", "key", "text", "created", "updated", "attempts", "origin")
+
+    def __init__(self, chat_id, key, text, origin=None):
+        self.chat_id = chat_id
+        self.key = key
+        self.text = text
+        # (guild_id, time.monotonic() первого голосового события) - для замера задержки событие -> отправка
+        self.origin = origin
+        self.created = time.monotonic()
+        self.updated = self.created
+        self.attempts = 0
+
+
+class NotificationDispatcher:
+    # Очередь уведомлений в Telegram с ограниченным размером, общим и per-chat лимитом скорости,
+    # фиксированным пулом отправителей и повторами с учётом retry_after.
+    def __init__(self, send):
+        self.send = send  # корутина вида send(chat_id, text), обычно bot.send_message
+        self.queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        # Ещё не отправленные уведомления по ключу (chat_id, key): новое для того же канала
+        # заменяет текст ожидающего, а не встаёт в очередь вторым сообщением
+        self.pending = {}
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE, max(1, int(NOTIFY_GLOBAL_RATE)))
+        self.chat_buckets = {}
+        self.paused_until = 0.0  # глобальная пауза после 429
+        self.workers = []
+        self.accepting = False
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.stale = 0
+        self.merged = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        NOTIFICATION_QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    def start(self):
+        if self.workers:
+            return
+        logger.debug(f"Starting notification dispatcher with {NOTIFY_WORKERS} workers.")
+        self.accepting = True
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(NOTIFY_WORKERS)]
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "stale": self.stale,
+            "merged": self.merged,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.total_latency / self.sent if self.sent else 0.0,
+        }
+
+    def drop(self, chat_id, reason):
+        logger.warning("Notification %s, dropping alert for chat_id=%s.", reason, chat_id)
+        self.dropped += 1
+        NOTIFICATIONS_FAILED.inc(labels=("dropped",))
+        return False
+
+    def merge(self, chat_id, text, key, origin):
+        # Уведомление с тем же ключом ещё ждёт отправки - обновляем его текст вместо второго сообщения
+        alert = self.pending.get((chat_id, key)) if key is not None else None
+        if alert is None:
+            return False
+        alert.text = text
+        alert.updated = time.monotonic()
+        if alert.origin is None:
+            alert.origin = origin
+        self.merged += 1
+        return True
+
+    def submit(self, chat_id, text, key=None, origin=None):
+        if not self.accepting:
+            return self.drop(chat_id, "dispatcher is not running")
+        if self.merge(chat_id, text, key, origin):
+            return True
+        alert = Alert(chat_id, key, text, origin)
+        try:
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            return self.drop(chat_id, "queue is full")
+        if key is not None:
+            self.pending[(chat_id, key)] = alert
+        return True
+
+    async def put(self, chat_id, text, key=None, origin=None, timeout=NOTIFY_SUBMIT_TIMEOUT_SEC):
+        # То же, что submit, но при полной очереди ждёт места. Вызывающий (хаб IPC, проверка порогов)
+        # на это время останавливается, и давление доходит до источника событий, а не теряет уведомления
+        if not self.accepting:
+            return self.drop(chat_id, "dispatcher is not running")
+        if self.merge(chat_id, text, key, origin):
+            return True
+        alert = Alert(chat_id, key, text, origin)
+        try:
+            # Пока место есть, обходимся без wait_for: он создаёт задачу и уступает цикл на каждом уведомлении
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(alert), timeout)
+            except asyncio.TimeoutError:
+                return self.drop(chat_id, f"queue stayed full for {timeout}s")
+        if key is not None:
+            self.pending[(chat_id, key)] = alert
+        return True
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # Полные корзины ничего не ограничивают, их можно выкинуть
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_idle()}
+            bucket = TokenBucket(NOTIFY_CHAT_RATE, NOTIFY_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def worker(self):
+        while True:
+            alert = await self.queue.get()
+            try:
+                await self.deliver(alert)
+            except Exception:
+                logger.exception(f"Unexpected error while sending alert to chat_id={alert.chat_id}.")
+                self.failed += 1
+                NOTIFICATIONS_FAILED.inc(labels=("error",))
+            finally:
+                self.queue.task_done()
+
+    async def deliver(self, alert):
+        await asyncio.sleep(self.chat_bucket(alert.chat_id).reserve())
+        while True:
+            if time.monotonic() - alert.updated > NOTIFY_MAX_AGE_SEC:
+                logger.debug("Dropping stale alert for chat_id=%s.", alert.chat_id)
+                if alert.key is not None and self.pending.get((alert.chat_id, alert.key)) is alert:
+                    del self.pending[(alert.chat_id, alert.key)]
+                self.stale += 1
+                NOTIFICATIONS_FAILED.inc(labels=("stale",))
+                return
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await asyncio.sleep(self.global_bucket.reserve())
+            # С этого момента новое уведомление для того же ключа пойдёт отдельным сообщением
+            if alert.key is not None and self.pending.get((alert.chat_id, alert.key)) is alert:
+                del self.pending[(alert.chat_id, alert.key)]
+            alert.attempts += 1
+            try:
+                await self.send(alert.chat_id, alert.text)
+            except TelegramRetryAfter as e:
+                logger.warning("Telegram asked to retry after %ss (chat_id=%s).", e.retry_after, alert.chat_id)
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                if alert.attempts > NOTIFY_MAX_RETRIES:
+                    self.failed += 1
+                    NOTIFICATIONS_FAILED.inc(labels=("retries",))
+                    return
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if alert.attempts > NOTIFY_MAX_RETRIES:
+                    logger.error(f"Giving up on alert for chat_id={alert.chat_id}: {e}")
+                    self.failed += 1
+                    NOTIFICATIONS_FAILED.inc(labels=("retries",))
+                    return
+                await asyncio.sleep(min(30.0, 2 ** (alert.attempts - 1)))
+                continue
+            except TelegramAPIError as e:
+                # Бот заблокирован, чат не найден и т.п. - повтор не поможет
+                logger.warning(f"Failed to send alert to chat_id={alert.chat_id}: {e}")
+                self.failed += 1
+                NOTIFICATIONS_FAILED.inc(labels=("api_error",))
+                return
+            latency = time.monotonic() - alert.created
+            self.sent += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            NOTIFICATIONS_SENT.inc()
+            NOTIFICATION_LATENCY.observe(latency)
+            if alert.origin is not None:
+                guild_id, event_time = alert.origin
+                GUILD_LATENCY.record(guild_id, time.monotonic() - event_time)
+            return
+
+    async def stop(self, timeout=NOTIFY_DRAIN_TIMEOUT_SEC):
+        # Перестаём принимать новые уведомления и даём очереди досылаться не дольше timeout
+        self.accepting = False
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Notification queue not drained in {timeout}s, {self.queue_depth} alerts lost.")
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+
+DIGEST_WINDOW_SEC = float(os.getenv("DIGEST_WINDOW_SEC", "5"))  # сколько копить уведомления для сводки
+DIGEST_MAX_NAMES = int(os.getenv("DIGEST_MAX_NAMES", "20"))  # сколько имён показывать в одной строке сводки
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def format_user_list(user_list, max_names):
+    if len(user_list) <= max_names:
+        return ", ".join(user_list)
+    return f"{', '.join(user_list[:max_names])} и ещё {len(user_list) - max_names}"
+
+
+def split_message(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    # Склеивает строки в сообщения не длиннее limit, слишком длинную строку режет
+    chunks = []
+    current = ""
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current = f"{current}\n{line}"
+        else:
+            chunks.append(current)
+            current = line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class DigestBuffer:
+    # Уведомления для пользователей в режиме сводки: копятся DIGEST_WINDOW_SEC
+    # и уходят одним сообщением (или несколькими, если не влезают в лимит Telegram)
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.buffers = {}  # chat_id -> {channel_name: (count, user_list)}
+        self.timers = {}
+        self.flush_tasks = set()
+
+    def add(self, chat_id, channel_name, user_count, user_list):
+        entries = self.buffers.setdefault(chat_id, {})
+        # Если тот же канал пересёк порог снова, в сводке остаётся последнее значение
+        entries[channel_name] = (user_count, user_list)
+        if chat_id not in self.timers:
+            loop = asyncio.get_running_loop()
+            self.timers[chat_id] = loop.call_later(DIGEST_WINDOW_SEC, self.start_flush, chat_id)
+
+    def start_flush(self, chat_id):
+        # Таймер не может ждать места в очереди, поэтому отправка идёт в задаче; stop_async её дождётся
+        task = asyncio.create_task(self.flush_chat(chat_id))
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush_chat(self, chat_id):
+        timer = self.timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        entries = self.buffers.pop(chat_id, None)
+        if not entries:
+            return
+        lines = ["Сводка:"]
+        for channel_name, (user_count, user_list) in entries.items():
+            lines.append(
+                f"• На {channel_name} собралось {user_count} человек: {format_user_list(user_list, DIGEST_MAX_NAMES)}"
+            )
+        # Сводка копилась DIGEST_WINDOW_SEC, при полной очереди ждём места, а не выбрасываем её
+        for chunk in split_message(lines):
+            await self.dispatcher.put(chat_id, chunk)
+
+    async def flush_all(self):
+        for chat_id in list(self.buffers):
+            await self.flush_chat(chat_id)
+        if self.flush_tasks:
+            await asyncio.gather(*list(self.flush_tasks))
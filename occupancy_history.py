@@ -0,0 +1,212 @@
+import logging
+import os
+import struct
+import time
+from array import array
+from dotenv import load_dotenv
+
+from storage import DB_PATH
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_PATH = os.getenv("HISTORY_PATH", DB_PATH + ".history")
+HISTORY_SAVE_INTERVAL_SEC = int(os.getenv("HISTORY_SAVE_INTERVAL_SEC", "300"))
+# Глубина каждого уровня в ячейках: минуты, часы, дни. Память на гильдию фиксирована: 8 байт на ячейку
+HISTORY_MINUTES = int(os.getenv("HISTORY_MINUTES", "180"))
+HISTORY_HOURS = int(os.getenv("HISTORY_HOURS", "168"))
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "90"))
+
+TIERS = ((60, HISTORY_MINUTES), (3600, HISTORY_HOURS), (86400, HISTORY_DAYS))
+COUNT_MAX = 0xFFFF  # счётчики хранятся в array("H")
+FILE_MAGIC = b"OCCH"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<4sHHIII")  # magic, версия, число уровней, размеры уровней
+GUILD_HEADER = struct.Struct("<Q")
+# Пики для /stats берутся из уже свёрнутых уровней: минутного за час, часового за сутки, дневного за неделю
+STATS_PEAKS = (("hour", 0, 60), ("day", 1, 24), ("week", 2, 7))
+
+
+class HistoryRing:
+    # Кольцевой буфер одного уровня: в ячейке slot % size лежит пик за интервал slot
+    # (номер интервала с начала эпохи). По номеру ячейки видно, не перезаписана ли она более новым интервалом.
+    __slots__ = ("period", "size", "slots", "total", "max_channel", "head")
+
+    def __init__(self, period, size):
+        self.period = period
+        self.size = size
+        self.slots = array("i", [-1]) * size
+        self.total = array("H", [0]) * size
+        self.max_channel = array("H", [0]) * size
+        self.head = -1  # последний записанный интервал
+
+    def _start(self, slot, total, max_channel):
+        i = slot % self.size
+        self.slots[i] = slot
+        self.total[i] = total
+        self.max_channel[i] = max_channel
+
+    def record(self, now, total, max_channel, last):
+        slot = int(now // self.period)
+        if slot != self.head:
+            if last is not None and self.head >= 0:
+                # В пропущенных интервалах событий не было, значит число людей не менялось
+                for skipped in range(max(self.head + 1, slot - self.size + 1), slot):
+                    self._start(skipped, *last)
+            # Интервал начинается с того числа людей, что было до события
+            self._start(slot, *(last if last is not None else (total, max_channel)))
+            self.head = slot
+        i = slot % self.size
+        if total > self.total[i]:
+            self.total[i] = total
+        if max_channel > self.max_channel[i]:
+            self.max_channel[i] = max_channel
+
+    def series(self, now, count, last):
+        # [(начало интервала, пик total, пик max_channel) или None, ...] за последние count интервалов.
+        # Интервалы после последнего события до now заполняются текущим значением last
+        now_slot = int(now // self.period)
+        result = []
+        for slot in range(now_slot - min(count, self.size) + 1, now_slot + 1):
+            i = slot % self.size
+            if self.slots[i] == slot:
+                result.append((slot * self.period, self.total[i], self.max_channel[i]))
+            elif last is not None and self.head >= 0 and slot > self.head:
+                result.append((slot * self.period, last[0], last[1]))
+            else:
+                result.append(None)
+        return result
+
+
+class GuildHistory:
+    __slots__ = ("rings", "last")
+
+    def __init__(self):
+        self.rings = [HistoryRing(period, size) for period, size in TIERS]
+        # Последние (total, max_channel); None после загрузки с диска - что было, пока бот лежал, неизвестно
+        self.last = None
+
+    def record(self, now, total, max_channel):
+        total = min(total, COUNT_MAX)
+        max_channel = min(max_channel, COUNT_MAX)
+        for ring in self.rings:
+            ring.record(now, total, max_channel, self.last)
+        self.last = (total, max_channel)
+
+
+class OccupancyHistory:
+    # Временной ряд заполненности по гильдиям: пики total и max_channel по минутам, часам и дням.
+    # Каждое значение сразу попадает во все три уровня, поэтому сводка читает уже свёрнутые ячейки.
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        self.guilds = {}  # guild_id -> GuildHistory
+        self.dirty = False
+
+    def record(self, guild_id, total, max_channel, now=None):
+        history = self.guilds.get(guild_id)
+        if history is None:
+            history = self.guilds[guild_id] = GuildHistory()
+        history.record(time.time() if now is None else now, total, max_channel)
+        self.dirty = True
+
+    def get(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def peak_hours(self, guild_id, now=None, limit=3):
+        # Часы суток (местное время), в которые в среднем больше всего людей, по часовому уровню
+        history = self.guilds.get(guild_id)
+        if history is None:
+            return []
+        now = time.time() if now is None else now
+        sums = {}
+        for item in history.rings[1].series(now, HISTORY_HOURS, history.last):
+            if item is None:
+                continue
+            start, total, max_channel = item
+            hour = time.localtime(start).tm_hour
+            acc = sums.setdefault(hour, [0, 0, 0])
+            acc[0] += total
+            acc[1] += max_channel
+            acc[2] += 1
+        ranked = sorted(
+            ((hour, acc[0] / acc[2], acc[1] / acc[2]) for hour, acc in sums.items()),
+            key=lambda row: row[1], reverse=True
+        )
+        return [row for row in ranked[:limit] if row[1] > 0]
+
+    def peak(self, guild_id, tier, count, now=None):
+        # (время начала интервала, пик total, пик max_channel) за последние count интервалов уровня
+        history = self.guilds.get(guild_id)
+        if history is None:
+            return None
+        items = [
+            item for item in history.rings[tier].series(time.time() if now is None else now, count, history.last)
+            if item is not None
+        ]
+        return max(items, key=lambda item: item[1]) if items else None
+
+    def summary(self, guild_id, now=None):
+        # Всё, что показывает /stats, в виде, пригодном для JSON: шард отправляет это хабу по IPC
+        history = self.guilds.get(guild_id)
+        if history is None:
+            return None
+        now = time.time() if now is None else now
+        return {
+            "last": history.last,
+            "peaks": {name: self.peak(guild_id, tier, count, now) for name, tier, count in STATS_PEAKS},
+            "hours": self.peak_hours(guild_id, now),
+        }
+
+    def dump(self):
+        # Сериализация в цикле событий (только копии массивов), запись - в отдельном потоке
+        parts = [FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, len(TIERS), *(size for _, size in TIERS))]
+        for guild_id, history in self.guilds.items():
+            parts.append(GUILD_HEADER.pack(guild_id))
+            for ring in history.rings:
+                parts.append(ring.slots.tobytes())
+                parts.append(ring.total.tobytes())
+                parts.append(ring.max_channel.tobytes())
+        self.dirty = False
+        return b"".join(parts)
+
+    def write_file(self, payload):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            payload = f.read()
+        if len(payload) < FILE_HEADER.size:
+            logger.warning(f"Occupancy history file {self.path} is truncated, starting empty.")
+            return
+        magic, version, tiers, *sizes = FILE_HEADER.unpack_from(payload)
+        if (magic != FILE_MAGIC or version != FILE_VERSION or tiers != len(TIERS)
+                or tuple(sizes) != tuple(size for _, size in TIERS)):
+            # Формат или размеры уровней поменялись - проще начать заново, чем пересчитывать
+            logger.warning(f"Occupancy history file {self.path} has a different layout, starting empty.")
+            return
+        offset = FILE_HEADER.size
+        guild_size = GUILD_HEADER.size + sum(size * 8 for _, size in TIERS)
+        guilds = {}
+        while offset + guild_size <= len(payload):
+            (guild_id,) = GUILD_HEADER.unpack_from(payload, offset)
+            offset += GUILD_HEADER.size
+            history = GuildHistory()
+            for ring in history.rings:
+                for values, itemsize in ((ring.slots, 4), (ring.total, 2), (ring.max_channel, 2)):
+                    end = offset + ring.size * itemsize
+                    values[:] = array(values.typecode, payload[offset:end])
+                    offset = end
+                valid = [slot for slot in ring.slots if slot >= 0]
+                ring.head = max(valid) if valid else -1
+            guilds[guild_id] = history
+        self.guilds = guilds
+        logger.info(f"Loaded occupancy history for {len(guilds)} guilds.")
@@ -0,0 +1,254 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from storage import Storage, DB_PATH, SQLITE_DB_PATH, apply_journal_entry, migrate_server_counts
+
+logger = logging.getLogger(__name__)
+
+# Поля настроек, у которых есть свои колонки/таблицы. Всё остальное лежит в users.extra как JSON.
+CORE_FIELDS = ("servers", "threshold", "mode")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    threshold INTEGER NOT NULL DEFAULT 0,
+    mode TEXT NOT NULL DEFAULT 'total',
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    user_id TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, guild_id)
+);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_guild ON subscriptions (guild_id);
+CREATE TABLE IF NOT EXISTS guild_counts (
+    guild_id INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, mode)
+);
+CREATE TABLE IF NOT EXISTS cooldowns (
+    user_id TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (user_id, guild_id)
+);
+CREATE INDEX IF NOT EXISTS idx_cooldowns_expires ON cooldowns (expires_at);
+"""
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL NORMAL не теряет целостность, а fsync делается только на чекпоинтах
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    migrate_server_counts_table(conn)
+    return conn
+
+
+def migrate_server_counts_table(conn):
+    # Старая схема хранила счётчик на (пользователь, сервер). Переносим в guild_counts максимум
+    # по (сервер, режим), как и migrate_server_counts для JSON, и удаляем старую таблицу.
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'server_counts'").fetchone()
+    if not exists:
+        return
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO guild_counts (guild_id, mode, count) "
+            "SELECT sc.guild_id, CASE WHEN u.mode = 'total' THEN 'total' ELSE 'max_channel' END, MAX(sc.count) "
+            "FROM server_counts sc JOIN users u ON u.user_id = sc.user_id GROUP BY 1, 2"
+        )
+        conn.execute("DROP TABLE server_counts")
+    logger.info("Migrated per-user server counts to per-guild counts.")
+
+
+def user_row(user_str, settings):
+    # Готовит строку пользователя заранее, чтобы поток-писатель не читал изменяемый dict настроек
+    extra = {k: v for k, v in settings.items() if k not in CORE_FIELDS}
+    return (
+        user_str,
+        settings.get("threshold", 0),
+        settings.get("mode", "total"),
+        json.dumps(extra, ensure_ascii=False),
+        [int(s) for s in settings.get("servers", [])],
+    )
+
+
+def write_user(conn, row):
+    user_str, threshold, mode, extra, servers = row
+    conn.execute(
+        "INSERT INTO users (user_id, threshold, mode, extra) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET threshold=excluded.threshold, mode=excluded.mode, extra=excluded.extra",
+        (user_str, threshold, mode, extra)
+    )
+    if servers:
+        placeholders = ",".join("?" * len(servers))
+        conn.execute(
+            f"DELETE FROM subscriptions WHERE user_id = ? AND guild_id NOT IN ({placeholders})",
+            (user_str, *servers)
+        )
+    else:
+        conn.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_str,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO subscriptions (user_id, guild_id) VALUES (?, ?)",
+        [(user_str, s) for s in servers]
+    )
+
+
+def write_guild_count(conn, server_str, mode, count):
+    conn.execute(
+        "INSERT OR REPLACE INTO guild_counts (guild_id, mode, count) VALUES (?, ?, ?)",
+        (int(server_str), mode, count)
+    )
+
+
+def write_cooldown(conn, user_str, server_str, expiry):
+    if expiry is None:
+        conn.execute("DELETE FROM cooldowns WHERE user_id = ? AND guild_id = ?", (user_str, int(server_str)))
+        return
+    conn.execute(
+        "INSERT OR REPLACE INTO cooldowns (user_id, guild_id, expires_at) VALUES (?, ?, ?)",
+        (user_str, int(server_str), expiry)
+    )
+
+
+def migrate_json_to_sqlite(json_path, db_path):
+    # Разовый перенос data.json в SQLite. Повторный запуск безопасен: строки перезаписываются.
+    logger.info(f"Migrating {json_path} to {db_path}.")
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data.setdefault("users", {})
+    data.setdefault("cooldowns", {})
+    users = data["users"]
+    journal_path = json_path + ".journal"
+    if os.path.exists(journal_path):
+        # Хвост журнала, ещё не свёрнутый в снимок
+        with open(journal_path, "rb") as f:
+            for raw in f:
+                try:
+                    apply_journal_entry(data, json.loads(raw))
+                except ValueError:
+                    break
+    migrate_server_counts(data)
+    conn = connect(db_path)
+    try:
+        with conn:
+            for user_str, settings in users.items():
+                write_user(conn, user_row(user_str, settings or {}))
+            for key, expiry in data["cooldowns"].items():
+                user_str, server_str = key.rsplit(":", 1)
+                write_cooldown(conn, user_str, server_str, expiry)
+            for server_str, counts in data.get("guild_counts", {}).items():
+                for mode, count in counts.items():
+                    write_guild_count(conn, server_str, mode, count)
+    finally:
+        conn.close()
+    logger.info(f"Migrated {len(users)} users.")
+    return len(users)
+
+
+class SqliteStorage(Storage):
+    # Тот же интерфейс, что и у Storage: чтение из памяти, а на диск уходят только изменённые строки.
+    def __init__(self):
+        self.conn = None
+        # Несброшенные изменения, схлопнутые по ключу: ("settings", user) / ("guild_count", server, mode)
+        self.pending_rows = {}
+        super().__init__()
+
+    def open(self):
+        logger.debug(f"Opening SQLite storage at {SQLITE_DB_PATH}.")
+        self.conn = connect(SQLITE_DB_PATH)
+        (users_count,) = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        if users_count == 0 and os.path.exists(DB_PATH):
+            # Первый запуск на SQLite: подхватываем данные из старого data.json
+            self.conn.close()
+            migrate_json_to_sqlite(DB_PATH, SQLITE_DB_PATH)
+            self.conn = connect(SQLITE_DB_PATH)
+        self.load_data()
+
+    def load_data(self):
+        logger.debug("Loading data from SQLite.")
+        users = {}
+        for user_str, threshold, mode, extra in self.conn.execute(
+                "SELECT user_id, threshold, mode, extra FROM users"):
+            settings = json.loads(extra)
+            settings.update({"servers": [], "threshold": threshold, "mode": mode})
+            users[user_str] = settings
+        for user_str, guild_id in self.conn.execute(
+                "SELECT user_id, guild_id FROM subscriptions ORDER BY rowid"):
+            if user_str in users:
+                users[user_str]["servers"].append(guild_id)
+        guild_counts = {}
+        for guild_id, mode, count in self.conn.execute("SELECT guild_id, mode, count FROM guild_counts"):
+            guild_counts.setdefault(str(guild_id), {})[mode] = count
+        # Истёкшие таймауты больше не нужны
+        with self.conn:
+            self.conn.execute("DELETE FROM cooldowns WHERE expires_at <= ?", (time.time(),))
+        cooldowns = {}
+        for user_str, guild_id, expires_at in self.conn.execute(
+                "SELECT user_id, guild_id, expires_at FROM cooldowns"):
+            cooldowns[f"{user_str}:{guild_id}"] = expires_at
+        self.data = {"users": users, "cooldowns": cooldowns, "guild_counts": guild_counts}
+        self.rebuild_server_index()
+
+    def record_change(self, change):
+        if change[0] == "guild_count":
+            _, server_str, mode, count = change
+            self.pending_rows[("guild_count", server_str, mode)] = count
+        elif change[0] == "cooldown":
+            _, user_str, server_str, expiry = change
+            self.pending_rows[("cooldown", user_str, server_str)] = expiry
+        else:
+            self.pending_rows[change] = None
+        self.save_data()
+
+    def prepare_flush(self, compact=False):
+        logger.debug("Preparing SQLite flush of %d rows.", len(self.pending_rows))
+        rows, self.pending_rows = self.pending_rows, {}
+        pending_changes, self.pending_changes = self.pending_changes, 0
+        if not rows:
+            return None
+        prepared = []
+        for key, count in rows.items():
+            if key[0] == "settings":
+                settings = self.data["users"].get(key[1])
+                if settings is not None:
+                    prepared.append(("settings", user_row(key[1], settings)))
+            else:
+                prepared.append((key[0], key[1], key[2], count))
+
+        def write():
+            with self.conn:
+                for item in prepared:
+                    if item[0] == "settings":
+                        write_user(self.conn, item[1])
+                    elif item[0] == "cooldown":
+                        write_cooldown(self.conn, item[1], item[2], item[3])
+                    else:
+                        write_guild_count(self.conn, item[1], item[2], item[3])
+
+        def rollback():
+            # Возвращаем изменения в очередь, более свежие значения не затираем
+            for key, count in rows.items():
+                self.pending_rows.setdefault(key, count)
+            self.pending_changes += pending_changes or 1
+        return write, rollback
+
+    async def close(self):
+        await super().close()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+if __name__ == "__main__":
+    # python sqlite_storage.py [data.json] [data.db]
+    logging.basicConfig(level=logging.INFO)
+    json_path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    db_path = sys.argv[2] if len(sys.argv) > 2 else SQLITE_DB_PATH
+    migrate_json_to_sqlite(json_path, db_path)
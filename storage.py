@@ -1,63 +1,505 @@
+import asyncio
+import contextvars
 import json
 import os
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 from dotenv import load_dotenv
 
+from metrics import STORAGE_FLUSH_DURATION, timed
+from threshold_index import ThresholdIndex, normalize_mode
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DB_PATH = os.getenv("DB_PATH", "data.json")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "json" или "sqlite"
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "data.db")
+# Отложенная запись: изменения копятся в памяти и сбрасываются на диск фоновой задачей
+STORAGE_WRITE_BEHIND = os.getenv("STORAGE_WRITE_BEHIND", "true").lower() == "true"
+STORAGE_FLUSH_INTERVAL_MS = int(os.getenv("STORAGE_FLUSH_INTERVAL_MS", "1000"))  # сброс раз в N мс
+STORAGE_FLUSH_MAX_CHANGES = int(os.getenv("STORAGE_FLUSH_MAX_CHANGES", "500"))  # или раньше, после K изменений
+# Журнал изменений: каждая правка дописывается строкой в DB_PATH.journal, а data.json
+# (снимок) переписывается только при компакции, когда журнал вырос больше порога
+STORAGE_JOURNAL = os.getenv("STORAGE_JOURNAL", "true").lower() == "true"
+JOURNAL_PATH = DB_PATH + ".journal"
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+# Хранилище, чей storage.batch() открыт в текущей задаче. Контекст наследуют только задачи, созданные
+# внутри блока, поэтому commit откладывается лишь для них, а не для команд Telegram и других событий
+BATCHING = contextvars.ContextVar("storage_batching", default=None)
+
+def apply_journal_entry(data, entry):
+    # Записи идемпотентны, поэтому журнал можно проигрывать поверх более свежего снимка
+    users = data["users"]
+    if entry["op"] == "set":
+        users[entry["u"]] = entry["s"]
+    elif entry["op"] == "gcnt":
+        data.setdefault("guild_counts", {}).setdefault(entry["g"], {})[entry["m"]] = entry["c"]
+    elif entry["op"] == "cnt":
+        # Старый формат: счётчик на пользователя, переносится в guild_counts через migrate_server_counts
+        settings = users.setdefault(entry["u"], {"servers": [], "threshold": 0, "mode": "total"})
+        settings.setdefault("server_counts", {})[entry["g"]] = entry["c"]
+    elif entry["op"] == "cd":
+        # e = null - таймаут удалён (истёк или вытеснен из памяти)
+        if entry["e"] is None:
+            data.setdefault("cooldowns", {}).pop(f"{entry['u']}:{entry['g']}", None)
+        else:
+            data.setdefault("cooldowns", {})[f"{entry['u']}:{entry['g']}"] = entry["e"]
+
+
+def migrate_server_counts(data):
+    # Раньше последнее число людей хранилось на каждого (пользователь, сервер), теперь - одно на
+    # (сервер, режим). Берём максимум: так после переноса никто не получит повторное уведомление.
+    guild_counts = data.setdefault("guild_counts", {})
+    migrated = 0
+    for settings in data["users"].values():
+        server_counts = settings.pop("server_counts", None) if settings else None
+        if not server_counts:
+            continue
+        mode = normalize_mode(settings.get("mode", "total"))
+        for server_str, count in server_counts.items():
+            counts = guild_counts.setdefault(server_str, {})
+            counts[mode] = max(counts.get(mode, 0), count)
+            migrated += 1
+    return migrated
+
 
 class Storage:
     def __init__(self):
-        logging.debug("Initializing storage.")
-        self.data = {"users": {}}
+        logger.debug("Initializing storage.")
+        # cooldowns: "user_id:server_id" -> время, до которого не уведомлять (переживает перезапуск)
+        # guild_counts: "server_id" -> {"total": n, "max_channel": m} - последнее число людей на сервере
+        self.data = {"users": {}, "cooldowns": {}, "guild_counts": {}}
+        # Обратный индекс: server_id -> множество user_id (str), подписанных на сервер
+        self.server_index = {}
+        # Сервера, под которыми пользователь сейчас числится в индексе: user_id (str) -> set(server_id)
+        self.indexed_servers = {}
+        # Пороги подписчиков, отсортированные по (server_id, режим)
+        self.threshold_index = ThresholdIndex()
+        # Число изменений, ещё не записанных на диск
+        self.pending_changes = 0
+        self.flusher_task = None
+        self.flush_event = None
+        self.flush_lock = None
+        # Поток-писатель для асинхронного фасада и вложенность defer_writes()
+        self.writer = None
+        self.deferred_writes = 0
+        self.listeners = []
+        # Строки журнала, ещё не дописанные в файл, и текущий размер журнала на диске
+        self.journal_buffer = []
+        self.journal_size = 0
+        self.open()
+
+    def open(self):
+        started = time.perf_counter()
+        replayed = 0
         if os.path.exists(DB_PATH):
-            logging.debug("Loading existing data from file.")
+            logger.debug("Loading existing data from file.")
             self.load_data()
         else:
-            logging.debug("No data file found, creating new.")
-            self.save_data()
+            logger.debug("No data file found, creating new.")
+            self.write_snapshot()
+        if os.path.exists(JOURNAL_PATH):
+            replayed = self.replay_journal()
+            self.rebuild_server_index()
+        self.migrate_server_counts()
+        logger.info(
+            f"Storage loaded in {(time.perf_counter() - started) * 1000:.1f} ms, "
+            f"replayed {replayed} journal entries ({self.journal_size} bytes)."
+        )
 
     def load_data(self):
-        logging.debug("Loading data from file.")
+        logger.debug("Loading data from file.")
         with open(DB_PATH, "r", encoding="utf-8") as f:
             self.data = json.load(f)
+        self.data.setdefault("cooldowns", {})
+        self.data.setdefault("guild_counts", {})
+        self.rebuild_server_index()
 
+    def migrate_server_counts(self):
+        migrated = migrate_server_counts(self.data)
+        if migrated:
+            logger.info(f"Migrated {migrated} per-user server counts to per-guild counts.")
+            # Новый формат попадёт на диск при ближайшей компакции; до неё перенос просто повторится
+            self.pending_changes += 1
+
+    def replay_journal(self):
+        logger.debug("Replaying storage journal.")
+        replayed = 0
+        good_size = 0
+        with open(JOURNAL_PATH, "rb") as f:
+            for raw in f:
+                try:
+                    entry = json.loads(raw)
+                except ValueError:
+                    # Недописанная последняя строка после падения - всё, что до неё, уже применено
+                    logger.warning(f"Truncated journal entry after {replayed} entries, ignoring the tail.")
+                    break
+                apply_journal_entry(self.data, entry)
+                replayed += 1
+                good_size += len(raw)
+        if good_size != os.path.getsize(JOURNAL_PATH):
+            # Отрезаем битый хвост, иначе следующая запись склеится с ним в одну строку
+            os.truncate(JOURNAL_PATH, good_size)
+        self.journal_size = good_size
+        return replayed
+
+    def rebuild_server_index(self):
+        logger.debug("Rebuilding server index.")
+        self.server_index = {}
+        self.indexed_servers = {}
+        self.threshold_index.clear()
+        for user_str, settings in self.data["users"].items():
+            self._reindex_user(user_str, settings)
+
+    def _reindex_user(self, user_str, settings):
+        # Сравниваем с тем, что уже лежит в индексе, а не со старыми настройками:
+        # обработчики часто мутируют тот же самый dict, который потом передают сюда.
+        old_servers = self.indexed_servers.get(user_str, set())
+        new_servers = {int(s) for s in (settings or {}).get("servers", [])}
+        for server_id in old_servers - new_servers:
+            subscribers = self.server_index.get(server_id)
+            if subscribers is not None:
+                subscribers.discard(user_str)
+                if not subscribers:
+                    del self.server_index[server_id]
+        for server_id in new_servers - old_servers:
+            self.server_index.setdefault(server_id, set()).add(user_str)
+        if new_servers:
+            self.indexed_servers[user_str] = new_servers
+        else:
+            self.indexed_servers.pop(user_str, None)
+        self.threshold_index.update_user(user_str, settings)
+
+    @timed("save_data")
     def save_data(self):
-        logging.debug("Saving data to file.")
-        with open(DB_PATH, "w", encoding="utf-8") as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=4)
+        # Пока фоновая запись не запущена (или выключена), пишем сразу - кроме вызовов
+        # из асинхронного фасада, которые сами отправят запись в поток-писатель
+        self.pending_changes += 1
+        if self.flusher_task is None:
+            if not self.deferred_writes:
+                self.flush()
+        elif self.pending_changes >= STORAGE_FLUSH_MAX_CHANGES:
+            self.flush_event.set()
+
+    @contextmanager
+    def defer_writes(self):
+        self.deferred_writes += 1
+        try:
+            yield
+        finally:
+            self.deferred_writes -= 1
+
+    @asynccontextmanager
+    async def batch(self):
+        # Изменения внутри блока (в том числе из задач, запущенных в нём) записываются одним commit в конце,
+        # и при отмене или ошибке тоже
+        outer = BATCHING.get() is not self
+        token = BATCHING.set(self)
+        try:
+            yield
+        finally:
+            BATCHING.reset(token)
+            if outer:
+                await self.commit()
+
+    def prepare_flush(self, compact=False):
+        # Выполняется в цикле событий: забирает накопленные изменения из памяти и возвращает
+        # (write, rollback). write только пишет готовые байты на диск и может работать в другом потоке,
+        # rollback возвращает изменения в очередь, если запись не удалась.
+        logger.debug("Preparing storage flush, pending_changes=%d.", self.pending_changes)
+        pending_changes, self.pending_changes = self.pending_changes, 0
+        if not STORAGE_JOURNAL:
+            if not pending_changes and not compact:
+                return None
+            snapshot = self.snapshot_payload()
+
+            def rollback():
+                self.pending_changes += pending_changes or 1
+            return (lambda: self.write_snapshot_file(snapshot)), rollback
+
+        lines, self.journal_buffer = self.journal_buffer, []
+        journal_payload = "".join(lines).encode("utf-8")
+        self.journal_size += len(journal_payload)
+        snapshot = None
+        compacted_size = self.journal_size
+        if self.journal_size and (compact or self.journal_size > JOURNAL_COMPACT_BYTES):
+            # Сериализуем снимок здесь, чтобы поток-писатель не читал self.data одновременно с изменениями
+            snapshot = self.snapshot_payload()
+            self.journal_size = 0
+        if not journal_payload and snapshot is None:
+            return None
+
+        def write():
+            if journal_payload:
+                self.append_journal_file(journal_payload)
+            if snapshot is not None:
+                self.compact_files(snapshot, compacted_size)
+
+        def rollback():
+            self.journal_buffer[:0] = lines
+            self.pending_changes += pending_changes or 1
+            self.journal_size = os.path.getsize(JOURNAL_PATH) if os.path.exists(JOURNAL_PATH) else 0
+        return write, rollback
+
+    def flush(self, compact=False):
+        job = self.prepare_flush(compact)
+        if job is None:
+            return
+        write, rollback = job
+        started = time.perf_counter()
+        try:
+            write()
+        except Exception:
+            rollback()
+            raise
+        STORAGE_FLUSH_DURATION.observe(time.perf_counter() - started)
+
+    async def aflush(self, compact=False):
+        # Запись на диск уходит в отдельный поток-писатель, цикл событий не блокируется.
+        # Пока идёт одна запись, следующие ждут на блокировке и потом забирают все накопленные изменения разом.
+        async with self.get_flush_lock():
+            job = self.prepare_flush(compact)
+            if job is None:
+                return
+            write, rollback = job
+            started = time.perf_counter()
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.get_writer(), write)
+            except Exception:
+                rollback()
+                raise
+            STORAGE_FLUSH_DURATION.observe(time.perf_counter() - started)
+
+    def get_flush_lock(self):
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        return self.flush_lock
+
+    def get_writer(self):
+        # Один поток - значит записи идут строго по порядку
+        if self.writer is None:
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+        return self.writer
+
+    def snapshot_payload(self):
+        self.prune_cooldowns()
+        return json.dumps(self.data, ensure_ascii=False, indent=4).encode("utf-8")
+
+    def write_snapshot(self):
+        self.write_snapshot_file(self.snapshot_payload())
+
+    def write_snapshot_file(self, payload):
+        # Пишем во временный файл и атомарно подменяем, чтобы падение посреди записи не портило data.json
+        tmp_path = DB_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, DB_PATH)
+
+    def append_journal_file(self, payload):
+        with open(JOURNAL_PATH, "ab") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact_files(self, snapshot, journal_size):
+        # Сворачиваем журнал в новый снимок. Если упадём между заменой снимка и очисткой журнала,
+        # при старте журнал просто повторно применится к снимку, в котором уже есть все его записи.
+        started = time.perf_counter()
+        self.write_snapshot_file(snapshot)
+        with open(JOURNAL_PATH, "wb") as f:
+            os.fsync(f.fileno())
+        logger.info(
+            f"Storage journal compacted ({journal_size} bytes) in {(time.perf_counter() - started) * 1000:.1f} ms."
+        )
+
+    def start_flusher(self):
+        if not STORAGE_WRITE_BEHIND or self.flusher_task is not None:
+            return
+        logger.debug("Starting storage write-behind flusher.")
+        self.flush_event = asyncio.Event()
+        self.flusher_task = asyncio.create_task(self.run_flusher())
+
+    async def run_flusher(self):
+        interval = STORAGE_FLUSH_INTERVAL_MS / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            if self.pending_changes:
+                try:
+                    await self.aflush()
+                except Exception:
+                    logger.exception("Failed to flush storage, will retry.")
+
+    async def close(self):
+        logger.debug("Closing storage.")
+        if self.flusher_task is not None:
+            self.flusher_task.cancel()
+            try:
+                await self.flusher_task
+            except asyncio.CancelledError:
+                pass
+            self.flusher_task = None
+        # Финальный сброс; журнал при этом сворачивается, чтобы следующий старт ничего не проигрывал
+        await self.aflush(compact=True)
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+            self.writer = None
+
+    async def commit(self):
+        # Для асинхронного фасада: при отложенной записи всё сделает фоновая задача,
+        # иначе дожидаемся записи в потоке-писателе, не блокируя цикл событий
+        if BATCHING.get() is self:
+            return
+        if self.flusher_task is None and self.pending_changes:
+            await self.aflush()
+
+    async def aupdate_user_settings(self, user_id, settings):
+        with self.defer_writes():
+            self.update_user_settings(user_id, settings)
+        await self.commit()
+
+    async def aadd_user_server(self, user_id, server_id):
+        with self.defer_writes():
+            self.add_user_server(user_id, server_id)
+        await self.commit()
+
+    async def aremove_user_server(self, user_id, server_id):
+        with self.defer_writes():
+            self.remove_user_server(user_id, server_id)
+        await self.commit()
+
+    async def aupdate_guild_count(self, server_id, mode, count):
+        with self.defer_writes():
+            self.update_guild_count(server_id, mode, count)
+        await self.commit()
+
+    async def aset_cooldown(self, user_id, server_id, expiry):
+        with self.defer_writes():
+            self.set_cooldown(user_id, server_id, expiry)
+        await self.commit()
+
+    async def aremove_cooldowns(self, keys):
+        with self.defer_writes():
+            self.remove_cooldowns(keys)
+        await self.commit()
 
     def get_user_settings(self, user_id):
-        logging.debug(f"Getting user settings for user_id={user_id}.")
+        logger.debug("Getting user settings for user_id=%s.", user_id)
         return self.data["users"].get(str(user_id), None)
 
     def update_user_settings(self, user_id, settings):
-        logging.debug(f"Updating user settings for user_id={user_id}.")
+        logger.debug("Updating user settings for user_id=%s.", user_id)
         self.data["users"][str(user_id)] = settings
+        self._reindex_user(str(user_id), settings)
+        self.on_change(("settings", str(user_id)))
+
+    def add_listener(self, listener):
+        # listener(change) вызывается на каждое изменение, например для рассылки по процессам-шардам
+        self.listeners.append(listener)
+
+    def on_change(self, change):
+        for listener in self.listeners:
+            listener(change)
+        self.record_change(change)
+
+    def record_change(self, change):
+        # change - что именно поменялось: ("settings", user_id), ("guild_count", server_id, mode, count)
+        # или ("cooldown", user_id, server_id, expiry); expiry = None - таймаут удалён.
+        # В режиме журнала в файл уходит только это изменение, а не весь документ.
+        if STORAGE_JOURNAL:
+            if change[0] == "settings":
+                entry = {"op": "set", "u": change[1], "s": self.data["users"].get(change[1])}
+            elif change[0] == "cooldown":
+                entry = {"op": "cd", "u": change[1], "g": change[2], "e": change[3]}
+            else:
+                entry = {"op": "gcnt", "g": change[1], "m": change[2], "c": change[3]}
+            self.journal_buffer.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
         self.save_data()
 
-    def get_all_users(self):
-        logging.debug("Getting all users.")
-        return list(self.data["users"].keys())
+    def get_subscribers(self, server_id):
+        # Пользователи, подписанные на сервер. Стоимость зависит только от числа его подписчиков.
+        return list(self.server_index.get(int(server_id), ()))
 
-    def get_user_server_count(self, user_id, server_id):
-        # Возвращаем сохраненное количество пользователей для данного пользователя и сервера.
-        # Если данных нет, считаем что раньше было 0.
-        settings = self.get_user_settings(user_id)
-        if not settings:
-            return 0
-        server_counts = settings.get("server_counts", {})
-        return server_counts.get(str(server_id), 0)
-
-    def update_user_server_count(self, user_id, server_id, count):
-        # Обновляем сохраненное количество людей для (user, server)
+    def add_user_server(self, user_id, server_id):
+        logger.debug("Adding server_id=%s for user_id=%s.", server_id, user_id)
+        settings = self.get_user_settings(user_id) or {
+            "servers": [],
+            "threshold": 0,
+            "mode": "total"
+        }
+        servers = settings.get("servers", [])
+        if server_id not in servers:
+            servers.append(server_id)
+        settings["servers"] = servers
+        self.update_user_settings(user_id, settings)
+
+    def remove_user_server(self, user_id, server_id):
+        logger.debug("Removing server_id=%s for user_id=%s.", server_id, user_id)
         settings = self.get_user_settings(user_id) or {
             "servers": [],
             "threshold": 0,
             "mode": "total"
         }
-        server_counts = settings.get("server_counts", {})
-        server_counts[str(server_id)] = count
-        settings["server_counts"] = server_counts
+        servers = settings.get("servers", [])
+        if server_id in servers:
+            servers.remove(server_id)
+        settings["servers"] = servers
         self.update_user_settings(user_id, settings)
+
+    def get_all_users(self):
+        logger.debug("Getting all users.")
+        return list(self.data["users"].keys())
+
+    def get_guild_count(self, server_id, mode):
+        # Последнее число людей на сервере в данном режиме ("total" / "max_channel").
+        # Если данных нет, считаем что раньше было 0.
+        return self.data["guild_counts"].get(str(server_id), {}).get(mode, 0)
+
+    def update_guild_count(self, server_id, mode, count):
+        self.data["guild_counts"].setdefault(str(server_id), {})[mode] = count
+        self.on_change(("guild_count", str(server_id), mode, count))
+
+    def get_cooldowns(self):
+        # [(user_id, server_id, expiry), ...] - только ещё действующие
+        now = time.time()
+        result = []
+        for key, expiry in self.data["cooldowns"].items():
+            if expiry > now:
+                user_str, server_str = key.rsplit(":", 1)
+                result.append((user_str, int(server_str), expiry))
+        return result
+
+    def set_cooldown(self, user_id, server_id, expiry):
+        self.data["cooldowns"][f"{user_id}:{server_id}"] = expiry
+        self.on_change(("cooldown", str(user_id), str(server_id), expiry))
+
+    def remove_cooldowns(self, keys):
+        # [(user_id, server_id), ...], которые CooldownStore выбросил: без этого истёкшие ключи
+        # копились бы в data["cooldowns"] и журнале до следующей компакции
+        cooldowns = self.data["cooldowns"]
+        for user_id, server_id in keys:
+            if cooldowns.pop(f"{user_id}:{server_id}", None) is not None:
+                self.on_change(("cooldown", str(user_id), str(server_id), None))
+
+    def prune_cooldowns(self):
+        now = time.time()
+        cooldowns = self.data["cooldowns"]
+        for key in [k for k, expiry in cooldowns.items() if expiry <= now]:
+            del cooldowns[key]
+
+
+def create_storage():
+    # Выбор бэкенда хранения по переменной окружения STORAGE_BACKEND
+    if STORAGE_BACKEND == "sqlite":
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage()
+    return Storage()
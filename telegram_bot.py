@@ -1,9 +1,16 @@
 import asyncio
 import logging
 import os
+import secrets
+import time
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
+from aiogram.methods import GetUpdates
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -11,19 +18,89 @@ from aiogram.types import (
     InlineKeyboardButton
 )
 
+from notifier import NotificationDispatcher, DigestBuffer
+from occupancy_history import HISTORY_ENABLED
+from metrics import GUILD_LATENCY, PROFILE_HOT_PATH, timed
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_ADMIN_ID = os.getenv("TELEGRAM_ADMIN_ID", "")
+# Другой адрес Bot API, например локальная заглушка из benchmarks/fake_telegram.py. Пусто - api.telegram.org
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")
+# Webhook вместо polling: публичный адрес, по которому Telegram достучится до нашего HTTP-сервера
+# (например https://bot.example.com). Пусто - polling, как раньше
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+# Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token. Если не задан, генерируется при старте
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+TELEGRAM_HANDLER_CONCURRENCY = int(os.getenv("TELEGRAM_HANDLER_CONCURRENCY", "32"))  # апдейтов в обработке одновременно
+
+
+class ConcurrencyLimit(BaseMiddleware):
+    # Ограничивает число одновременно обрабатываемых апдейтов: при polling aiogram
+    # запускает обработку каждого апдейта отдельной задачей
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+class PollTracker(BaseRequestMiddleware):
+    # Запоминает время последнего успешного getUpdates - по нему /healthz понимает, что polling жив
+    def __init__(self):
+        self.last_poll = None
+
+    async def __call__(self, make_request, bot, method):
+        response = await make_request(bot, method)
+        if isinstance(method, GetUpdates):
+            self.last_poll = time.monotonic()
+        return response
+
+
+class TrackedRequestHandler(SimpleRequestHandler):
+    # Обработка апдейта из webhook: Telegram ждёт ответа, поэтому одновременно их не больше max_connections
+    # вебхука, а задача видна stop_async и доводится до конца, даже если HTTP-сервер уже закрыл запрос
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tasks = set()
+
+    async def handle(self, request):
+        task = asyncio.create_task(super().handle(request))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return await asyncio.shield(task)
 
 
 class TelegramBot:
     def __init__(self, storage):
-        logging.debug("Initializing TelegramBot.")
+        logger.debug("Initializing TelegramBot.")
         self.storage = storage
         self.discord_bot = None
-        self.bot = Bot(token=TELEGRAM_BOT_TOKEN)
+        self.history_source = None  # у кого есть history_summary для /stats
+        # Копия имён гильдий: guild_id -> имя. Её присылает Discord-сторона, в том числе из процессов-шардов
+        self.guild_names = {}
+        if TELEGRAM_API_BASE:
+            session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE))
+            self.bot = Bot(token=TELEGRAM_BOT_TOKEN, session=session)
+        else:
+            self.bot = Bot(token=TELEGRAM_BOT_TOKEN)
+        self.poll_tracker = PollTracker()
+        self.bot.session.middleware(self.poll_tracker)
         self.dp = Dispatcher()
+        self.dp.update.outer_middleware(ConcurrencyLimit(TELEGRAM_HANDLER_CONCURRENCY))
+        self.webhook_secret = TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        self.webhook_ready = False
+        self.webhook_handler = None
+        self.stopped = None
+        # Все уведомления идут через очередь с лимитами скорости и повторами
+        self.notifier = NotificationDispatcher(self.bot.send_message)
+        # Для пользователей в режиме сводки уведомления по разным серверам склеиваются в одно сообщение
+        self.digest = DigestBuffer(self.notifier)
 
         # Состояния пользователя: user_id -> {"action": "set_threshold"/"add_server"/"remove_server"/"bugreport"}
         self.user_states = {}
@@ -43,7 +120,7 @@ class TelegramBot:
         @self.dp.message(Command("start"))
         async def cmd_start(message: types.Message):
             user_id = message.from_user.id
-            logging.debug(f"Received /start from user_id={user_id}.")
+            logger.debug(f"Received /start from user_id={user_id}.")
             await self.handle_start_command(user_id)
             await message.answer(
                 "Привет! Ниже есть меню с кнопками для управления ботом.\nИли используйте /help для списка команд.",
@@ -54,15 +131,18 @@ class TelegramBot:
         @self.dp.message(Command("help"))
         async def cmd_help(message: types.Message):
             user_id = message.from_user.id
-            logging.debug(f"Received /help from user_id={user_id}.")
+            logger.debug(f"Received /help from user_id={user_id}.")
             help_text = (
                 "Список команд:\n"
                 "/help - показать это сообщение\n"
                 "/setthreshold <число> - установить порог уведомления\n"
                 "/setmode <total|max_channel> - установить режим подсчёта\n"
+                "/setdigest <on|off> - присылать уведомления одной сводкой\n"
+                "/setcooldown <секунды> - не повторять уведомление раньше (0 - по умолчанию)\n"
                 "/addserver <server_id> - добавить сервер\n"
                 "/removeserver <server_id> - убрать сервер\n"
                 "/settings - показать текущие настройки\n"
+                "/stats <server_id> - когда на сервере больше всего людей\n"
                 "/bugreport <текст> - отправить сообщение администратору\n\n"
                 "Или используйте кнопки для взаимодействия."
             )
@@ -72,13 +152,13 @@ class TelegramBot:
         @self.dp.message(Command("settings"))
         async def cmd_settings(message: types.Message):
             user_id = message.from_user.id
-            logging.debug(f"Received /settings from user_id={user_id}.")
+            logger.debug(f"Received /settings from user_id={user_id}.")
             await self.handle_settings_command(user_id, message)
 
         # Остальные команды изначальной логики остаются, чтобы не ломать существующий функционал:
         @self.dp.message(Command("setthreshold"))
         async def cmd_setthreshold(message: types.Message):
-            logging.debug(f"Received /setthreshold from user_id={message.from_user.id}.")
+            logger.debug(f"Received /setthreshold from user_id={message.from_user.id}.")
             user_id = message.from_user.id
             parts = message.text.strip().split(maxsplit=1)
             if len(parts) < 2:
@@ -94,7 +174,7 @@ class TelegramBot:
 
         @self.dp.message(Command("setmode"))
         async def cmd_setmode(message: types.Message):
-            logging.debug(f"Received /setmode from user_id={message.from_user.id}.")
+            logger.debug(f"Received /setmode from user_id={message.from_user.id}.")
             user_id = message.from_user.id
             parts = message.text.strip().split(maxsplit=1)
             if len(parts) < 2:
@@ -107,9 +187,49 @@ class TelegramBot:
             await self.handle_set_mode_command(user_id, mode)
             await message.answer("Режим обновлен.")
 
+        @self.dp.message(Command("setdigest"))
+        async def cmd_setdigest(message: types.Message):
+            logger.debug(f"Received /setdigest from user_id={message.from_user.id}.")
+            user_id = message.from_user.id
+            parts = message.text.strip().split(maxsplit=1)
+            if len(parts) < 2 or parts[1] not in ["on", "off"]:
+                await message.answer("Укажи on или off")
+                return
+            await self.handle_set_digest_command(user_id, parts[1] == "on")
+            await message.answer("Режим сводки обновлен.")
+
+        @self.dp.message(Command("setcooldown"))
+        async def cmd_setcooldown(message: types.Message):
+            logger.debug(f"Received /setcooldown from user_id={message.from_user.id}.")
+            user_id = message.from_user.id
+            parts = message.text.strip().split(maxsplit=1)
+            if len(parts) < 2 or not parts[1].isdigit():
+                await message.answer("Укажи таймаут в секундах (0 - по умолчанию)")
+                return
+            await self.handle_set_cooldown_command(user_id, int(parts[1]))
+            await message.answer("Таймаут обновлен.")
+
+        @self.dp.message(Command("slowguilds"))
+        async def cmd_slowguilds(message: types.Message):
+            # Только для администратора: гильдии с наибольшей задержкой событие -> уведомление
+            if not TELEGRAM_ADMIN_ID or message.from_user.id != int(TELEGRAM_ADMIN_ID):
+                return
+            parts = message.text.strip().split(maxsplit=1)
+            limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+            await message.answer(self.format_slow_guilds(limit))
+
+        @self.dp.message(Command("stats"))
+        async def cmd_stats(message: types.Message):
+            logger.debug(f"Received /stats from user_id={message.from_user.id}.")
+            parts = message.text.strip().split(maxsplit=1)
+            if len(parts) < 2 or not parts[1].isdigit():
+                await message.answer("Укажи server_id")
+                return
+            await message.answer(await self.format_stats(int(parts[1])))
+
         @self.dp.message(Command("addserver"))
         async def cmd_addserver(message: types.Message):
-            logging.debug(f"Received /addserver from user_id={message.from_user.id}.")
+            logger.debug(f"Received /addserver from user_id={message.from_user.id}.")
             user_id = message.from_user.id
             parts = message.text.strip().split(maxsplit=1)
             if len(parts) < 2:
@@ -125,7 +245,7 @@ class TelegramBot:
 
         @self.dp.message(Command("removeserver"))
         async def cmd_removeserver(message: types.Message):
-            logging.debug(f"Received /removeserver from user_id={message.from_user.id}.")
+            logger.debug(f"Received /removeserver from user_id={message.from_user.id}.")
             user_id = message.from_user.id
             parts = message.text.strip().split(maxsplit=1)
             if len(parts) < 2:
@@ -142,7 +262,7 @@ class TelegramBot:
         @self.dp.message(Command("bugreport"))
         async def cmd_bugreport(message: types.Message):
             # Формат: /bugreport <текст>
-            logging.debug(f"Received /bugreport from user_id={message.from_user.id}.")
+            logger.debug(f"Received /bugreport from user_id={message.from_user.id}.")
             user_id = message.from_user.id
             parts = message.text.strip().split(maxsplit=1)
             if len(parts) < 2:
@@ -170,10 +290,16 @@ class TelegramBot:
         @self.dp.message(F.text == "Режим")
         async def btn_mode(message: types.Message):
             user_id = message.from_user.id
+            settings = self.storage.get_user_settings(user_id) or {}
+            if settings.get("digest", False):
+                digest_button = InlineKeyboardButton(text="Сводка: выключить", callback_data="digest_off")
+            else:
+                digest_button = InlineKeyboardButton(text="Сводка: включить", callback_data="digest_on")
             # Показываем inline-клавиатуру для выбора режима
             inline_kb = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="Суммарно (total)", callback_data="mode_total")],
-                [InlineKeyboardButton(text="Макс. канал (max_channel)", callback_data="mode_max")]
+                [InlineKeyboardButton(text="Макс. канал (max_channel)", callback_data="mode_max")],
+                [digest_button]
             ])
             await message.answer("Выберите режим:", reply_markup=inline_kb)
 
@@ -186,6 +312,12 @@ class TelegramBot:
             elif call.data == "mode_max":
                 await self.handle_set_mode_command(user_id, "max_channel")
                 await call.message.edit_text("Режим обновлен на max_channel.")
+            elif call.data == "digest_on":
+                await self.handle_set_digest_command(user_id, True)
+                await call.message.edit_text("Уведомления будут приходить одной сводкой.")
+            elif call.data == "digest_off":
+                await self.handle_set_digest_command(user_id, False)
+                await call.message.edit_text("Уведомления будут приходить по отдельности.")
             await call.answer()
 
         @self.dp.message(F.text == "Добавить")
@@ -250,72 +382,141 @@ class TelegramBot:
                 await message.answer("Используйте меню или /help для просмотра команд.")
 
     def set_discord_bot(self, discord_bot):
-        logging.debug("Setting discord bot in TelegramBot.")
+        logger.debug("Setting discord bot in TelegramBot.")
         self.discord_bot = discord_bot
+        self.history_source = discord_bot
+
+    def set_history_source(self, source):
+        # В режиме с процессами-шардами история лежит у них, и /stats спрашивает её через IpcHub
+        self.history_source = source
+
+    @property
+    def webhook_mode(self):
+        return bool(TELEGRAM_WEBHOOK_URL)
+
+    def setup_webhook(self, app):
+        # Регистрирует обработчик webhook в aiohttp-приложении HTTP-сервера; вызывать до его запуска
+        self.webhook_handler = TrackedRequestHandler(
+            dispatcher=self.dp, bot=self.bot, handle_in_background=False, secret_token=self.webhook_secret
+        )
+        self.webhook_handler.register(app, path=TELEGRAM_WEBHOOK_PATH)
 
     async def start_async(self):
-        logging.debug("Running TelegramBot polling.")
-        await self.bot.delete_webhook(drop_pending_updates=True)
-        await self.dp.start_polling(self.bot, signals=[])
+        self.notifier.start()
+        if not self.webhook_mode:
+            logger.debug("Running TelegramBot polling.")
+            # Накопившиеся за время простоя апдейты не выбрасываем: это команды пользователей
+            await self.bot.delete_webhook(drop_pending_updates=False)
+            # Сигналы обрабатывает main.py, а сессию закрывает stop_async - после того, как уйдут уведомления
+            await self.dp.start_polling(self.bot, handle_signals=False, close_bot_session=False)
+            return
+        url = TELEGRAM_WEBHOOK_URL.rstrip("/") + TELEGRAM_WEBHOOK_PATH
+        logger.info(f"Registering Telegram webhook at {url}.")
+        await self.bot.set_webhook(
+            url,
+            secret_token=self.webhook_secret,
+            allowed_updates=self.dp.resolve_used_update_types(),
+            # Telegram сам ограничивает число одновременных запросов (от 1 до 100)
+            max_connections=min(max(TELEGRAM_HANDLER_CONCURRENCY, 1), 100),
+            drop_pending_updates=False
+        )
+        self.webhook_ready = True
+        # Апдейты приходят в HTTP-сервер, здесь просто живём до остановки
+        self.stopped = asyncio.Event()
+        try:
+            await self.stopped.wait()
+        finally:
+            self.webhook_ready = False
+
+    def seconds_since_poll(self):
+        if self.poll_tracker.last_poll is None:
+            return None
+        return time.monotonic() - self.poll_tracker.last_poll
+
+    async def stop_intake(self):
+        # Перестаём забирать апдейты; уже принятые уведомления дошлёт stop_async
+        if self.stopped is not None:
+            self.stopped.set()
+        if not self.webhook_mode:
+            try:
+                await self.dp.stop_polling()
+            except RuntimeError:
+                pass  # polling ещё не запущен или уже остановлен
+
+    async def stop_async(self):
+        logger.debug("Stopping TelegramBot, draining notifications.")
+        if self.stopped is not None:
+            self.stopped.set()
+        if self.webhook_handler is not None and self.webhook_handler.tasks:
+            # Апдейты, принятые до остановки HTTP-сервера, обрабатываются до конца
+            await asyncio.gather(*list(self.webhook_handler.tasks), return_exceptions=True)
+        await self.digest.flush_all()
+        await self.notifier.stop()
+        await self.bot.session.close()
 
     async def handle_start_command(self, user_id):
-        logging.debug(f"Handling start command for user_id={user_id}.")
+        logger.debug(f"Handling start command for user_id={user_id}.")
         settings = self.storage.get_user_settings(user_id)
         if not settings:
-            self.storage.update_user_settings(user_id, {
+            await self.storage.aupdate_user_settings(user_id, {
                 "servers": [],
                 "threshold": 0,
                 "mode": "total"
             })
 
     async def handle_set_threshold_command(self, user_id, threshold):
-        logging.debug(f"Handling setthreshold for user_id={user_id}, threshold={threshold}.")
+        logger.debug(f"Handling setthreshold for user_id={user_id}, threshold={threshold}.")
         settings = self.storage.get_user_settings(user_id) or {
             "servers": [],
             "threshold": 0,
             "mode": "total"
         }
         settings["threshold"] = threshold
-        self.storage.update_user_settings(user_id, settings)
+        await self.storage.aupdate_user_settings(user_id, settings)
 
     async def handle_set_mode_command(self, user_id, mode):
-        logging.debug(f"Handling setmode for user_id={user_id}, mode={mode}.")
+        logger.debug(f"Handling setmode for user_id={user_id}, mode={mode}.")
         settings = self.storage.get_user_settings(user_id) or {
             "servers": [],
             "threshold": 0,
             "mode": "total"
         }
         settings["mode"] = mode
-        self.storage.update_user_settings(user_id, settings)
+        await self.storage.aupdate_user_settings(user_id, settings)
 
-    async def handle_add_server_command(self, user_id, server_id):
-        logging.debug(f"Handling addserver for user_id={user_id}, server_id={server_id}.")
+    async def handle_set_digest_command(self, user_id, enabled):
+        logger.debug(f"Handling setdigest for user_id={user_id}, enabled={enabled}.")
         settings = self.storage.get_user_settings(user_id) or {
             "servers": [],
             "threshold": 0,
             "mode": "total"
         }
-        servers = settings.get("servers", [])
-        if server_id not in servers:
-            servers.append(server_id)
-        settings["servers"] = servers
-        self.storage.update_user_settings(user_id, settings)
+        settings["digest"] = enabled
+        await self.storage.aupdate_user_settings(user_id, settings)
 
-    async def handle_remove_server_command(self, user_id, server_id):
-        logging.debug(f"Handling removeserver for user_id={user_id}, server_id={server_id}.")
+    async def handle_set_cooldown_command(self, user_id, cooldown_sec):
+        logger.debug(f"Handling setcooldown for user_id={user_id}, cooldown_sec={cooldown_sec}.")
         settings = self.storage.get_user_settings(user_id) or {
             "servers": [],
             "threshold": 0,
             "mode": "total"
         }
-        servers = settings.get("servers", [])
-        if server_id in servers:
-            servers.remove(server_id)
-        settings["servers"] = servers
-        self.storage.update_user_settings(user_id, settings)
+        if cooldown_sec > 0:
+            settings["cooldown_sec"] = cooldown_sec
+        else:
+            settings.pop("cooldown_sec", None)
+        await self.storage.aupdate_user_settings(user_id, settings)
+
+    async def handle_add_server_command(self, user_id, server_id):
+        logger.debug(f"Handling addserver for user_id={user_id}, server_id={server_id}.")
+        await self.storage.aadd_user_server(user_id, server_id)
+
+    async def handle_remove_server_command(self, user_id, server_id):
+        logger.debug(f"Handling removeserver for user_id={user_id}, server_id={server_id}.")
+        await self.storage.aremove_user_server(user_id, server_id)
 
     async def handle_settings_command(self, user_id, message: types.Message):
-        logging.debug(f"Handling settings for user_id={user_id}.")
+        logger.debug(f"Handling settings for user_id={user_id}.")
         settings = self.storage.get_user_settings(user_id)
         if not settings:
             await message.answer("У вас нет настроек. Используйте /start для инициализации.")
@@ -323,12 +524,16 @@ class TelegramBot:
         servers = settings.get("servers", [])
         threshold = settings.get("threshold", 0)
         mode = settings.get("mode", "total")
+        digest = "вкл" if settings.get("digest", False) else "выкл"
+        cooldown = settings.get("cooldown_sec")
+        cooldown_str = f"{cooldown} сек" if cooldown else "по умолчанию"
 
         if servers:
-            servers_str = "\n".join(
-                f"- {self.discord_bot.client.get_guild(s_id).name} (ID: {s_id})"
-                for s_id in servers
-            )
+            lines = []
+            for s_id in servers:
+                name = self.get_guild_name(s_id)
+                lines.append(f"- {name} (ID: {s_id})" if name else f"- ID: {s_id}")
+            servers_str = "\n".join(lines)
         else:
             servers_str = "нет"
 
@@ -337,11 +542,24 @@ class TelegramBot:
             f"Отслеживаемые сервера:\n{servers_str}\n"
             f"Порог: {threshold}\n"
             f"Режим: {mode}\n"
+            f"Сводка: {digest}\n"
+            f"Таймаут уведомлений: {cooldown_str}\n"
         )
         await message.answer(text)
 
+    def update_guilds(self, names):
+        for guild_id, name in names.items():
+            if name is None:
+                self.guild_names.pop(int(guild_id), None)
+            else:
+                self.guild_names[int(guild_id)] = name
+
+    def get_guild_name(self, server_id):
+        # Если бота нет на сервере (или Discord-сторона ещё не прислала имена), показываем только ID
+        return self.guild_names.get(int(server_id))
+
     async def handle_bugreport_command(self, user_id, report_text, message: types.Message):
-        logging.debug(f"Handling bugreport from user_id={user_id}.")
+        logger.debug(f"Handling bugreport from user_id={user_id}.")
         if not TELEGRAM_ADMIN_ID:
             await message.answer("Администратор не настроен. Сообщение не отправлено.")
             return
@@ -350,7 +568,66 @@ class TelegramBot:
         await self.bot.send_message(admin_id, report_msg)
         await message.answer("Спасибо за ваш отзыв! Ваш багрепорт отправлен администратору.")
 
-    def notify_user(self, user_id, channel_name, user_count, user_list):
-        logging.debug(f"Notifying user_id={user_id} about channel={channel_name}, count={user_count}.")
-        text = f"На {channel_name} собралось {user_count} человек: {', '.join(user_list)}"
-        asyncio.create_task(self.bot.send_message(user_id, text))
+    def format_slow_guilds(self, limit):
+        rows = GUILD_LATENCY.slowest(limit)
+        if not rows:
+            if not PROFILE_HOT_PATH:
+                return "Замеры выключены (PROFILE_HOT_PATH=false)."
+            return "Пока нет данных о задержках."
+        lines = [f"Самые медленные гильдии (событие → отправка), топ {len(rows)}:"]
+        for guild_id, count, p50, p99, max_latency in rows:
+            name = self.get_guild_name(guild_id)
+            label = f"{name} ({guild_id})" if name else str(guild_id)
+            lines.append(f"{label}: {count} увед., p50 {p50:.2f} с, p99 {p99:.2f} с, max {max_latency:.2f} с")
+        return "\n".join(lines)
+
+    async def format_stats(self, server_id):
+        if not HISTORY_ENABLED or self.history_source is None:
+            return "История заполненности недоступна."
+        summary = await self.history_source.history_summary(server_id)
+        if summary is None:
+            return "По этому серверу пока нет данных."
+        name = self.get_guild_name(server_id)
+        label = f"{name} ({server_id})" if name else str(server_id)
+        lines = [f"Статистика сервера {label}:"]
+        if summary["last"] is not None:
+            total, max_channel = summary["last"]
+            lines.append(f"Сейчас: {total} чел., в самом заполненном канале {max_channel}")
+        for title, name, fmt in (("за час", "hour", "%H:%M"), ("за сутки", "day", "%H:00"), ("за неделю", "week", "%d.%m")):
+            peak = summary["peaks"][name]
+            if peak is not None and peak[1] > 0:
+                start, total, max_channel = peak
+                lines.append(f"Пик {title}: {total} чел. ({time.strftime(fmt, time.localtime(start))}), "
+                             f"в одном канале до {max_channel}")
+        if summary["hours"]:
+            lines.append("Самые загруженные часы:")
+            for hour, avg_total, avg_max in summary["hours"]:
+                lines.append(f"{hour:02d}:00 - в среднем до {avg_total:.1f} чел., в одном канале до {avg_max:.1f}")
+        if len(lines) == 1:
+            lines.append("За последнюю неделю данных нет.")
+        return "\n".join(lines)
+
+    async def notify_users(self, user_ids, channel_name, user_count, user_list, origin=None):
+        # Одно пересечение порога -> уведомления всем, у кого оно сработало. При полной очереди ждём места:
+        # в процессе-хабе это останавливает чтение сокета, и шард замедляется, а не теряет уведомления
+        for user_id in user_ids:
+            text = self.prepare_alert(user_id, channel_name, user_count, user_list)
+            if text is not None:
+                await self.notifier.put(int(user_id), text, key=channel_name, origin=origin)
+
+    def notify_user(self, user_id, channel_name, user_count, user_list, origin=None):
+        text = self.prepare_alert(user_id, channel_name, user_count, user_list)
+        if text is not None:
+            # Ключ - канал: если предыдущее уведомление о нём ещё не ушло, просто обновим его текст
+            self.notifier.submit(int(user_id), text, key=channel_name, origin=origin)
+
+    @timed("notify_user")
+    def prepare_alert(self, user_id, channel_name, user_count, user_list):
+        # Текст уведомления или None, если пользователь получает сводку
+        logger.debug("Notifying user_id=%s about channel=%s, count=%s.", user_id, channel_name, user_count)
+        settings = self.storage.get_user_settings(user_id) or {}
+        if settings.get("digest", False):
+            # Сводка задерживается намеренно, в замер задержки событие -> отправка она не попадает
+            self.digest.add(int(user_id), channel_name, user_count, user_list)
+            return None
+        return f"На {channel_name} собралось {user_count} человек: {', '.join(user_list)}"
@@ -0,0 +1,20 @@
+# Общие фикстуры. Модули бота читают настройки при импорте, поэтому тесты не трогают os.environ,
+# а подменяют уже прочитанные константы через monkeypatch - после теста они возвращаются сами.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # JSON-хранилище с журналом во временном каталоге теста
+    monkeypatch.setattr(storage, "DB_PATH", str(tmp_path / "data.json"))
+    monkeypatch.setattr(storage, "JOURNAL_PATH", str(tmp_path / "data.json.journal"))
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "json")
+    monkeypatch.setattr(storage, "STORAGE_JOURNAL", True)
+    return tmp_path
@@ -0,0 +1,37 @@
+# CooldownStore: истёкшие записи и вытесненные при переполнении возвращаются вызывающему,
+# чтобы их можно было убрать и из хранилища.
+from cooldowns import CooldownStore
+
+
+def test_set_returns_expired_keys():
+    store = CooldownStore(max_size=10)
+    assert store.set(("1", 10), 100.0, now=0.0) == []
+    assert store.set(("2", 10), 50.0, now=0.0) == []
+    assert store.set(("3", 10), 200.0, now=60.0) == [("2", 10)]
+    assert store.is_active(("1", 10), now=60.0)
+    assert not store.is_active(("2", 10), now=60.0)
+    assert len(store) == 2
+
+
+def test_overflow_evicts_soonest_expiry():
+    store = CooldownStore(max_size=2)
+    store.set(("1", 10), 300.0, now=0.0)
+    store.set(("2", 10), 100.0, now=0.0)
+    assert store.set(("3", 10), 200.0, now=0.0) == [("2", 10)]
+    assert sorted(store.expiry) == [("1", 10), ("3", 10)]
+
+
+def test_updated_expiry_replaces_old_heap_entry():
+    store = CooldownStore(max_size=10)
+    store.set(("1", 10), 50.0, now=0.0)
+    store.set(("1", 10), 500.0, now=0.0)
+    # Старый элемент кучи со временем 50 пропускается и не удаляет продлённый таймаут
+    assert store.purge(100.0) == []
+    assert store.is_active(("1", 10), now=100.0)
+
+
+def test_load_skips_expired_and_returns_overflow():
+    store = CooldownStore(max_size=2)
+    removed = store.load([("1", 10, 50.0), ("2", 10, 300.0), ("3", 10, 200.0), ("4", 10, 400.0)], now=100.0)
+    assert removed == [("3", 10)]
+    assert sorted(store.expiry) == [("2", 10), ("4", 10)]
@@ -0,0 +1,67 @@
+# Полная очередь уведомлений в процессе-хабе должна останавливать шард, а не терять пересечения порогов.
+#   python -m pytest -q tests
+import asyncio
+
+import ipc
+import notifier
+import telegram_bot
+from ipc import IpcHub, HubClient, ReplicaStorage
+from storage import create_storage
+from telegram_bot import TelegramBot
+
+CROSSINGS = 300
+NAMES = ["x" * 100] * 100  # ~10 КБ на сообщение, чтобы буферы сокета заполнились быстро
+
+
+async def publish_with_full_dispatcher():
+    storage = create_storage()
+    telegram_bot = TelegramBot(storage)
+    notifier = telegram_bot.notifier
+    # Отправителей нет: очередь диспетчера заполняется и не разбирается
+    notifier.accepting = True
+    hub = IpcHub(storage, telegram_bot)
+    await hub.start()
+    client = HubClient(ReplicaStorage(), None, 1)
+    client_task = asyncio.create_task(client.run())
+    await asyncio.wait_for(client.ready.wait(), 5)
+
+    accepted = 0
+    timed_out = 0
+    for i in range(CROSSINGS):
+        # Разные каналы - разные ключи, уведомления не склеиваются
+        if await client.notify_users(["1"], f"channel-{i}", 5, NAMES):
+            accepted += 1
+        else:
+            timed_out += 1
+            break
+    dropped_while_full = notifier.dropped
+
+    # Освобождаем очередь: всё, что шард успел отправить, должно дойти до диспетчера
+    delivered = []
+    while len(delivered) < accepted:
+        alert = await asyncio.wait_for(notifier.queue.get(), 5)
+        delivered.append(alert.text)
+
+    client_task.cancel()
+    await hub.stop()
+    await storage.close()
+    return accepted, timed_out, dropped_while_full, delivered, notifier.dropped
+
+
+def test_full_dispatcher_blocks_worker_instead_of_dropping(data_dir, monkeypatch):
+    monkeypatch.setattr(telegram_bot, "TELEGRAM_BOT_TOKEN", "123456789:test-token-not-used-for-network")
+    monkeypatch.setattr(ipc, "IPC_SOCKET_PATH", str(data_dir / "ipc.sock"))
+    monkeypatch.setattr(ipc, "IPC_QUEUE_SIZE", 4)
+    monkeypatch.setattr(ipc, "IPC_PUBLISH_TIMEOUT_SEC", 0.3)
+    # Маленький буфер чтения хаба, иначе до остановки шарда уйдут десятки мегабайт
+    monkeypatch.setattr(ipc, "IPC_LINE_LIMIT", 64 * 1024)
+    monkeypatch.setattr(notifier, "NOTIFY_QUEUE_SIZE", 2)
+    accepted, timed_out, dropped_while_full, delivered, dropped = asyncio.run(publish_with_full_dispatcher())
+    # Шард упёрся в Connection.put и получил отказ по таймауту, а не отправил всё в пустоту
+    assert timed_out == 1
+    assert accepted < CROSSINGS
+    # Хаб ждал места в очереди (NOTIFY_SUBMIT_TIMEOUT_SEC намного больше таймаута шарда) и ничего не выбросил
+    assert dropped_while_full == 0
+    assert dropped == 0
+    # Каждое принятое шардом пересечение дошло до диспетчера, по порядку
+    assert [text.split(" ")[1] for text in delivered] == [f"channel-{i}" for i in range(accepted)]
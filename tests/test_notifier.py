@@ -0,0 +1,115 @@
+# NotificationDispatcher: ожидающее уведомление с тем же ключом обновляется, а не дублируется;
+# повтор после 429 и отказ без повтора на ошибке API.
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import notifier
+from notifier import NotificationDispatcher
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limits(monkeypatch):
+    monkeypatch.setattr(notifier, "NOTIFY_GLOBAL_RATE", 1000000.0)
+    monkeypatch.setattr(notifier, "NOTIFY_CHAT_RATE", 1000000.0)
+    monkeypatch.setattr(notifier, "NOTIFY_CHAT_BURST", 1000000)
+    monkeypatch.setattr(notifier, "NOTIFY_WORKERS", 1)
+
+
+@pytest.fixture
+def small_queue(monkeypatch):
+    monkeypatch.setattr(notifier, "NOTIFY_QUEUE_SIZE", 3)
+
+
+async def run_dispatcher(send, submit):
+    dispatcher = NotificationDispatcher(send)
+    dispatcher.accepting = True
+    submit(dispatcher)
+    dispatcher.start()
+    await dispatcher.stop(timeout=5)
+    return dispatcher
+
+
+def test_pending_alert_with_same_key_is_merged():
+    sent = []
+
+    async def send(chat_id, text):
+        sent.append((chat_id, text))
+
+    def submit(dispatcher):
+        dispatcher.submit(1, "5 человек", key="channel")
+        dispatcher.submit(1, "6 человек", key="channel")
+        dispatcher.submit(2, "6 человек", key="channel")
+        dispatcher.submit(1, "другой канал", key="other")
+
+    dispatcher = asyncio.run(run_dispatcher(send, submit))
+    assert sent == [(1, "6 человек"), (2, "6 человек"), (1, "другой канал")]
+    assert dispatcher.merged == 1
+    assert dispatcher.pending == {}
+
+
+def test_alert_after_send_is_not_merged():
+    sent = []
+
+    async def send(chat_id, text):
+        sent.append(text)
+
+    async def scenario():
+        dispatcher = NotificationDispatcher(send)
+        dispatcher.start()
+        dispatcher.submit(1, "первое", key="channel")
+        await dispatcher.queue.join()
+        dispatcher.submit(1, "второе", key="channel")
+        await dispatcher.stop(timeout=5)
+        return dispatcher
+
+    dispatcher = asyncio.run(scenario())
+    assert sent == ["первое", "второе"]
+    assert dispatcher.merged == 0
+
+
+def test_retry_after_is_retried():
+    attempts = []
+
+    async def send(chat_id, text):
+        attempts.append(text)
+        if len(attempts) == 1:
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Too Many Requests", 0)
+
+    dispatcher = asyncio.run(run_dispatcher(send, lambda d: d.submit(1, "текст")))
+    assert attempts == ["текст", "текст"]
+    assert (dispatcher.sent, dispatcher.failed) == (1, 0)
+
+
+def test_api_error_is_not_retried():
+    attempts = []
+
+    async def send(chat_id, text):
+        attempts.append(text)
+        raise TelegramBadRequest(SendMessage(chat_id=chat_id, text=text), "chat not found")
+
+    dispatcher = asyncio.run(run_dispatcher(send, lambda d: d.submit(1, "текст")))
+    assert attempts == ["текст"]
+    assert (dispatcher.sent, dispatcher.failed) == (0, 1)
+
+
+def test_full_queue_drops_on_submit_and_waits_on_put(small_queue):
+    async def scenario():
+        dispatcher = NotificationDispatcher(None)
+        dispatcher.accepting = True
+        for i in range(notifier.NOTIFY_QUEUE_SIZE):
+            dispatcher.submit(1, f"{i}")
+        assert not dispatcher.submit(2, "лишнее")
+        # put ждёт, пока место освободится, вместо того чтобы выбросить уведомление
+        waiting = asyncio.create_task(dispatcher.put(3, "дождалось", timeout=5))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        dispatcher.queue.get_nowait()
+        assert await waiting
+        assert not await dispatcher.put(4, "не дождалось", timeout=0.05)
+        return dispatcher
+
+    dispatcher = asyncio.run(scenario())
+    assert dispatcher.dropped == 2
@@ -0,0 +1,74 @@
+# Журнал хранилища: изменения после перезапуска восстанавливаются из журнала, битый хвост
+# отрезается, компакция переносит всё в снимок и очищает журнал.
+import json
+import os
+import time
+
+import storage
+from storage import Storage
+
+
+def test_journal_replays_changes_after_restart(data_dir):
+    first = Storage()
+    first.update_user_settings("1", {"servers": [10, 20], "threshold": 3, "mode": "total"})
+    first.update_guild_count(10, "total", 4)
+    expiry = time.time() + 600
+    first.set_cooldown("1", 10, expiry)
+    # Снимок остался пустым, всё лежит в журнале
+    with open(storage.DB_PATH, encoding="utf-8") as f:
+        assert json.load(f)["users"] == {}
+
+    second = Storage()
+    assert second.get_user_settings("1") == {"servers": [10, 20], "threshold": 3, "mode": "total"}
+    assert second.get_guild_count(10, "total") == 4
+    assert second.get_cooldowns() == [("1", 10, expiry)]
+    # Индексы строятся по восстановленным данным
+    assert second.get_subscribers(20) == ["1"]
+    assert second.threshold_index.crossed(10, "total", 2, 3) == ["1"]
+
+
+def test_removed_cooldown_stays_removed_after_replay(data_dir):
+    first = Storage()
+    first.set_cooldown("1", 10, time.time() + 600)
+    first.remove_cooldowns([("1", 10)])
+    assert Storage().get_cooldowns() == []
+
+
+def test_truncated_journal_tail_is_cut(data_dir):
+    first = Storage()
+    first.update_user_settings("1", {"servers": [10], "threshold": 1, "mode": "total"})
+    good_size = os.path.getsize(storage.JOURNAL_PATH)
+    # Падение посреди записи строки журнала
+    with open(storage.JOURNAL_PATH, "ab") as f:
+        f.write(b'{"op":"set","u":"2","s":{"serv')
+
+    second = Storage()
+    assert second.get_all_users() == ["1"]
+    assert os.path.getsize(storage.JOURNAL_PATH) == good_size
+    # Следующая запись не склеивается с обрезанным хвостом
+    second.update_user_settings("3", {"servers": [10], "threshold": 2, "mode": "total"})
+    assert sorted(Storage().get_all_users()) == ["1", "3"]
+
+
+def test_compaction_moves_journal_into_snapshot(data_dir):
+    first = Storage()
+    for user in range(5):
+        first.update_user_settings(str(user), {"servers": [10], "threshold": user, "mode": "max_channel"})
+    assert os.path.getsize(storage.JOURNAL_PATH) > 0
+
+    first.flush(compact=True)
+    assert os.path.getsize(storage.JOURNAL_PATH) == 0
+    assert first.journal_size == 0
+    with open(storage.DB_PATH, encoding="utf-8") as f:
+        assert sorted(json.load(f)["users"]) == ["0", "1", "2", "3", "4"]
+    assert sorted(Storage().get_all_users()) == ["0", "1", "2", "3", "4"]
+
+
+def test_journal_compacts_by_size(data_dir, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_COMPACT_BYTES", 200)
+    first = Storage()
+    for user in range(10):
+        first.update_user_settings(str(user), {"servers": [10], "threshold": 1, "mode": "total"})
+    # Журнал не растёт дальше порога: каждый раз, когда он его превышает, содержимое уходит в снимок
+    assert os.path.getsize(storage.JOURNAL_PATH) <= 200
+    assert len(Storage().get_all_users()) == 10
@@ -0,0 +1,46 @@
+# ThresholdIndex.crossed отдаёт ровно тех, чей порог лежит в (старое число, новое число].
+from threshold_index import ThresholdIndex
+
+
+def build(users):
+    index = ThresholdIndex()
+    for user_str, threshold, mode, servers in users:
+        index.update_user(user_str, {"servers": servers, "threshold": threshold, "mode": mode})
+    return index
+
+
+def test_crossed_returns_thresholds_in_half_open_range():
+    index = build([("a", 2, "total", [1]), ("b", 3, "total", [1]), ("c", 3, "total", [1]), ("d", 5, "total", [1])])
+    assert index.crossed(1, "total", 2, 3) == ["b", "c"]
+    assert index.crossed(1, "total", 1, 5) == ["a", "b", "c", "d"]
+    # Порог, равный старому числу, уже был достигнут раньше
+    assert index.crossed(1, "total", 3, 4) == []
+
+
+def test_crossed_only_on_growth():
+    index = build([("a", 2, "total", [1])])
+    assert index.crossed(1, "total", 3, 1) == []
+    assert index.crossed(1, "total", 2, 2) == []
+
+
+def test_crossed_separates_servers_and_modes():
+    index = build([("a", 2, "total", [1, 2]), ("b", 2, "max_channel", [1])])
+    assert index.crossed(1, "total", 0, 2) == ["a"]
+    assert index.crossed(2, "total", 0, 2) == ["a"]
+    assert index.crossed(1, "max_channel", 0, 2) == ["b"]
+    # server_id из хранилища может прийти строкой
+    assert index.crossed("1", "max_channel", 0, 2) == ["b"]
+    assert index.crossed(3, "total", 0, 10) == []
+
+
+def test_update_user_moves_entries():
+    index = build([("a", 2, "total", [1, 2])])
+    index.update_user("a", {"servers": [2], "threshold": 4, "mode": "max_channel"})
+    assert index.crossed(1, "total", 0, 10) == []
+    assert index.crossed(2, "total", 0, 10) == []
+    assert index.crossed(2, "max_channel", 3, 4) == ["a"]
+    assert not index.has_subscribers(1, "total")
+    # Без серверов пользователь пропадает из индекса целиком
+    index.update_user("a", {"servers": [], "threshold": 4, "mode": "max_channel"})
+    assert index.entries == {}
+    assert index.users == {}
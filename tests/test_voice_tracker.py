@@ -0,0 +1,52 @@
+# GuildOccupancy: total и максимум по каналам после каждого перемещения совпадают с полным пересчётом.
+import random
+
+from voice_tracker import GuildOccupancy
+
+
+def recount(occupancy):
+    sizes = [len(members) for members in occupancy.channel_members.values()]
+    return sum(sizes), max(sizes, default=0)
+
+
+def test_join_move_leave():
+    occupancy = GuildOccupancy(1)
+    assert occupancy.move(100, 10)
+    assert occupancy.move(101, 10)
+    assert occupancy.move(102, 11)
+    assert (occupancy.total, occupancy.max_count, occupancy.max_channel_id()) == (3, 2, 10)
+    # Тот же канал (мьют, деафен) ничего не меняет
+    assert not occupancy.move(100, 10)
+    occupancy.move(100, 11)
+    assert (occupancy.total, occupancy.max_count, occupancy.max_channel_id()) == (3, 2, 11)
+    occupancy.move(100, None)
+    occupancy.move(102, None)
+    assert (occupancy.total, occupancy.max_count, occupancy.max_channel_id()) == (1, 1, 10)
+    occupancy.move(101, None)
+    assert (occupancy.total, occupancy.max_count, occupancy.max_channel_id()) == (0, 0, None)
+    assert occupancy.channel_members == {}
+    assert occupancy.size_buckets == {}
+
+
+def test_max_channel_tie_takes_lowest_id():
+    occupancy = GuildOccupancy(1)
+    occupancy.move(100, 12)
+    occupancy.move(101, 11)
+    assert occupancy.max_channel_id() == 11
+
+
+def test_leave_unknown_member_is_ignored():
+    occupancy = GuildOccupancy(1)
+    assert not occupancy.move(100, None)
+    assert (occupancy.total, occupancy.max_count) == (0, 0)
+
+
+def test_random_moves_match_full_recount():
+    rng = random.Random(7)
+    occupancy = GuildOccupancy(1)
+    channels = [None, 10, 11, 12, 13]
+    for _ in range(5000):
+        occupancy.move(rng.randrange(40), rng.choice(channels))
+        assert (occupancy.total, occupancy.max_count) == recount(occupancy)
+        if occupancy.max_count:
+            assert len(occupancy.channel_members[occupancy.max_channel_id()]) == occupancy.max_count
@@ -0,0 +1,71 @@
+import bisect
+
+# Верхняя граница для user_id (str) при поиске по кортежам (порог, user_id)
+USER_MAX = "\uffff"
+
+
+MODES = ("total", "max_channel")
+
+
+def normalize_mode(mode):
+    # Всё, что не total, считается по самому заполненному каналу - так же, как в VoiceSnapshot.view
+    return "total" if mode == "total" else "max_channel"
+
+
+class ThresholdIndex:
+    # Пороги подписчиков по (server_id, режим) в отсортированных массивах. Когда число людей
+    # меняется с A на B, порог пересекли ровно те, у кого A < порог <= B - это один срез по bisect,
+    # остальных подписчиков гильдии не трогаем вовсе.
+    def __init__(self):
+        self.entries = {}  # (server_id, mode) -> отсортированный список (threshold, user_str)
+        self.users = {}  # user_str -> (threshold, mode, frozenset(server_id)), что лежит в индексе сейчас
+
+    def clear(self):
+        self.entries = {}
+        self.users = {}
+
+    def update_user(self, user_str, settings):
+        old = self.users.get(user_str)
+        new = None
+        if settings and settings.get("servers"):
+            new = (
+                int(settings.get("threshold", 0)),
+                normalize_mode(settings.get("mode", "total")),
+                frozenset(int(s) for s in settings["servers"])
+            )
+        if old == new:
+            return
+        if old is not None:
+            threshold, mode, servers = old
+            for server_id in servers:
+                self._remove(server_id, mode, threshold, user_str)
+        if new is not None:
+            threshold, mode, servers = new
+            for server_id in servers:
+                bisect.insort(self.entries.setdefault((server_id, mode), []), (threshold, user_str))
+            self.users[user_str] = new
+        else:
+            self.users.pop(user_str, None)
+
+    def _remove(self, server_id, mode, threshold, user_str):
+        key = (server_id, mode)
+        items = self.entries.get(key)
+        if not items:
+            return
+        i = bisect.bisect_left(items, (threshold, user_str))
+        if i < len(items) and items[i] == (threshold, user_str):
+            del items[i]
+        if not items:
+            del self.entries[key]
+
+    def crossed(self, server_id, mode, old_count, new_count):
+        # Пользователи, чей порог лежит в (old_count, new_count]: для них число людей перешло порог снизу вверх
+        items = self.entries.get((int(server_id), mode))
+        if not items or new_count <= old_count:
+            return []
+        lo = bisect.bisect_right(items, (old_count, USER_MAX))
+        hi = bisect.bisect_right(items, (new_count, USER_MAX))
+        return [user_str for _, user_str in items[lo:hi]]
+
+    def has_subscribers(self, server_id, mode):
+        return (int(server_id), mode) in self.entries
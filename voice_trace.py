@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import secrets
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Запись голосовых событий для воспроизведения (benchmarks/voice_replay.py). Пустой путь - выключено
+VOICE_TRACE_PATH = os.getenv("VOICE_TRACE_PATH", "")
+VOICE_TRACE_MAX_BYTES = int(os.getenv("VOICE_TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+VOICE_TRACE_BACKUPS = int(os.getenv("VOICE_TRACE_BACKUPS", "3"))
+# Ключ хэша участников. Без него ключ случайный, и хэши одного человека совпадают только в пределах запуска
+VOICE_TRACE_SALT = os.getenv("VOICE_TRACE_SALT", "")
+VOICE_TRACE_FLUSH_SEC = 5
+
+
+def member_hash(member_id, key):
+    digest = hashlib.blake2b(str(member_id).encode(), key=key, digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1  # 63 бита, чтобы влезать в signed int64 у потребителей
+
+
+def read_trace(paths):
+    # Строки [ts, guild_id, member_hash, before_channel_id|null, after_channel_id|null] из файлов по порядку
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Недописанная строка в конце файла после падения
+                    logger.warning(f"Skipping broken trace line in {path}.")
+
+
+class VoiceTraceRecorder:
+    # Дописывает события в JSONL с ротацией по размеру, как RotatingFileHandler: path, path.1, ... path.N.
+    # Имена и ID участников в файл не попадают, только хэш с ключом.
+    def __init__(self, path, max_bytes=VOICE_TRACE_MAX_BYTES, backups=VOICE_TRACE_BACKUPS, salt=VOICE_TRACE_SALT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.key = hashlib.blake2b(salt.encode()).digest()[:32] if salt else secrets.token_bytes(32)
+        self.file = None
+        self.size = 0
+        self.last_flush = 0.0
+        self.events = 0
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+        logger.info(f"Recording voice events to {self.path}.")
+
+    def record(self, guild_id, member_id, before_channel, after_channel):
+        before_id = before_channel.id if before_channel else None
+        after_id = after_channel.id if after_channel else None
+        if before_id == after_id:
+            return
+        now = time.time()
+        line = json.dumps(
+            [round(now, 3), guild_id, member_hash(member_id, self.key), before_id, after_id], separators=(",", ":")
+        ) + "\n"
+        # Файл буферизован: на событие обычно ни одного системного вызова, сброс - раз в несколько секунд
+        self.file.write(line)
+        self.size += len(line)
+        self.events += 1
+        if now - self.last_flush > VOICE_TRACE_FLUSH_SEC:
+            self.file.flush()
+            self.last_flush = now
+        if self.size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            logger.info(f"Voice trace closed after {self.events} events.")
@@ -0,0 +1,204 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Заполненность голосовых каналов одной гильдии (без ботов).
+# Все изменения по событию стоят O(1): счётчик канала сдвигается на ±1,
+# канал переезжает в соседнюю корзину по размеру, максимум поправляется
+# не больше чем на единицу.
+class GuildOccupancy:
+    __slots__ = ("guild_id", "channel_members", "member_channel", "size_buckets", "total", "max_count")
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.channel_members = {}  # channel_id -> set(member_id)
+        self.member_channel = {}  # member_id -> channel_id
+        self.size_buckets = {}  # количество людей -> set(channel_id)
+        self.total = 0
+        self.max_count = 0
+
+    def _bucket_remove(self, size, channel_id):
+        bucket = self.size_buckets.get(size)
+        if bucket is not None:
+            bucket.discard(channel_id)
+            if not bucket:
+                del self.size_buckets[size]
+
+    def _bucket_add(self, size, channel_id):
+        if size > 0:
+            self.size_buckets.setdefault(size, set()).add(channel_id)
+
+    def _leave(self, member_id):
+        channel_id = self.member_channel.pop(member_id, None)
+        if channel_id is None:
+            return
+        members = self.channel_members.get(channel_id)
+        if members is None or member_id not in members:
+            return
+        size = len(members)
+        members.discard(member_id)
+        if not members:
+            del self.channel_members[channel_id]
+        self._bucket_remove(size, channel_id)
+        self._bucket_add(size - 1, channel_id)
+        self.total -= 1
+        # Размер канала уменьшился на один, поэтому максимум опускается максимум на единицу
+        if size == self.max_count and self.max_count not in self.size_buckets:
+            self.max_count -= 1
+
+    def _join(self, member_id, channel_id):
+        members = self.channel_members.setdefault(channel_id, set())
+        if member_id in members:
+            return
+        size = len(members)
+        members.add(member_id)
+        self.member_channel[member_id] = channel_id
+        self._bucket_remove(size, channel_id)
+        self._bucket_add(size + 1, channel_id)
+        self.total += 1
+        if size + 1 > self.max_count:
+            self.max_count = size + 1
+
+    def move(self, member_id, channel_id):
+        # channel_id=None означает, что участник вышел из голосовых каналов
+        if self.member_channel.get(member_id) == channel_id:
+            return False
+        self._leave(member_id)
+        if channel_id is not None:
+            self._join(member_id, channel_id)
+        return True
+
+    def max_channel_id(self):
+        bucket = self.size_buckets.get(self.max_count)
+        if not bucket:
+            return None
+        # При равенстве берём канал с наименьшим id, чтобы результат был стабильным
+        return min(bucket)
+
+    def member_ids(self):
+        return self.member_channel.keys()
+
+
+class VoiceTracker:
+    def __init__(self):
+        self.guilds = {}  # guild_id -> GuildOccupancy
+
+    def seed_guild(self, guild):
+        # Полный обход каналов гильдии. Нужен только при старте, переподключении
+        # и периодической сверке, а не на каждое событие.
+        occupancy = GuildOccupancy(guild.id)
+        for vc in guild.voice_channels:
+            for m in vc.members:
+                if not m.bot:
+                    occupancy.move(m.id, vc.id)
+        self.guilds[guild.id] = occupancy
+        return occupancy
+
+    def seed_all(self, guilds):
+        for guild in guilds:
+            self.seed_guild(guild)
+        logger.debug(f"Voice tracker seeded for {len(self.guilds)} guilds.")
+
+    def reconcile(self, guild):
+        # Сверка инкрементального состояния с тем, что лежит в кэше discord.py
+        old = self.guilds.get(guild.id)
+        fresh = self.seed_guild(guild)
+        if old is not None and (old.total != fresh.total or old.max_count != fresh.max_count):
+            logger.warning(
+                f"Voice tracker drift in guild_id={guild.id}: "
+                f"total {old.total}->{fresh.total}, max {old.max_count}->{fresh.max_count}."
+            )
+            return True
+        return False
+
+    def drop_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def dump_state(self):
+        # {guild_id: {channel_id: [member_id, ...]}} для тёплого старта; ключи строками, как в JSON
+        return {
+            str(guild_id): {str(channel_id): list(members) for channel_id, members in occupancy.channel_members.items()}
+            for guild_id, occupancy in self.guilds.items()
+        }
+
+    def load_state(self, state):
+        for guild_str, channels in state.items():
+            occupancy = GuildOccupancy(int(guild_str))
+            for channel_str, members in channels.items():
+                for member_id in members:
+                    occupancy.move(member_id, int(channel_str))
+            self.guilds[occupancy.guild_id] = occupancy
+        logger.debug(f"Voice tracker restored for {len(state)} guilds.")
+
+    def get(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def apply(self, member, before_channel, after_channel):
+        # Возвращает True, если заполненность каналов действительно изменилась
+        # (мьют/деафен приходят с тем же каналом и ничего не меняют).
+        if member.bot:
+            return False
+        before_id = before_channel.id if before_channel else None
+        after_id = after_channel.id if after_channel else None
+        if before_id == after_id:
+            return False
+        occupancy = self.guilds.get(member.guild.id)
+        if occupancy is None:
+            occupancy = self.seed_guild(member.guild)
+            return True
+        return occupancy.move(member.id, after_id)
+
+
+# Срез заполненности гильдии на момент одного события. Общий для всех подписчиков:
+# считается один раз, а списки имён собираются лениво - только если уведомление реально уходит.
+class VoiceSnapshot:
+    __slots__ = ("guild", "guild_name", "_occupancy", "total", "max_channel", "max_channel_id", "max_channel_name",
+                 "_total_names", "_max_names")
+
+    def __init__(self, guild, occupancy):
+        self.guild = guild
+        self.guild_name = guild.name if guild else ""
+        self._occupancy = occupancy
+        if occupancy is None:
+            self.total = 0
+            self.max_channel = 0
+            self.max_channel_id = None
+        else:
+            self.total = occupancy.total
+            self.max_channel = occupancy.max_count
+            self.max_channel_id = occupancy.max_channel_id()
+        channel = guild.get_channel(self.max_channel_id) if guild and self.max_channel_id else None
+        self.max_channel_name = channel.name if channel else ""
+        self._total_names = None
+        self._max_names = None
+
+    def _names(self, member_ids):
+        names = []
+        for member_id in member_ids:
+            m = self.guild.get_member(member_id) if self.guild else None
+            if m:
+                names.append(m.name)
+        return names
+
+    def total_member_names(self):
+        if self._total_names is None:
+            ids = self._occupancy.member_ids() if self._occupancy else ()
+            self._total_names = self._names(ids)
+        return self._total_names
+
+    def max_channel_member_names(self):
+        if self._max_names is None:
+            ids = self._occupancy.channel_members.get(self.max_channel_id, ()) if self._occupancy else ()
+            self._max_names = self._names(ids)
+        return self._max_names
+
+    def view(self, mode):
+        # (количество, подпись для уведомления, функция получения имён) для режима подписчика
+        if mode == "total":
+            return self.total, f"Сервер {self.guild_name} (все каналы)", self.total_member_names
+        return (
+            self.max_channel,
+            f"Сервер {self.guild_name}, канал {self.max_channel_name}",
+            self.max_channel_member_names,
+        )